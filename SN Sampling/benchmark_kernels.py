@@ -0,0 +1,171 @@
+import numpy as np
+import astropy.io.fits as pyfits
+import platform
+import timeit
+import json
+import time
+import sys
+
+import psf_mog_fitting as pmf
+
+# micro-benchmarks of the PSF and galaxy rendering and fitting kernels. every input is fixed --
+# drawn with a fixed seed, or from the fitted PSF components and the hosts below -- so runs on
+# different code are directly comparable. results are saved as json, keyed by kernel and sweep
+# parameters, and can be compared against a stored baseline:
+#   python benchmark_kernels.py run [results.json]
+#   python benchmark_kernels.py compare results.json baseline.json [tolerance]
+
+psf_comp_filename = '../PSFs/wfirst_psf_comp.npy'
+pixel_scale, filt_zp = 0.11, 26.41
+seed = 1234
+
+
+def time_kernel(fun, repeat=7, min_time=0.2):
+    # best and median time per call of fun(), each of repeat timings running it enough times to
+    # take at least min_time seconds, as timeit's autorange
+    timer = timeit.Timer(fun)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+    return {'best': np.amin(times), 'median': np.median(times), 'number': number}
+
+
+# mu_0, n_type, e_disk, pa_disk, half_l_r, offset_r, mag, offset_ra_pix, offset_dec_pix of ten
+# hosts, as drawn by sn_sampling.draw_host_params with the fixed seed. they are kept here, rather
+# than drawn on every run, so that the benchmarks need not import sn_sampling, and with it
+# galsim, sncosmo and the webbpsf data
+fixed_hosts = [[21.2889, 4, 0.8927, 280.79, 0.8997, 2.2907, 19.6462, 0.2809, 0.7958],
+               [20.0587, 1, 0.8883, 128.81, 1.4022, 2.2653, 17.4577, 0.6798, 0.7084],
+               [21.6455, 1, 0.1124, 278.22, 2.2418, 3.6218, 20.2702, 0.3676, 0.6131],
+               [19.4443, 4, 0.6844, 335.93, 1.7330, 4.4124, 16.6665, 0.3993, 0.7830],
+               [21.4399, 1, 0.4926, 288.77, 0.6163, 0.9957, 21.2644, 0.7002, 0.7005],
+               [19.5954, 4, 0.9624, 159.17, 2.3005, 5.8572, 15.8324, 0.0686, 0.1906],
+               [21.0323, 1, 0.5800, 15.60, 1.5352, 2.4802, 18.6975, 0.3331, 0.5029],
+               [20.7011, 4, 0.8036, 203.74, 0.3149, 0.8017, 21.4524, 0.6151, 0.9039],
+               [21.5623, 4, 0.5978, 137.63, 0.4185, 1.0656, 22.0168, 0.4526, 0.9724],
+               [19.8701, 4, 0.5597, 265.87, 1.5921, 4.0535, 17.4950, 0.4722, 0.1150]]
+
+
+def fixed_host_params(n_hosts):
+    # the gal_params of mog_galaxy for the first n_hosts fixed hosts, with the unit covariance of
+    # each elliptical profile made as in draw_host_params
+    hosts = []
+    for mu_0, n_type, e_disk, pa_disk, half_l_r, offset_r, mag, offset_ra, offset_dec in \
+            fixed_hosts[:n_hosts]:
+        t = np.radians(pa_disk)
+        Rg = np.array([[-np.sin(t), e_disk * np.cos(t)], [np.cos(t), e_disk * np.sin(t)]])
+        hosts.append([mu_0, n_type, e_disk, pa_disk, half_l_r, offset_r,
+                      np.matmul(Rg, np.transpose(Rg)), mag, offset_ra, offset_dec])
+    return hosts
+
+
+def benchmark_gaussian_2d(results, psf_comp):
+    mks, Vks, _ = pmf.psf_comp_to_mog(psf_comp[0])
+    for len_image in [25, 51, 101]:
+        x_pos = np.arange(0, len_image) - (len_image - 1) / 2
+        x = np.stack(np.meshgrid(x_pos, x_pos, indexing='ij'), axis=-1).reshape(len_image,
+                                                                                 len_image, 2, 1)
+        x_t = x.reshape(len_image, len_image, 1, 2)
+        mu, sigma = mks[0].reshape(2, 1), Vks[0]
+        results['gaussian_2d/len_image={}'.format(len_image)] = time_kernel(
+            lambda: pmf.gaussian_2d(x, x_t, mu, mu.T, sigma))
+
+
+def benchmark_mog_galaxy(results, psf_comp, hosts):
+    # component-count sweep over a set of hosts with their drawn stamp sizes, and stamp-size sweep
+    # of a single host by scaling its offset radius, with the full PSF
+    for n_comp in [4, 8, 12, psf_comp.shape[1]]:
+        psf_c = psf_comp[0, :n_comp]
+        results['mog_galaxy/n_comp={}'.format(n_comp)] = time_kernel(
+            lambda: [pmf.mog_galaxy(pixel_scale, filt_zp, psf_c, host) for host in hosts])
+    for len_image in [25, 51, 101]:
+        host = list(hosts[0])
+        host[5] = len_image * pixel_scale / 2.2
+        results['mog_galaxy/len_image={}'.format(len_image)] = time_kernel(
+            lambda: pmf.mog_galaxy(pixel_scale, filt_zp, psf_comp[0], host))
+        results['mog_galaxy_truncated/len_image={}'.format(len_image)] = time_kernel(
+            lambda: pmf.mog_galaxy(pixel_scale, filt_zp, psf_comp[0], host, n_sigma=5))
+
+
+def benchmark_mog_add_psf(results, psf_comp):
+    np.random.seed(seed)
+    offsets = np.random.uniform(-0.5, 0.5, size=(10, 2))
+    for len_image in [25, 51, 101]:
+        for n_comp in [4, 8, 12, psf_comp.shape[1]]:
+            psf_c = psf_comp[0, :n_comp]
+            image = np.zeros((len_image, len_image), float)
+            results['mog_add_psf/len_image={}/n_comp={}'.format(len_image, n_comp)] = \
+                time_kernel(lambda: [pmf.mog_add_psf(image, [dx, dy, 22], filt_zp, psf_c)
+                                     for dx, dy in offsets])
+
+
+def benchmark_psf_fit(results, psf_comp, oversamp=4):
+    # objective and model evaluation on the oversampled cut-outs of the fits, |x|, |y| <=
+    # max_pix_offset, of noisy renders of the fitted cores
+    np.random.seed(seed)
+    for max_pix_offset in [5, 9, 11]:
+        x = np.arange(-max_pix_offset * oversamp, max_pix_offset * oversamp + 1) / oversamp
+        for n_comp in [4, 8, psf_comp.shape[1] - 1]:
+            p = psf_comp[0, :n_comp].reshape(-1)
+            z = pmf.psf_fit_fun(p, x, x)
+            z += np.random.normal(0, 1e-4 * np.amax(z), size=z.shape)
+            key = 'max_pix_offset={}/n_comp={}'.format(max_pix_offset, n_comp)
+            results['psf_fit_fun/' + key] = time_kernel(lambda: pmf.psf_fit_fun(p, x, x))
+            results['psf_fit_min/' + key] = time_kernel(lambda: pmf.psf_fit_min(p, x, x, z))
+
+
+def benchmark_create_effective_psf(results, oversamp=4):
+    # webbpsf-sized oversampled PSFs, fov_pixels * oversamp on a side
+    np.random.seed(seed)
+    for fov_pixels in [31, 91, 181]:
+        psf = pyfits.HDUList([pyfits.PrimaryHDU(np.random.uniform(0, 1, size=(
+            fov_pixels * oversamp, fov_pixels * oversamp)))])
+        results['create_effective_psf/fov_pixels={}'.format(fov_pixels)] = time_kernel(
+            lambda: pmf.create_effective_psf(psf, oversamp))
+
+
+def run_benchmarks(results_filename):
+    psf_comp = np.load(psf_comp_filename)
+    hosts = fixed_host_params(10)
+    results = {}
+    benchmark_gaussian_2d(results, psf_comp)
+    benchmark_mog_galaxy(results, psf_comp, hosts)
+    benchmark_mog_add_psf(results, psf_comp)
+    benchmark_psf_fit(results, psf_comp)
+    benchmark_create_effective_psf(results)
+    for key in sorted(results):
+        print('{:50s} {:.3e} s'.format(key, results[key]['best']))
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.platform(),
+            'processor': platform.processor(), 'psf_comp': psf_comp_filename, 'seed': seed}
+    with open(results_filename, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1, sort_keys=True)
+
+
+def compare_benchmarks(results_filename, baseline_filename, tolerance=0.1):
+    # ratio of the best times of every benchmark in both files, flagging those more than
+    # tolerance slower or faster than the baseline; returns the number of slower benchmarks
+    with open(results_filename) as f:
+        results = json.load(f)['results']
+    with open(baseline_filename) as f:
+        baseline = json.load(f)['results']
+    n_slower = 0
+    for key in sorted(set(results) & set(baseline)):
+        ratio = results[key]['best'] / baseline[key]['best']
+        flag = 'slower' if ratio > 1 + tolerance else 'faster' if ratio < 1 - tolerance else ''
+        n_slower += flag == 'slower'
+        print('{:50s} {:.3e} s {:.3e} s {:6.2f}x {}'.format(key, baseline[key]['best'],
+                                                           results[key]['best'], ratio, flag))
+    for key in sorted(set(results) ^ set(baseline)):
+        print('{:50s} only in {}'.format(key, results_filename if key in results else
+                                         baseline_filename))
+    return n_slower
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'run':
+        run_benchmarks(sys.argv[2] if len(sys.argv) > 2 else 'benchmark_kernels.json')
+    elif sys.argv[1] == 'compare':
+        tolerance = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+        sys.exit(1 if compare_benchmarks(sys.argv[2], sys.argv[3], tolerance) > 0 else 0)
@@ -1,9 +1,7 @@
 import sys
-import os
 import math
 import galsim
 import galsim.wfirst as wfirst
-from webbpsf import wfirst as wfirst_wpsf
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from astropy.visualization import simple_norm
@@ -12,6 +10,7 @@ from scipy.special import gammaincinv
 import sncosmo
 import astropy.io.fits as pyfits
 import astropy.units as u
+import psf_mog_fitting as pmf
 
 np.set_printoptions(edgeitems=10, linewidth=500)
 
@@ -81,21 +80,14 @@ def main(argv):
     filters = np.array(['z087', 'y106', 'w149', 'j129', 'h158', 'f184'])  # 'r062'
     use_SCA = 7  # This could be any number from 1...18
     remake_psfs = False
-    for filter_ in filters:
-        if remake_psfs or not os.path.exists('../PSFs/{}.fits'.format(filter_)):
-            wfi = wfirst_wpsf.WFI()
-            wfi.filter = filter_
-            wfi.detector = 'SCA09'
-            # position can vary 4 - 4092, allowing for a 4 pixel gap
-            wfi.detector_position = (2048, 2048)
-            wfi.options['parity'] = 'odd'
-            wfi.options['output_mode'] = 'both'
-            psf_ = wfi.calc_psf(oversample=10)
-            psf_.writeto('../PSFs/{}.fits'.format(filter_), overwrite=True)
-            psf_ = psf_[0]
-        else:
-            psf_ = pyfits.open('../PSFs/{}.fits'.format(filter_))[0]
-        psfs.append(galsim.InterpolatedImage(galsim.Image(psf_.data),
+    # webbpsf PSFs are only computed if not already cached for this exact configuration
+    psf_hduls = pmf.cached_psf_images([(filter_, 'SCA09', (2048, 2048)) for filter_ in filters],
+                                      10, refresh=remake_psfs)
+    for psf_hdul in psf_hduls:
+        psf_ = psf_hdul[0]
+        # the cached PSFs are read into memory as the FITS files store them, big-endian, so copy
+        # into native floats
+        psfs.append(galsim.InterpolatedImage(galsim.Image(np.array(psf_.data, dtype=float)),
                     scale=psf_.header['PIXELSCL']))
 
     # We choose a particular (RA, dec) location on the sky for our observation.
@@ -1,15 +1,21 @@
-from scipy.optimize import basinhopping
+from scipy.optimize import basinhopping, least_squares, linear_sum_assignment, OptimizeResult
+from scipy.signal import fftconvolve
 import multiprocessing
-import itertools
+from multiprocessing import shared_memory
+import queue
+import hashlib
 import timeit
 import matplotlib.gridspec as gridspec
 import numpy as np
 import matplotlib.pyplot as plt
 import astropy.io.fits as pyfits
 from astropy.visualization import simple_norm
+import webbpsf
 from webbpsf import wfirst
+from webbpsf.utils import get_webbpsf_data_path
 import copy
 import sys
+import os
 
 
 def gridcreate(name, y, x, ratio, z, **kwargs):
@@ -32,7 +38,99 @@ def gaussian_2d(x, x_t, mu, mu_t, sigma):
     return gauss_pdf
 
 
-def mog_galaxy(pixel_scale, filt_zp, psf_c, gal_params):
+def psf_comp_to_mog(psf_c):
+    # converts the (N, 6) mux, muy, sx, sy, rho, c array of PSF components into means (N, 2),
+    # covariance matrices (N, 2, 2) and weights (N,)
+    mks = psf_c[:, [0, 1]]
+    pks = psf_c[:, 5]  # what is referred to as 'c' in psf_mog_fitting is p_k in H&L13
+    sx, sy, r = psf_c[:, 2], psf_c[:, 3], psf_c[:, 4]
+    Vks = np.empty((len(psf_c), 2, 2), float)
+    Vks[:, 0, 0] = sx**2
+    Vks[:, 0, 1] = Vks[:, 1, 0] = r * sx * sy
+    Vks[:, 1, 1] = sy**2
+    return mks, Vks, pks
+
+
+def mog_render(x, y, mus, Vs, cs):
+    # evaluates sum_k c_k N(r | mu_k, V_k) for all K components in one pass, returning an image of
+    # shape (len(x), len(y)) to match the (x, y) indexing of gaussian_2d. mus is (K, 2), Vs is
+    # (K, 2, 2) and cs is (K,); as all V are symmetric 2x2 matrices V = [[a, b], [b, d]] we can
+    # invert them in closed form as V^-1 = [[d, -b], [-b, a]] / (ad - b^2)
+    a, b, d = Vs[:, 0, 0].reshape(-1, 1, 1), Vs[:, 0, 1].reshape(-1, 1, 1), \
+        Vs[:, 1, 1].reshape(-1, 1, 1)
+    det_sig = a * d - b**2
+    dx = x.reshape(1, -1, 1) - mus[:, 0].reshape(-1, 1, 1)
+    dy = y.reshape(1, 1, -1) - mus[:, 1].reshape(-1, 1, 1)
+    mal_dist_sq = (d * dx**2 - 2 * b * dx * dy + a * dy**2) / det_sig
+    norms = cs / (2 * np.pi * np.sqrt(det_sig[:, 0, 0]))
+    # contract over the component axis, (K,) x (K, x, y) -> (x, y)
+    return np.tensordot(norms, np.exp(-0.5 * mal_dist_sq), axes=1)
+
+
+def mog_render_truncated(x, y, mus, Vs, cs, n_sigma):
+    # sparse accumulation version of mog_render, in which each component is only evaluated inside
+    # its own +-n_sigma (marginal) bounding box and added into the image; x and y must be evenly
+    # spaced and increasing. returns the image and the flux lost by truncating each gaussian
+    a, b, d = Vs[:, 0, 0], Vs[:, 0, 1], Vs[:, 1, 1]
+    det_sig = a * d - b**2
+    norms = cs / (2 * np.pi * np.sqrt(det_sig))
+    dx, dy = x[1] - x[0], y[1] - y[0]
+    sx, sy = np.sqrt(a), np.sqrt(d)
+    # pixel index range [i0, i1), [j0, j1) of each bounding box, clipped to the image
+    i0 = np.clip(np.ceil((mus[:, 0] - n_sigma * sx - x[0]) / dx).astype(int), 0, len(x))
+    i1 = np.clip(np.floor((mus[:, 0] + n_sigma * sx - x[0]) / dx).astype(int) + 1, 0, len(x))
+    j0 = np.clip(np.ceil((mus[:, 1] - n_sigma * sy - y[0]) / dy).astype(int), 0, len(y))
+    j1 = np.clip(np.floor((mus[:, 1] + n_sigma * sy - y[0]) / dy).astype(int) + 1, 0, len(y))
+    n_x, n_y = np.maximum(i1 - i0, 0), np.maximum(j1 - j0, 0)
+    image = np.zeros((len(x), len(y)), float)
+    box_flux = np.zeros(len(cs), float)
+    # the components are evaluated together on (component, x, y) cubes the size of the largest
+    # box, padded out and masked for the smaller boxes, and scattered into the image. boxes can
+    # differ in area by orders of magnitude, e.g. the sersic components of a galaxy, so
+    # components are grouped by box size to within a factor two on each side, rather than all
+    # padded to the largest box; those whose boxes cover the whole image, common on small
+    # stamps, are grouped together and added as by mog_render
+    live = (n_x > 0) & (n_y > 0)
+    whole = (n_x == len(x)) & (n_y == len(y))
+    groups = np.where(whole, -1, np.ceil(np.log2(np.maximum(n_x, 1))) * 64 +
+                      np.ceil(np.log2(np.maximum(n_y, 1))))
+    for group in np.unique(groups[live]):
+        k = np.where((groups == group) & live)[0]
+        ind_x = i0[k].reshape(-1, 1) + np.arange(0, np.amax(n_x[k])).reshape(1, -1)
+        ind_y = j0[k].reshape(-1, 1) + np.arange(0, np.amax(n_y[k])).reshape(1, -1)
+        in_x, in_y = ind_x < i1[k].reshape(-1, 1), ind_y < j1[k].reshape(-1, 1)
+        ind_x, ind_y = np.where(in_x, ind_x, 0), np.where(in_y, ind_y, 0)
+        dx_ = (x[ind_x] - mus[k, 0].reshape(-1, 1))[:, :, np.newaxis]
+        dy_ = (y[ind_y] - mus[k, 1].reshape(-1, 1))[:, np.newaxis, :]
+        a_, b_, d_, det_ = [q[k].reshape(-1, 1, 1) for q in [a, b, d, det_sig]]
+        mal_dist_sq = (d_ * dx_**2 - 2 * b_ * dx_ * dy_ + a_ * dy_**2) / det_
+        if group == -1:
+            exp_k = np.exp(-0.5 * mal_dist_sq)
+            image += np.tensordot(norms[k], exp_k, axes=1)
+            box_flux[k] = norms[k] * np.sum(exp_k, axis=(1, 2))
+        else:
+            image_k = norms[k].reshape(-1, 1, 1) * np.exp(-0.5 * mal_dist_sq) * \
+                (in_x[:, :, np.newaxis] & in_y[:, np.newaxis, :])
+            ind = ind_x[:, :, np.newaxis] * len(y) + ind_y[:, np.newaxis, :]
+            image += np.bincount(ind.reshape(-1), weights=image_k.reshape(-1),
+                                 minlength=image.size).reshape(image.shape)
+            box_flux[k] = np.sum(image_k, axis=(1, 2))
+    # the dropped flux is the flux of each component, cs, less that rendered in its box -- as a
+    # flux, rather than per pixel, such that the image summed over pixel areas plus the dropped
+    # flux is sum(cs), whether the rest was cut by the box, fell off the image, or was lost to
+    # sampling a gaussian narrower than a pixel
+    return image, np.sum(cs) - np.sum(box_flux) * dx * dy
+
+
+def galaxy_image_shape(offset_r, pixel_scale):
+    # odd-sided stamp covering 2.2 times the offset radius of the galaxy, with a minimum size
+    len_image = np.ceil(2.2*offset_r / pixel_scale).astype(int)
+    len_image = len_image + 1 if len_image % 2 == 0 else len_image
+    len_image = max(25, len_image)
+    return len_image, len_image+2
+
+
+def mog_galaxy(pixel_scale, filt_zp, psf_c, gal_params, n_sigma=None, image_shape=None):
     mu_0, n_type, e_disk, pa_disk, half_l_r, offset_r, Vgm_unit, mag, offset_ra_pix, \
         offset_dec_pix = gal_params
 
@@ -51,112 +149,271 @@ def mog_galaxy(pixel_scale, filt_zp, psf_c, gal_params):
     # Vm is always circular so this doesn't need to be a full matrix, but PSF m/V do need to
     vms = np.array(vm_dev_sqrt)**2 if n_type == 4 else np.array(vm_exp_sqrt)**2
 
-    mks = psf_c[:, [0, 1]].reshape(-1, 2, 1)
-    pks = psf_c[:, 5]  # what is referred to as 'c' in psf_mog_fitting is p_k in H&L13
-    sx, sy, r = psf_c[:, 2], psf_c[:, 3], psf_c[:, 4]
-    Vks = np.array([[[sx[q]**2, r[q]*sx[q]*sy[q]], [r[q]*sx[q]*sy[q], sy[q]**2]] for
-                    q in range(0, len(sx))])
+    mks, Vks, pks = psf_comp_to_mog(psf_c)
     # covariance matrix and mean positions given in pixels, but need converting to half-light
     mks *= (pixel_scale / half_l_r)
     Vks *= (pixel_scale / half_l_r)**2
 
-    len_image = np.ceil(2.2*offset_r / pixel_scale).astype(int)
-    len_image = len_image + 1 if len_image % 2 == 0 else len_image
-    len_image = max(25, len_image)
-    image = np.zeros((len_image, len_image+2), float)
+    # the stamp is sized to the galaxy unless a shape is given
+    image = np.zeros(galaxy_image_shape(offset_r, pixel_scale) if image_shape is None else
+                     image_shape, float)
     x_cent, y_cent = (image.shape[0]-1)/2, (image.shape[1]-1)/2
 
     # positons should be in dimensionless but physical coordinates in terms of Re; first the
     # Xg vector needs converting from its given (ra, dec) to pixel coordiantes, to be placed
     # in the xy grid correctly (currently this just defaults to the central pixel, but it may
     # not in the future)
-    xg = np.array([[(offset_ra_pix + x_cent) * pixel_scale / half_l_r],
-                   [(offset_dec_pix + y_cent) * pixel_scale / half_l_r]])
+    xg = np.array([(offset_ra_pix + x_cent) * pixel_scale / half_l_r,
+                   (offset_dec_pix + y_cent) * pixel_scale / half_l_r])
     x_pos = (np.arange(0, image.shape[0])) * pixel_scale / half_l_r
     y_pos = (np.arange(0, image.shape[1])) * pixel_scale / half_l_r
-    x, y = np.meshgrid(x_pos, y_pos, indexing='xy')
-    # n-D gaussians have mahalnobis distance (x - mu)^T Sigma^-1 (x - mu) so coords_t and m_t
-    # should be *row* vectors, and thus be shape (1, x) while coords and m should be column
-    # vectors and shape (x, 1). starting with coords, we need to add the grid of data, so if
-    # this array has shape (1, 2, y, x), and if we transpose it it'll have shape (x, y, 2, 1)
-    coords = np.transpose(np.array([[x, y]]))
-    # the "transpose" of the vector x turns from being a column vector (shape = (2, 1)) to a
-    # row vector (shape = (1, 2)), but should still have external shape (x, y), so we start
-    # with vector of (2, 1, y, x) and transpose again
-    coords_t = np.transpose(np.array([[x], [y]]))
     # total flux in galaxy -- ensure that all units end up in flux as counts/s accordingly
     Sg = 10**(-1/2.5 * (mag - filt_zp))
-    for k in range(0, len(mks)):
-        pk = pks[k]
-        Vk = Vks[k]
-        mk = mks[k]
-        for m_ in range(0, len(vms)):
-            cm = cms[m_]
-            vm = vms[m_]
-            # Vgm = RVR^T = vm RR^T given that V = vmI
-            Vgm = vm * Vgm_unit
-            # reshape m and m_t to force propagation of arrays, remembering row vectors are
-            # (1, x) and column vectors are (x, 1) in shape
-            m = (mk + xg).reshape(1, 1, 2, 1)
-            m_t = m.reshape(1, 1, 1, 2)
-            V = Vgm + Vk
-            g_2d = gaussian_2d(coords, coords_t, m, m_t, V)
-            # having converted the covariance matrix to half-light radii, we need to account for a
-            # corresponding reverse correction so that the PSF dimensions are correct, which are
-            # defined in pure pixel scale
-            image += Sg * cm * pk * g_2d / (half_l_r / pixel_scale)**2
+    # every PSF component k is convolved with every sersic component m, giving a K*M mixture
+    # with V = Vk + Vgm, where Vgm = RVR^T = vm RR^T given that V = vmI, and mean mk + xg
+    Vgms = vms.reshape(-1, 1, 1) * Vgm_unit
+    Vs = (Vks.reshape(-1, 1, 2, 2) + Vgms.reshape(1, -1, 2, 2)).reshape(-1, 2, 2)
+    ms = np.repeat(mks + xg, len(vms), axis=0)
+    # having converted the covariance matrix to half-light radii, we need to account for a
+    # corresponding reverse correction so that the PSF dimensions are correct, which are
+    # defined in pure pixel scale
+    cs = (Sg * np.outer(pks, cms) / (half_l_r / pixel_scale)**2).reshape(-1)
+    # if a truncation threshold is given, only render each gaussian inside its n_sigma box, also
+    # returning the flux (in counts/s, undoing the half-light radius scaling) lost by doing so
+    if n_sigma is not None:
+        image_, dropped_flux = mog_render_truncated(x_pos, y_pos, ms, Vs, cs, n_sigma)
+        image += image_
+        return image, dropped_flux * (half_l_r / pixel_scale)**2
+    image += mog_render(x_pos, y_pos, ms, Vs, cs)
 
     return image
 
 
-def mog_add_psf(image, psf_params, filt_zp, psf_c):
+def mog_add_psf(image, psf_params, filt_zp, psf_c, n_sigma=None):
     offset_ra_pix, offset_dec_pix, mag = psf_params
     x_cent, y_cent = (image.shape[0]-1)/2, (image.shape[1]-1)/2
     # unlike the MoG for the galaxy profile, the PSF can be fit entirely in pure pixel coordinates,
     # with all parameters defined in this coordinate system
-    xg = np.array([[offset_ra_pix + x_cent], [offset_dec_pix + y_cent]])
+    xg = np.array([offset_ra_pix + x_cent, offset_dec_pix + y_cent])
     x_pos, y_pos = np.arange(0, image.shape[0]), np.arange(0, image.shape[1])
-    x, y = np.meshgrid(x_pos, y_pos, indexing='xy')
-    # n-D gaussians have mahalnobis distance (x - mu)^T Sigma^-1 (x - mu) so coords_t and m_t
-    # should be *row* vectors, and thus be shape (1, x) while coords and m should be column
-    # vectors and shape (x, 1). starting with coords, we need to add the grid of data, so if
-    # this array has shape (1, 2, y, x), and if we transpose it it'll have shape (x, y, 2, 1)
-    coords = np.transpose(np.array([[x, y]]))
-    # the "transpose" of the vector x turns from being a column vector (shape = (2, 1)) to a
-    # row vector (shape = (1, 2)), but should still have external shape (x, y), so we start
-    # with vector of (2, 1, y, x) and transpose again
-    coords_t = np.transpose(np.array([[x], [y]]))
-
-    mks = psf_c[:, [0, 1]].reshape(-1, 2, 1)
-    pks = psf_c[:, 5]  # what is referred to as 'c' in psf_mog_fitting is p_k in H&L13
-    sx, sy, r = psf_c[:, 2], psf_c[:, 3], psf_c[:, 4]
-    Vks = np.array([[[sx[q]**2, r[q]*sx[q]*sy[q]], [r[q]*sx[q]*sy[q], sy[q]**2]] for
-                    q in range(0, len(sx))])
+
+    mks, Vks, pks = psf_comp_to_mog(psf_c)
 
     # total flux in source -- ensure that all units end up in flux as counts/s accordingly
     Sg = 10**(-1/2.5 * (mag - filt_zp))
-    for k in range(0, len(mks)):
-        pk = pks[k]
-        V = Vks[k]
-        mk = mks[k]
-        # reshape m and m_t to force propagation of arrays, remembering row vectors are
-        # (1, x) and column vectors are (x, 1) in shape
-        m = (mk + xg).reshape(1, 1, 2, 1)
-        m_t = m.reshape(1, 1, 1, 2)
-        g_2d = gaussian_2d(coords, coords_t, m, m_t, V)
-        image += Sg * pk * g_2d
+    if n_sigma is not None:
+        image_, dropped_flux = mog_render_truncated(x_pos, y_pos, mks + xg, Vks, Sg * pks,
+                                                    n_sigma)
+        image += image_
+        return image, dropped_flux
+    image += mog_render(x_pos, y_pos, mks + xg, Vks, Sg * pks)
 
     return image
 
 
-def create_psf_image(filter_, oversamp):
+def make_psf_stamp_table(psf_comp, n_sub, half_width):
+    # pre-renders unit-flux PSF stamps of each filter, centred on the middle pixel of a
+    # (2 half_width + 1) square stamp but shifted by sub-pixel offsets (i/n_sub, j/n_sub),
+    # i, j = 0, 1, ..., n_sub, giving a (filter, i, j, x, y) table
+    len_stamp = 2 * half_width + 1
+    psf_table = np.zeros((len(psf_comp), n_sub + 1, n_sub + 1, len_stamp, len_stamp), float)
+    for k in range(0, len(psf_comp)):
+        for i in range(0, n_sub + 1):
+            for j in range(0, n_sub + 1):
+                # a source magnitude equal to the zero point gives unit flux
+                mog_add_psf(psf_table[k, i, j], [i / n_sub, j / n_sub, 0], 0, psf_comp[k])
+    return psf_table
+
+
+# tables derived from PSF component files already loaded by this process, keyed by
+# (psf_comp_filename, tag)
+psf_comp_tables = {}
+
+
+def load_psf_comp_table(psf_comp_filename, tag, make_fun, *args, source_filenames=()):
+    # tables derived from the PSF components, make_fun(psf_comp, *args), are created once per PSF
+    # component file and saved alongside it as {psf_comp_filename}_{tag}.npy, being remade if
+    # the components -- or any of source_filenames, other files the table is made from -- are
+    # newer than the saved table
+    key = (psf_comp_filename, tag)
+    if key not in psf_comp_tables:
+        table_filename = '{}_{}.npy'.format(os.path.splitext(psf_comp_filename)[0], tag)
+        if not os.path.isfile(table_filename) or os.path.getmtime(table_filename) < \
+                max(os.path.getmtime(q) for q in [psf_comp_filename] + list(source_filenames)):
+            # several processes may be making the table at once, so write to a unique file and
+            # then atomically move it into place, so no process can read a partial table
+            temp_filename = '{}.{}.npy'.format(os.path.splitext(table_filename)[0], os.getpid())
+            np.save(temp_filename, make_fun(np.load(psf_comp_filename), *args))
+            os.replace(temp_filename, table_filename)
+        psf_comp_tables[key] = np.load(table_filename, mmap_mode='r')
+    return psf_comp_tables[key]
+
+
+def load_psf_stamp_table(psf_comp_filename, n_sub=32, half_width=20):
+    return load_psf_comp_table(psf_comp_filename, 'stamps_{}_{}'.format(n_sub, half_width),
+                               make_psf_stamp_table, n_sub, half_width)
+
+
+def add_psf_from_table(image, psf_params, filt_zp, psf_table):
+    # table-lookup equivalent of mog_add_psf, with psf_table the (n_sub+1, n_sub+1, x, y) stamps of
+    # a single filter from make_psf_stamp_table, bilinearly interpolated to the fractional pixel
+    # position of the source, scaled to its flux and added to the image
+    offset_ra_pix, offset_dec_pix, mag = psf_params
+    n_sub, half_width = psf_table.shape[0] - 1, (psf_table.shape[2] - 1) // 2
+    x_cent, y_cent = (image.shape[0]-1)/2, (image.shape[1]-1)/2
+    x_s, y_s = offset_ra_pix + x_cent, offset_dec_pix + y_cent
+    x_ind, y_ind = int(np.floor(x_s)), int(np.floor(y_s))
+    # position within the sub-pixel grid, and the interpolation weights between grid points
+    t_x, t_y = (x_s - x_ind) * n_sub, (y_s - y_ind) * n_sub
+    i, j = min(int(t_x), n_sub - 1), min(int(t_y), n_sub - 1)
+    w_x, w_y = t_x - i, t_y - j
+    stamp = (1 - w_x) * (1 - w_y) * psf_table[i, j] + w_x * (1 - w_y) * psf_table[i+1, j] + \
+        (1 - w_x) * w_y * psf_table[i, j+1] + w_x * w_y * psf_table[i+1, j+1]
+
+    # total flux in source -- ensure that all units end up in flux as counts/s accordingly
+    Sg = 10**(-1/2.5 * (mag - filt_zp))
+    # the stamp is centred on pixel (x_ind, y_ind) of the image; only add the overlapping region
+    x0, x1 = max(0, x_ind - half_width), min(image.shape[0], x_ind + half_width + 1)
+    y0, y1 = max(0, y_ind - half_width), min(image.shape[1], y_ind + half_width + 1)
+    if x0 < x1 and y0 < y1:
+        image[x0:x1, y0:y1] += Sg * stamp[x0 - x_ind + half_width:x1 - x_ind + half_width,
+                                          y0 - y_ind + half_width:y1 - y_ind + half_width]
+
+    return image
+
+
+def make_psf_residual_table(psf_comp, psf_names, oversamp, half_width, threshold):
+    # the part of each filter's ePSF the core gaussians -- all but the wide component -- do not
+    # describe, e.g. the diffraction spikes and wings, tabulated on the oversampled grid of the
+    # ePSF out to |x|, |y| <= half_width pixels as a (filter, x, y) table. residuals below
+    # threshold times the ePSF peak are zeroed, leaving the table sparse; with the cores this
+    # reproduces the webbpsf ePSF within the table, in place of the wide component
+    len_table = 2 * half_width * oversamp + 1
+    residual_table = np.zeros((len(psf_comp), len_table, len_table), float)
+    for k in range(0, len(psf_comp)):
+        x, y, psf_image, _, _, _, _, _, _ = psf_cutout(psf_names[k], oversamp, half_width, 0)
+        x_w = np.where(np.abs(x) <= half_width)[0]
+        y_w = np.where(np.abs(y) <= half_width)[0]
+        residual = psf_image[y_w[0]:y_w[-1]+1, x_w[0]:x_w[-1]+1] - \
+            psf_fit_fun(psf_comp[k, :-1].reshape(-1), x[x_w], y[y_w])
+        residual[np.abs(residual) < threshold * np.amax(psf_image)] = 0
+        # ePSFs smaller than the table leave its edges empty; the table is (x, y), as the images
+        i0, j0 = np.rint((x[x_w[0]] + half_width) * oversamp).astype(int), \
+            np.rint((y[y_w[0]] + half_width) * oversamp).astype(int)
+        residual_table[k, i0:i0+len(x_w), j0:j0+len(y_w)] = residual.T
+    return residual_table
+
+
+def load_psf_residual_table(psf_comp_filename, psf_names, oversamp, half_width=20,
+                            threshold=1e-6):
+    # the residuals are also remade if the ePSFs are, and are kept per threshold and set of ePSFs,
+    # the latter by a hash of their file names
+    names_hash = hashlib.sha1(repr(list(psf_names)).encode()).hexdigest()[:16]
+    return load_psf_comp_table(psf_comp_filename, 'residual_{}_{}_{:g}_{}'.format(
+        oversamp, half_width, threshold, names_hash), make_psf_residual_table, psf_names,
+        oversamp, half_width, threshold, source_filenames=psf_names)
+
+
+def add_psf_residual(image, psf_params, filt_zp, psf_residual, oversamp):
+    # adds a single filter's residual table, from make_psf_residual_table, for a point source to
+    # the image, as a stamp add: pixel centres fall on every oversamp-th point of the table, so
+    # the stamp for a source at any sub-pixel position is the bilinear interpolation of the
+    # four strided slices of the table surrounding it
+    offset_ra_pix, offset_dec_pix, mag = psf_params
+    half_width = (psf_residual.shape[0] - 1) // (2 * oversamp) - 1
+    x_cent, y_cent = (image.shape[0]-1)/2, (image.shape[1]-1)/2
+    x_s, y_s = offset_ra_pix + x_cent, offset_dec_pix + y_cent
+    x_ind, y_ind = int(np.floor(x_s)), int(np.floor(y_s))
+    # pixel x_ind + d is at d - (x_s - x_ind) from the source, table point (d + half_width + 1)
+    # oversamp - t_x, for t_x = (x_s - x_ind) oversamp; so interpolate between the points a_x
+    # and a_x + 1 below (d + half_width + 1) oversamp
+    t_x, t_y = (x_s - x_ind) * oversamp, (y_s - y_ind) * oversamp
+    a_x, a_y = int(t_x), int(t_y)
+    w_x, w_y = t_x - a_x, t_y - a_y
+    len_stamp = 2 * half_width + 1
+    s_x = slice(oversamp - a_x, oversamp - a_x + len_stamp * oversamp, oversamp)
+    s_y = slice(oversamp - a_y, oversamp - a_y + len_stamp * oversamp, oversamp)
+    s_x1 = slice(s_x.start - 1, s_x.stop - 1, oversamp)
+    s_y1 = slice(s_y.start - 1, s_y.stop - 1, oversamp)
+    stamp = (1 - w_x) * (1 - w_y) * psf_residual[s_x, s_y] + \
+        w_x * (1 - w_y) * psf_residual[s_x1, s_y] + (1 - w_x) * w_y * psf_residual[s_x, s_y1] + \
+        w_x * w_y * psf_residual[s_x1, s_y1]
+
+    Sg = 10**(-1/2.5 * (mag - filt_zp))
+    x0, x1 = max(0, x_ind - half_width), min(image.shape[0], x_ind + half_width + 1)
+    y0, y1 = max(0, y_ind - half_width), min(image.shape[1], y_ind + half_width + 1)
+    if x0 < x1 and y0 < y1:
+        image[x0:x1, y0:y1] += Sg * stamp[x0 - x_ind + half_width:x1 - x_ind + half_width,
+                                          y0 - y_ind + half_width:y1 - y_ind + half_width]
+    return image
+
+
+def add_galaxy_psf_residual(image, pixel_scale, filt_zp, gal_params, psf_residual, oversamp):
+    # adds the convolution of a galaxy with a single filter's residual table to its image, as
+    # made by mog_galaxy with the PSF cores. the unconvolved galaxy is rendered on the oversampled
+    # grid of the table, each gaussian smoothed by the variance of an oversampled cell,
+    # 1/12 cell^2, to approximate its flux in each cell, and convolved with the table by FFT,
+    # keeping the points at the image's pixel centres. the oversampled grid spans the image
+    # exactly, so both truncate the galaxy at the same place
+    cell_c = np.array([[0, 0, np.sqrt(1/12), np.sqrt(1/12), 0, 1]])
+    offset_ra_pix, offset_dec_pix = gal_params[-2:]
+    galaxy = mog_galaxy(pixel_scale / oversamp, filt_zp, cell_c, list(gal_params[:-2]) +
+                        [offset_ra_pix * oversamp, offset_dec_pix * oversamp],
+                        image_shape=((image.shape[0] - 1) * oversamp + 1,
+                                     (image.shape[1] - 1) * oversamp + 1))
+    # pixel i of the image is galaxy point i oversamp, offset in the convolution by the
+    # half-width of the table
+    half_table = (psf_residual.shape[0] - 1) // 2
+    image += fftconvolve(galaxy, psf_residual)[half_table:-half_table:oversamp,
+                                               half_table:-half_table:oversamp]
+    return image
+
+
+def make_aperture_correction_table(psf_comp, n_sub, max_half_width):
+    # fraction of the PSF flux falling in a (2N + 1) pixel square box, N = 0, 1, ...,
+    # max_half_width, for sources at sub-pixel offsets (i/n_sub, j/n_sub), i, j = 0, ..., n_sub,
+    # giving a (filter, N, i, j) table
+    apcorr_table = np.empty((len(psf_comp), max_half_width + 1, n_sub + 1, n_sub + 1), float)
+    # every box is made up of points d + i/n_sub for integer |d| <= max_half_width, so evaluate
+    # the PSF once at all of these points, ordered [d, i], and then sum the relevant subsets
+    M = max_half_width
+    x = (np.arange(-M, M+1).reshape(-1, 1) + np.arange(0, n_sub + 1).reshape(1, -1) /
+         n_sub).reshape(-1)
+    for k in range(0, len(psf_comp)):
+        # psf_fit_fun returns (y, x) arrays, so this is [d_y, j, d_x, i]
+        psf_fit = psf_fit_fun(psf_comp[k].reshape(-1), x, x).reshape(2*M+1, n_sub+1, 2*M+1,
+                                                                     n_sub+1)
+        for N in range(0, max_half_width + 1):
+            apcorr_table[k, N] = np.sum(psf_fit[M-N:M+N+1, :, M-N:M+N+1, :], axis=(0, 2)).T
+    return apcorr_table
+
+
+def load_aperture_correction_table(psf_comp_filename, n_sub=32, max_half_width=10):
+    return load_psf_comp_table(psf_comp_filename, 'apcorr_{}_{}'.format(n_sub, max_half_width),
+                               make_aperture_correction_table, n_sub, max_half_width)
+
+
+def aperture_correction(apcorr_table, N, dx, dy):
+    # bilinear interpolation of a single filter's (N, n_sub+1, n_sub+1) aperture correction
+    # table to the sub-pixel offset (dx, dy), both in [0, 1]
+    n_sub = apcorr_table.shape[1] - 1
+    t_x, t_y = dx * n_sub, dy * n_sub
+    i, j = min(int(t_x), n_sub - 1), min(int(t_y), n_sub - 1)
+    w_x, w_y = t_x - i, t_y - j
+    return (1 - w_x) * (1 - w_y) * apcorr_table[N, i, j] + \
+        w_x * (1 - w_y) * apcorr_table[N, i+1, j] + (1 - w_x) * w_y * apcorr_table[N, i, j+1] + \
+        w_x * w_y * apcorr_table[N, i+1, j+1]
+
+
+def create_psf_image(filter_, oversamp, detector='SCA09', detector_position=(2048, 2048),
+                     parity='odd'):
     # see https://webbpsf.readthedocs.io/en/stable/wfirst.html for details of detector things
     wfi = wfirst.WFI()
     wfi.filter = filter_
-    wfi.detector = 'SCA09'
+    wfi.detector = detector
     # position can vary 4 - 4092, allowing for a 4 pixel gap
-    wfi.detector_position = (2048, 2048)
-    wfi.options['parity'] = 'odd'
+    wfi.detector_position = detector_position
+    wfi.options['parity'] = parity
     wfi.options['output_mode'] = 'both'
 
     psf = wfi.calc_psf(oversample=oversamp)
@@ -164,27 +421,105 @@ def create_psf_image(filter_, oversamp):
     return psf
 
 
-def create_effective_psf(psf_, oversamp):
-    # you lose oversamp/2 pixels at each edge, so overall lose oversamp pixels
+def webbpsf_data_version():
+    # both the webbpsf code and its separately installed data files set the PSFs it computes
+    data_version = 'unknown'
+    version_file = os.path.join(get_webbpsf_data_path(), 'version.txt')
+    if os.path.isfile(version_file):
+        with open(version_file) as f:
+            data_version = f.read().strip()
+    return '{}/{}'.format(webbpsf.__version__, data_version)
+
+
+def psf_cache_filename(cache_dir, filter_, oversamp, detector, detector_position, parity,
+                       data_version):
+    # content-addressed file name for a create_psf_image output, from a hash of every input which
+    # sets the PSF, such that a change to any of them can never pick up a stale file
+    key = repr((filter_, int(oversamp), detector, tuple(int(q) for q in detector_position),
+                parity, data_version))
+    return os.path.join(cache_dir, '{}_{}.fits'.format(
+        filter_, hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+
+def create_cached_psf_image(iterable):
+    # fills a single PSF cache miss, writing to a temporary file first so that a killed job
+    # never leaves a partial PSF in the cache
+    filename, filter_, oversamp, detector, detector_position, parity = iterable
+    psf = create_psf_image(filter_, oversamp, detector, detector_position, parity)
+    temp = '{}.{}.tmp'.format(filename, os.getpid())
+    psf.writeto(temp, overwrite=True)
+    os.replace(temp, filename)
+    return filename
+
+
+def cached_psf_filenames(psf_specs, oversamp, parity='odd', cache_dir='../PSFs/cache',
+                         N_pools=None, refresh=False):
+    # returns the cache files of the webbpsf PSFs, as from create_psf_image, for each of
+    # psf_specs, a list of (filter, detector, detector_position). PSFs are computed only if not
+    # already in cache_dir -- or for all with refresh -- in parallel across a process pool
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    data_version = webbpsf_data_version()
+    filenames = [psf_cache_filename(cache_dir, filter_, oversamp, detector, detector_position,
+                                    parity, data_version)
+                 for filter_, detector, detector_position in psf_specs]
+    misses = {}
+    for filename, (filter_, detector, detector_position) in zip(filenames, psf_specs):
+        if refresh or not os.path.isfile(filename):
+            misses[filename] = (filename, filter_, oversamp, detector, detector_position, parity)
+    if len(misses) > 0:
+        N_pools = min(len(misses), multiprocessing.cpu_count() if N_pools is None else N_pools)
+        pool = multiprocessing.Pool(N_pools)
+        for _ in pool.imap_unordered(create_cached_psf_image, misses.values()):
+            pass
+        pool.close()
+        pool.join()
+
+    return filenames
+
+
+def read_psf_image(filename):
+    # in-memory copy of a PSF HDUList, with the file closed again, so that holding many PSFs does
+    # not also hold their file handles
+    with pyfits.open(filename) as f:
+        return pyfits.HDUList([type(hdu)(data=hdu.data.copy(), header=hdu.header.copy())
+                               for hdu in f])
+
+
+def cached_psf_images(psf_specs, oversamp, **kwargs):
+    # the PSF HDULists themselves, see cached_psf_filenames, each read into memory
+    return [read_psf_image(filename) for filename in
+            cached_psf_filenames(psf_specs, oversamp, **kwargs)]
+
+
+def effective_psf(psf_data, oversamp):
+    # sums each 2N x 2N block of oversampled pixels, N = int(oversamp/2), giving the ePSF -- the
+    # flux a detector pixel centered on each oversampled pixel receives. because the "middle" of
+    # an NxN pixel grid is two lower but only one higher than the specific pixel (i.e., p0 p1 [p2
+    # is this pixel] p3), the block runs from N below to N - 1 above each pixel; otherwise we'd
+    # sum 2N+1 data points for each oversample, creating additional flux. you lose oversamp/2
+    # pixels at each edge, so overall lose oversamp pixels -- only have to remove the first
+    # (oversampled) pixel and the final oversampled (minus end of slice) pixels, as the "first"
+    # effective pixel will use the information from the sides. the box sum is separable, so it is
+    # done as strided window sums along each axis in turn, rather than through a summed-area
+    # table, whose differences of large cumulative sums would lose precision in the faint wings.
+    # any leading axes of psf_data, e.g. wavelengths or detector positions, are kept
     N = int(oversamp/2)
+    psf_data = np.asarray(psf_data, dtype=float)
+    ny, nx = psf_data.shape[-2:]
+    box = np.lib.stride_tricks.sliding_window_view(
+        psf_data[..., oversamp-N:ny-oversamp+N, :], 2*N, axis=-2).sum(axis=-1)
+    box = np.lib.stride_tricks.sliding_window_view(
+        box[..., oversamp-N:nx-oversamp+N], 2*N, axis=-1).sum(axis=-1)
+    return box
+
+
+def create_effective_psf(psf_, oversamp):
     psf = copy.deepcopy(psf_)
-    # only have to remove the first (oversampled) pixel and the final oversampled (minus end of
-    # slie) pixels, as the "first" effective pixel -- the sum over the NxN finer resolution
-    # pixels -- will use the information from the sides, but we can remove the information
-    # subsequently
-    reduced_psf = np.empty((psf[0].data.shape[0] - 2*oversamp+1,
-                            psf[0].data.shape[1] - 2*oversamp+1), float)
-
-    for i in range(oversamp, psf[0].data.shape[0]-oversamp+1):
-        for j in range(oversamp, psf[0].data.shape[1]-oversamp+1):
-            # because the "middle" of an NxN pixel grid is two lower but only one higher than the
-            # specific pixel (i.e., p0 p1 [p2 is this pixel] p3), we only go +-N with python's
-            # 'drop the last value' slicing; otherwise we'd sum 2N+1 data points for each
-            # oversample, creating additional flux
-            reduced_psf[i-oversamp, j-oversamp] = np.sum(psf[0].data[i-N:i+N, j-N:j+N])
+    reduced_psf = effective_psf(psf[0].data, oversamp)
     psf[0].data = reduced_psf
-    psf[0].header['NAXIS1'] = reduced_psf.shape[0]
-    psf[0].header['NAXIS2'] = reduced_psf.shape[1]
+    psf[0].header['NAXIS1'] = reduced_psf.shape[-1]
+    psf[0].header['NAXIS2'] = reduced_psf.shape[-2]
     psf[0].header['HISTORY'] = "Created oversampled ePSF response at original pixel resolution"
     return psf
 
@@ -212,65 +547,46 @@ def create_effective_psf(psf_, oversamp):
 
 
 def psf_fit_min(p, x, y, z):
-    mu_xs, mu_ys, s_xs, s_ys, rhos, cks = \
-        np.array([p[0+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[1+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[2+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[3+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[4+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[5+i*6] for i in range(0, int(len(p)/6))])
-
-    model_zs = np.empty((len(p) // 6, len(y), len(x)), float)
-    model_z = np.zeros((len(y), len(x)), float)
-    dfdcs = np.empty_like(model_zs)
-    As, Bs, Cs, Ds, x_s, y_s = [], [], [], [], [], []
-    for i, (mu_x, mu_y, sx, sy, rho, ck) in enumerate(zip(mu_xs, mu_ys, s_xs, s_ys, rhos, cks)):
-        omp2 = 1 - rho**2
-        x_ = (x - mu_x).reshape(1, -1)
-        y_ = (y - mu_y).reshape(-1, 1)
-        A = x_ * y_ / (sx * sy)
-        B = (x_/sx)**2 + (y_/sy)**2 - A * 2 * rho
-        C = x_ / sx - rho * y_ / sy
-        D = y_ / sy - rho * x_ / sx
-        As.append(A)
-        Bs.append(B)
-        Cs.append(C)
-        Ds.append(D)
-        x_s.append(x_)
-        y_s.append(y_)
-        # as dfdc = f / c this definition allows for the avoidance of divide-by-zero errors
-        dfdcs[i] = 1/(2 * np.pi * sx * sy * np.sqrt(omp2)) * np.exp(-0.5/omp2 * B)
-        model_zs[i] = ck * dfdcs[i]
-        model_z += model_zs[i]
-    dz = model_z - z
-
-    jac = np.empty(len(p), float)
+    # all N components are evaluated at once on a (component, y, x) cube
+    mu_xs, mu_ys, s_xs, s_ys, rhos, cks = np.asarray(p).reshape(-1, 6).T
+    omp2 = 1 - rhos**2
+    x_ = x.reshape(1, 1, -1) - mu_xs.reshape(-1, 1, 1)
+    y_ = y.reshape(1, -1, 1) - mu_ys.reshape(-1, 1, 1)
+    sx, sy, rho, o = s_xs.reshape(-1, 1, 1), s_ys.reshape(-1, 1, 1), rhos.reshape(-1, 1, 1), \
+        omp2.reshape(-1, 1, 1)
+    B = (x_/sx)**2 + (y_/sy)**2 - 2 * rho * x_ * y_ / (sx * sy)
+    # as dfdc = f / c this definition allows for the avoidance of divide-by-zero errors
+    dfdcs = 1/(2 * np.pi * sx * sy * np.sqrt(o)) * np.exp(-0.5/o * B)
     # model_z is sum_j f_ij above
-    for i in range(0, len(p)):
-        i_set = i // 6
-        i_in = i % 6
-        mu_x, mu_y, sx, sy, rho, ck = mu_xs[i_set], mu_ys[i_set], s_xs[i_set], s_ys[i_set], \
-            rhos[i_set], cks[i_set]
-        x_, y_, A, B, C, D = x_s[i_set], y_s[i_set], As[i_set], Bs[i_set], Cs[i_set], Ds[i_set]
-        f = model_zs[i_set]
-        omp2 = 1 - rho**2
-        # each of our six parameters in turn are mux, muy, sx, sy, rho and c.
-        if i_in == 0:
-            dfda = f / (sx * omp2) * C
-        elif i_in == 1:
-            dfda = f / (sy * omp2) * D
-        elif i_in == 2:
-            dfda = f * x_ / (sx**2 * omp2) * C - f / sx
-        elif i_in == 3:
-            dfda = f * y_ / (sy**2 * omp2) * D - f / sy
-        elif i_in == 4:
-            dfda = f * rho / omp2 * (1 - B/omp2 + A)
-        elif i_in == 5:
-            dfda = dfdcs[i_set]
-        # differential of sum_i (sum_j f_ij - z_i)**2 / o**2 is
-        # sum_i (2 * (sum_j f_ij - z_i) * dfda / o**2)
-        dFda = 2 * np.sum(dz * dfda)
-        jac[i] = dFda
+    dz = np.tensordot(cks, dfdcs, axes=1) - z
+
+    # differential of sum_i (sum_j f_ij - z_i)**2 / o**2 is
+    # sum_i (2 * (sum_j f_ij - z_i) * dfda / o**2). every dfda is f, or f/c, multiplied by a
+    # polynomial of at most second order in (x - mux) and (y - muy), so all six gradient blocks
+    # follow from the moments of dz * dfdc over the grid for each component
+    h = dfdcs * dz
+    x_, y_ = x_[:, 0, :], y_[:, :, 0]
+    h_x = np.sum(h, axis=1)  # sum over y, shape (N, x)
+    h_y = np.sum(h, axis=2)  # sum over x, shape (N, y)
+    h_xy = np.matmul(h, x_[:, :, np.newaxis])[:, :, 0]  # sum_x h (x - mux), shape (N, y)
+    s_0 = np.sum(h_x, axis=1)
+    s_x, s_xx = np.sum(h_x * x_, axis=1), np.sum(h_x * x_**2, axis=1)
+    s_y, s_yy = np.sum(h_y * y_, axis=1), np.sum(h_y * y_**2, axis=1)
+    s_xy = np.sum(h_xy * y_, axis=1)
+    # the sums over the grid of f C, f D, f (x - mux) C, f (y - muy) D, f A and f B, with
+    # A = (x - mux) (y - muy) / (sx sy) and B, C and D as above
+    f_C = cks * (s_x / s_xs - rhos * s_y / s_ys)
+    f_D = cks * (s_y / s_ys - rhos * s_x / s_xs)
+    f_xC = cks * (s_xx / s_xs - rhos * s_xy / s_ys)
+    f_yD = cks * (s_yy / s_ys - rhos * s_xy / s_xs)
+    f_A = cks * s_xy / (s_xs * s_ys)
+    f_B = cks * (s_xx / s_xs**2 + s_yy / s_ys**2) - 2 * rhos * f_A
+    f_ = cks * s_0
+    # each of our six parameters in turn are mux, muy, sx, sy, rho and c.
+    jac = 2 * np.stack([f_C / (s_xs * omp2), f_D / (s_ys * omp2),
+                        f_xC / (s_xs**2 * omp2) - f_ / s_xs, f_yD / (s_ys**2 * omp2) - f_ / s_ys,
+                        (rhos * (f_ - f_B / omp2) + f_A) / omp2, s_0],
+                       axis=1).reshape(-1)
     return np.sum(dz * dz), jac
 
 
@@ -292,30 +608,372 @@ class MyTakeStep(object):
         return x
 
 
+def random_psf_x0(N, x_cent, y_cent, s):
+    x0 = []
+    for _ in range(0, N):
+        x0 = x0 + [np.random.normal(x_cent, 3*s), np.random.normal(y_cent, 3*s),
+                   np.random.uniform(0.05, 0.3), np.random.uniform(0.05, 0.3),
+                   np.random.uniform(0, 0.3), np.random.random()]
+    return x0
+
+
+class StopAtObjective(object):
+    # basinhopping callback ending the chain once a minimum at or below f_stop has been found.
+    # the callback is passed each trial minimum, and only stops the chain from the first step on,
+    # so the best minimum so far is tracked here
+    def __init__(self, f_stop):
+        self.f_stop = f_stop
+        self.f_best = np.inf
+
+    def __call__(self, x, f, accept):
+        self.f_best = min(self.f_best, f)
+        return self.f_best <= self.f_stop
+
+
+class PsfChainCheckpoint(StopAtObjective):
+    # basinhopping callback which, as well as stopping at f_stop, saves the chain's best minimum,
+    # number of minima found, objective evaluations and random state to filename after every
+    # iteration, so that a killed chain can be continued from where it got to. key identifies the
+    # inputs to the chain, with checkpoints saved under any other key ignored and overwritten.
+    # evaluations are counted as the chain runs, by the objective from counted or by adding to
+    # nfev, so that the total over every run of the chain is kept
+    def __init__(self, filename, key, f_stop=None):
+        StopAtObjective.__init__(self, -np.inf if f_stop is None else f_stop)
+        self.filename, self.key = filename, key
+        self.x_best, self.nit, self.nfev, self.done, self.random_state = None, 0, 0, False, None
+        if os.path.isfile(filename):
+            with np.load(filename) as f:
+                if str(f['key']) == key:
+                    self.x_best, self.f_best = f['x'], float(f['fun'])
+                    self.nit, self.nfev, self.done = int(f['nit']), int(f['nfev']), bool(f['done'])
+                    self.random_state = ('MT19937', f['rng_keys'], int(f['rng_pos']),
+                                         int(f['rng_has_gauss']), float(f['rng_cached_gaussian']))
+
+    def save(self):
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        # write to a temporary file first, so a chain killed mid-write keeps its last checkpoint
+        temp = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(temp, 'wb') as f:
+            np.savez(f, key=self.key, x=self.x_best, fun=self.f_best, nit=self.nit, nfev=self.nfev,
+                     done=self.done, rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss,
+                     rng_cached_gaussian=cached_gaussian)
+        os.replace(temp, self.filename)
+
+    def resume(self, x0, niters):
+        # returns the start point and number of iterations left for the chain, restoring the
+        # random state used by MyTakeStep if it is continuing from a checkpoint
+        if self.x_best is None:
+            return x0, niters
+        np.random.set_state(self.random_state)
+        return self.x_best, max(niters - self.nit, 0)
+
+    def counted(self, fun):
+        def counted_fun(*args):
+            self.nfev += 1
+            return fun(*args)
+        return counted_fun
+
+    def __call__(self, x, f, accept):
+        self.nit += 1
+        if f < self.f_best:
+            self.x_best = np.copy(x)
+        stop = StopAtObjective.__call__(self, x, f, accept)
+        self.save()
+        return stop
+
+    def finish(self, res):
+        # keeps the better of res and any minimum found before the chain was resumed, and marks
+        # the chain as done, such that it is not run again
+        if self.x_best is not None and self.f_best < res.fun:
+            res.x, res.fun = self.x_best, self.f_best
+        self.x_best, self.f_best = res.x, res.fun
+        self.done = True
+        self.save()
+        res.nfev, res.nit = self.nfev, self.nit
+        return res
+
+    def result(self):
+        return OptimizeResult(x=self.x_best, fun=self.f_best, nfev=self.nfev, nit=self.nit)
+
+
 def psf_fitting_wrapper(iterable):
     np.random.seed(seed=None)
-    i, (x, y, psf_image, x_cent, y_cent, N, min_kwarg, niters, x0, s, t) = iterable
+    i, (x, y, psf_image, x_cent, y_cent, N, min_kwarg, niters, x0, s, t, f_stop,
+        checkpoint) = iterable
     if x0 is None:
-        x0 = []
-        for _ in range(0, N):
-            x0 = x0 + [np.random.normal(x_cent, 3*s), np.random.normal(y_cent, 3*s),
-                       np.random.uniform(0.05, 0.3), np.random.uniform(0.05, 0.3),
-                       np.random.uniform(0, 0.3), np.random.random()]
+        x0 = random_psf_x0(N, x_cent, y_cent, s)
     take_step = MyTakeStep(stepsize=s)
-    res = basinhopping(psf_fit_min, x0, minimizer_kwargs=min_kwarg, niter=niters, T=t,
-                       stepsize=s, take_step=take_step)
+    fun = psf_fit_min
+    if checkpoint is not None:
+        x0, niters = checkpoint.resume(x0, niters)
+        # basinhopping also passes the callback the minimum from x0, found before its first step,
+        # which is not one of the chain's iterations
+        checkpoint.nit -= 1
+        callback = checkpoint
+        fun = checkpoint.counted(psf_fit_min)
+    else:
+        callback = None if f_stop is None else StopAtObjective(f_stop)
+    res = basinhopping(fun, x0, minimizer_kwargs=min_kwarg, niter=niters, T=t,
+                       stepsize=s, take_step=take_step, callback=callback)
+    if checkpoint is not None:
+        res = checkpoint.finish(res)
 
     return res
 
 
+def psf_em_fit(x, y, z, N, g, n_iter=500, tol=1e-9, s_min=0.1, rho_max=0.9, p0=None):
+    # expectation-maximisation fit of an N component gaussian mixture to the PSF image, treating
+    # each pixel value z_ij as the weight of a sample at (x_i, y_j). every iteration assigns each
+    # pixel's weight to the components by responsibility, r_kij = p_k N_k(x_i, y_j) /
+    # sum_k p_k N_k(x_i, y_j), then updates p_k, mu_k and V_k as the responsibility-weighted
+    # moments, all in closed form. as sum_k p_k = 1, c_k = g p_k keeps sum_k c_k = g, and sigmas
+    # and correlations are clipped to s_min and rho_max to keep inside the psf_fit_min bounds.
+    # components narrower than half the sample spacing can collapse onto single samples, so the
+    # sigma floor is raised to that for coarser grids.
+    # p0, in the same form as the output, warm-starts the fit from a previous solution.
+    # returns the parameters in the [mux, muy, sx, sy, rho, c]*N form, and the iteration count
+    s_min = max(s_min, 0.5 * np.mean(np.diff(x)), 0.5 * np.mean(np.diff(y)))
+    w = np.clip(z, 0, None)
+    w = w / np.sum(w)
+    x_, y_ = x.reshape(1, 1, -1), y.reshape(1, -1, 1)
+    if p0 is not None:
+        mu_xs, mu_ys, s_xs, s_ys, rhos, cks = [q.reshape(-1, 1, 1) for q in
+                                               np.asarray(p0).reshape(-1, 6).T]
+        v_xx, v_yy, v_xy = s_xs**2, s_ys**2, rhos * s_xs * s_ys
+        # gradient-based solutions may contain negative weights, which EM cannot represent
+        pks = np.maximum(cks, 1e-6 * np.amax(np.abs(cks)))
+        pks = pks / np.sum(pks)
+    else:
+        # start from pixel positions drawn by weight, with widths set by the image moments
+        ind = np.random.choice(w.size, size=N, p=w.reshape(-1))
+        mu_xs, mu_ys = x[ind % len(x)].reshape(-1, 1, 1), y[ind // len(x)].reshape(-1, 1, 1)
+        mx, my = np.sum(w * x.reshape(1, -1)), np.sum(w * y.reshape(-1, 1))
+        s2 = max(0.5 * np.sum(w * ((x.reshape(1, -1) - mx)**2 +
+                                   (y.reshape(-1, 1) - my)**2)) / N, s_min**2)
+        v_xx, v_yy, v_xy = np.full((N, 1, 1), s2), np.full((N, 1, 1), s2), np.zeros((N, 1, 1))
+        pks = np.full((N, 1, 1), 1 / N)
+    logl = None
+    for i in range(0, n_iter):
+        # E step: responsibilities, from the normalised gaussians via the closed-form 2x2 inverse
+        det = v_xx * v_yy - v_xy**2
+        dx, dy = x_ - mu_xs, y_ - mu_ys
+        q = (v_yy * dx**2 - 2 * v_xy * dx * dy + v_xx * dy**2) / det
+        pdf = pks / (2 * np.pi * np.sqrt(det)) * np.exp(-0.5 * q)
+        tot = np.sum(pdf, axis=0)
+        tot[tot == 0] = np.finfo(float).tiny
+        new_logl = np.sum(w * np.log(tot))
+        r = w * pdf / tot
+        # M step: weighted zeroth, first and second moments of each component
+        pks = np.sum(r, axis=(1, 2), keepdims=True)
+        pks_ = np.maximum(pks, np.finfo(float).tiny)
+        mu_xs = np.sum(r * x_, axis=(1, 2), keepdims=True) / pks_
+        mu_ys = np.sum(r * y_, axis=(1, 2), keepdims=True) / pks_
+        dx, dy = x_ - mu_xs, y_ - mu_ys
+        v_xx = np.maximum(np.sum(r * dx**2, axis=(1, 2), keepdims=True) / pks_, s_min**2)
+        v_yy = np.maximum(np.sum(r * dy**2, axis=(1, 2), keepdims=True) / pks_, s_min**2)
+        v_xy = np.clip(np.sum(r * dx * dy, axis=(1, 2), keepdims=True) / pks_,
+                       -rho_max * np.sqrt(v_xx * v_yy), rho_max * np.sqrt(v_xx * v_yy))
+        if logl is not None and np.abs(new_logl - logl) < tol * np.abs(logl):
+            break
+        logl = new_logl
+    s_xs, s_ys = np.sqrt(v_xx), np.sqrt(v_yy)
+    p = np.stack([mu_xs, mu_ys, s_xs, s_ys, v_xy / (s_xs * s_ys), g * pks], axis=1)
+    return p.reshape(-1), i + 1
+
+
+def clip_to_bounds(p, bounds):
+    lower = np.array([-np.inf if b[0] is None else b[0] for b in bounds])
+    upper = np.array([np.inf if b[1] is None else b[1] for b in bounds])
+    return np.clip(p, lower, upper)
+
+
+def em_psf_x0(x, y, z, N, g, bounds, p0=None):
+    # EM starting point for the gradient-based fits, clipped to lie within their bounds
+    p, _ = psf_em_fit(x, y, z, N, g, p0=p0)
+    return clip_to_bounds(p, bounds)
+
+
+# filters, in order, of PSF component files written before their _fit.npz record was kept
+legacy_psf_comp_filters = ['z087', 'y106', 'w149', 'j129', 'h158', 'f184']
+
+
+def psf_comp_fit_filename(psf_comp_filename):
+    return '{}_fit.npz'.format(os.path.splitext(psf_comp_filename)[0])
+
+
+def filter_wavelength(filter_):
+    # WFIRST filter names encode their central wavelength, e.g. z087 is centered on 0.87 microns
+    return int(filter_[1:4]) / 100
+
+
+def load_psf_comp_seeds(psf_comp_filename, filters):
+    # for each filter returns the parameters of an existing fit to seed an incremental refit with,
+    # without the fixed wide component, and whether they are that filter's own fit or are taken
+    # from the filter nearest in wavelength -- with positions and widths scaled by the ratio of
+    # wavelengths, the PSF core scaling roughly as lambda/D. None without an existing fit.
+    # filters may also be field PSF grid nodes, e.g. z087_SCA01_4_4, seeded from the fit to
+    # their filter, z087, if there is no fit to the node itself
+    if not os.path.isfile(psf_comp_filename):
+        return [None] * len(filters)
+    psf_comp = np.load(psf_comp_filename)
+    fit_filename = psf_comp_fit_filename(psf_comp_filename)
+    if os.path.isfile(fit_filename):
+        stored_filters = list(np.load(fit_filename)['filters'])
+    else:
+        stored_filters = legacy_psf_comp_filters
+    waves = np.array([filter_wavelength(f) for f in stored_filters])
+    seeds = []
+    for filter_ in filters:
+        if filter_ in stored_filters:
+            seeds.append((psf_comp[stored_filters.index(filter_), :-1].reshape(-1), True))
+        elif filter_[:4] in stored_filters:
+            seeds.append((psf_comp[stored_filters.index(filter_[:4]), :-1].reshape(-1), False))
+        else:
+            i = np.argmin(np.abs(waves - filter_wavelength(filter_)))
+            p = np.copy(psf_comp[i, :-1])
+            p[:, :4] *= filter_wavelength(filter_) / waves[i]
+            seeds.append((p.reshape(-1), False))
+    return seeds
+
+
+def resize_psf_x0(p, N, g):
+    # matches a seed's number of components to N, dropping the lowest weight components or
+    # splitting the highest weight component in two along x, and rescales the weights to sum to g
+    p = np.asarray(p, dtype=float).reshape(-1, 6)
+    p = p[np.argsort(-np.abs(p[:, 5]))][:N]
+    while len(p) < N:
+        a, b = np.copy(p[0]), np.copy(p[0])
+        a[0], b[0] = p[0, 0] - 0.5 * p[0, 2], p[0, 0] + 0.5 * p[0, 2]
+        a[5], b[5] = p[0, 5] / 2, p[0, 5] / 2
+        p = np.vstack([p[1:], a, b])
+        p = p[np.argsort(-np.abs(p[:, 5]))]
+    p[:, 5] *= g / np.sum(p[:, 5])
+    return p.reshape(-1)
+
+
+def block_mean_psf(x, y, z, factor):
+    # downsamples the PSF image by averaging factor x factor blocks of samples, placed at the mean
+    # of the block's coordinates. as z samples the PSF response, rather than integrating it over
+    # each sample's area, the block mean conserves flux: sum z dx dy is unchanged. any remainder
+    # rows and columns are split evenly between the two edges, where the cut PSF is zero anyway
+    if factor == 1:
+        return x, y, z
+    nx, ny = len(x) // factor, len(y) // factor
+    x0, y0 = (len(x) - nx * factor) // 2, (len(y) - ny * factor) // 2
+    x_ = np.mean(x[x0:x0 + nx * factor].reshape(nx, factor), axis=1)
+    y_ = np.mean(y[y0:y0 + ny * factor].reshape(ny, factor), axis=1)
+    z_ = np.mean(z[y0:y0 + ny * factor, x0:x0 + nx * factor].reshape(ny, factor, nx, factor),
+                 axis=(1, 3))
+    return x_, y_, z_
+
+
+def psf_fit_derivs(p, x, y):
+    # evaluates every gaussian component, and its derivatives with respect to its own six
+    # parameters, on a (component, y, x) cube; returns f, shape (N, y, x), and dfda, shape
+    # (N, 6, y, x), with the six parameters in turn being mux, muy, sx, sy, rho and c
+    mu_xs, mu_ys, s_xs, s_ys, rhos, cks = [q.reshape(-1, 1, 1) for q in
+                                           np.asarray(p).reshape(-1, 6).T]
+    omp2 = 1 - rhos**2
+    x_ = x.reshape(1, 1, -1) - mu_xs
+    y_ = y.reshape(1, -1, 1) - mu_ys
+    A = x_ * y_ / (s_xs * s_ys)
+    B = (x_/s_xs)**2 + (y_/s_ys)**2 - A * 2 * rhos
+    C = x_ / s_xs - rhos * y_ / s_ys
+    D = y_ / s_ys - rhos * x_ / s_xs
+    dfda = np.empty((len(mu_xs), 6, len(y), len(x)), float)
+    # as dfdc = f / c this definition allows for the avoidance of divide-by-zero errors
+    dfda[:, 5] = 1/(2 * np.pi * s_xs * s_ys * np.sqrt(omp2)) * np.exp(-0.5/omp2 * B)
+    f = cks * dfda[:, 5]
+    dfda[:, 0] = f / (s_xs * omp2) * C
+    dfda[:, 1] = f / (s_ys * omp2) * D
+    dfda[:, 2] = f * x_ / (s_xs**2 * omp2) * C - f / s_xs
+    dfda[:, 3] = f * y_ / (s_ys**2 * omp2) * D - f / s_ys
+    dfda[:, 4] = f / omp2 * (rhos * (1 - B/omp2) + A)
+    return f, dfda
+
+
+class PsfResiduals(object):
+    # residual vector, r_i = sum_j f_ij - z_i, and its jacobian for the PSF MoG fit, for use with
+    # scipy.optimize.least_squares. flux conservation, sum_k c_k = g, is kept exactly by
+    # reparameterising c_N = g - sum_{k<N} c_k, so the fit is over the other 6N - 1 parameters
+    def __init__(self, x, y, z, g):
+        self.x, self.y, self.z, self.g = x, y, z, g
+        self.q, self.f, self.dfda = None, None, None
+
+    def full_params(self, q):
+        return np.append(q, self.g - np.sum(q[5::6]))
+
+    def evaluate(self, q):
+        # least_squares asks for the residuals and jacobian at the same point separately, so
+        # keep the most recent evaluation to avoid computing the model twice
+        if self.q is None or not np.array_equal(q, self.q):
+            self.q = np.copy(q)
+            self.f, self.dfda = psf_fit_derivs(self.full_params(q), self.x, self.y)
+
+    def residuals(self, q):
+        self.evaluate(q)
+        return (np.sum(self.f, axis=0) - self.z).reshape(-1)
+
+    def jacobian(self, q):
+        self.evaluate(q)
+        jac = self.dfda.reshape(self.dfda.shape[0] * 6, -1).T[:, :-1]
+        # as dc_N/dc_k = -1, every other c_k also picks up -dfdc_N
+        jac[:, 5::6] -= self.dfda[-1, 5].reshape(-1, 1)
+        return jac
+
+
+def psf_lsq_fitting_wrapper(iterable):
+    # least-squares alternative to psf_fitting_wrapper, taking the same inputs: each iteration
+    # perturbs the best solution so far with MyTakeStep and re-minimises with a bounded
+    # trust-region least-squares solver using the analytic residual jacobian, keeping the
+    # result if it improves on the best solution, stopping once it reaches f_stop
+    np.random.seed(seed=None)
+    i, (x, y, psf_image, x_cent, y_cent, N, min_kwarg, niters, x0, s, t, f_stop,
+        checkpoint) = iterable
+    if x0 is None:
+        x0 = random_psf_x0(N, x_cent, y_cent, s)
+    nit0 = 0
+    if checkpoint is not None:
+        x0, niters_left = checkpoint.resume(x0, niters)
+        nit0 = niters - niters_left
+        stop = checkpoint
+    else:
+        stop = None if f_stop is None else StopAtObjective(f_stop)
+    g = min_kwarg['constraints']['args'][0]
+    lower = np.array([-np.inf if b[0] is None else b[0] for b in min_kwarg['bounds']])[:-1]
+    upper = np.array([np.inf if b[1] is None else b[1] for b in min_kwarg['bounds']])[:-1]
+    resids = PsfResiduals(x, y, psf_image, g)
+    take_step = MyTakeStep(stepsize=s)
+    x_ = np.array(x0, dtype=float)
+    best, nfev, nit = None, 0, nit0
+    # niters minimisations in all, continuing from those run before the chain was resumed
+    for nit in range(nit0, niters):
+        res = least_squares(resids.residuals, np.clip(x_[:-1], lower, upper),
+                            jac=resids.jacobian, bounds=(lower, upper), method='trf',
+                            x_scale='jac')
+        nfev += res.nfev
+        if checkpoint is not None:
+            checkpoint.nfev += res.nfev
+        if best is None or res.cost < best.cost:
+            best = res
+        if stop is not None and stop(resids.full_params(best.x), 2 * best.cost, True):
+            break
+        x_ = take_step(resids.full_params(best.x))
+
+    if best is None:
+        # a resumed chain with no iterations left, whose best minimum is that checkpointed
+        return checkpoint.finish(OptimizeResult(x=x_, fun=np.inf, nfev=0, nit=nit0,
+                                                success=True, message=''))
+    # return in the same form as basinhopping, with fun the sum of squares of psf_fit_min
+    res = OptimizeResult(x=resids.full_params(best.x), fun=2 * best.cost, nfev=nfev, nit=nit + 1,
+                         success=best.success, message=best.message)
+    if checkpoint is not None:
+        res = checkpoint.finish(res)
+    return res
+
+
 def psf_fit_fun(p, x, y):
-    mu_xs, mu_ys, s_xs, s_ys, rhos, cks = \
-        np.array([p[0+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[1+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[2+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[3+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[4+i*6] for i in range(0, int(len(p)/6))]), \
-        np.array([p[5+i*6] for i in range(0, int(len(p)/6))])
+    mu_xs, mu_ys, s_xs, s_ys, rhos, cks = np.asarray(p).reshape(-1, 6).T
     psf_fit = np.zeros((len(y), len(x)), float)
     for i, (mu_x, mu_y, sx, sy, rho, ck) in enumerate(zip(mu_xs, mu_ys, s_xs, s_ys, rhos, cks)):
         omp2 = 1 - rho**2
@@ -329,7 +987,7 @@ def psf_fit_fun(p, x, y):
 
 def eq_con(x, g):
     # since sum_k c_k = g, the equality constrain is sum_k c_k - g
-    return np.sum([x[5+i*6] for i in range(0, int(len(x)/6))]) - g
+    return np.sum(np.asarray(x)[5::6]) - g
 
 
 def eq_con_jac(x, g):
@@ -349,91 +1007,240 @@ def background_mog_fit(p, x, y):
     return (f - 1)**2, np.array([2 * (f - 1) * dfdc])
 
 
-def psf_mog_fitting(psf_names, oversamp, psf_comp_filename, N_comp, type_, max_pix_offsets, cuts):
-    gs = gridcreate('adsq', 5, len(psf_names), 0.8, 5)
+def psf_cutout(psf_name, oversamp, max_pix_offset, cut):
+    # reads the oversampled PSF, centering its coordinates, and cuts out the central region of
+    # the PSF, |x|, |y| <= max_pix_offset, zeroing any pixel below cut, for the MoG fit. returns
+    # the coordinates and image of the full PSF and the cut-out, the total and cut-out fluxes --
+    # summed over the samples at pixel centers -- and the cut-out's indices in the full PSF
+    with pyfits.open(psf_name) as f:
+        # #### WFC3 ####
+        # as WFC3-2016-12 suggests that fortran reads these files (x, y, N) we most likely read
+        # them as (N, y, x) with the transposition from f- to c-order, thus the psf is (y, x)
+        # shape
+        # psf_image = f[0].data[4, :, :].copy()
+        # #### WFIRST ####
+        psf_image = f[0].data.copy()
+    x, y = np.arange(0, psf_image.shape[1])/oversamp, np.arange(0, psf_image.shape[0])/oversamp
+    x_cent, y_cent = (x[-1]+x[0])/2, (y[-1]+y[0])/2
+    over_index_middle = 1 / 2
+    cut_int = ((x.reshape(1, -1) % 1.0 == over_index_middle) &
+               (y.reshape(-1, 1) % 1.0 == over_index_middle))
+    total_flux = np.sum(psf_image[cut_int])
+    x -= x_cent
+    y -= y_cent
+
+    x_w = np.where((x >= -1 * max_pix_offset) & (x <= max_pix_offset))[0]
+    y_w = np.where((y >= -1 * max_pix_offset) & (y <= max_pix_offset))[0]
+    y_w0, y_w1, x_w0, x_w1 = np.amin(y_w), np.amax(y_w), np.amin(x_w), np.amax(x_w)
+    psf_image_c = np.copy(psf_image[y_w0:y_w1+1, x_w0:x_w1+1])
+    psf_image_c[psf_image_c < cut] = 0
+    x_c, y_c = x[x_w0:x_w1+1], y[y_w0:y_w1+1]
+    cut_int = ((x_c.reshape(1, -1) % 1.0 == over_index_middle) &
+               (y_c.reshape(-1, 1) % 1.0 == over_index_middle))
+    cut_flux = np.sum(psf_image_c[cut_int])
+    return x, y, psf_image, x_c, y_c, psf_image_c, total_flux, cut_flux, (y_w0, y_w1, x_w0, x_w1)
+
+
+def psf_fit_pool_init(shm_name, layout):
+    # attaches each worker of the fitting pool to the shared memory block holding the PSF
+    # cut-outs, so that tasks need only carry the (filter, level) index of their cut-out
+    global psf_fit_shm, psf_fit_images
+    psf_fit_shm = shared_memory.SharedMemory(name=shm_name)
+    psf_fit_images = shared_psf_images(psf_fit_shm.buf, layout)
+
+
+def shared_psf_images(buf, layout):
+    # layout maps each (filter, level) to the offset, in floats, and x and y lengths of its x, y
+    # and z = psf_image arrays, stored consecutively in buf
+    images = {}
+    for key, (offset, nx, ny) in layout.items():
+        a = np.ndarray(nx + ny + nx * ny, dtype=float, buffer=buf, offset=offset * 8)
+        images[key] = (a[:nx], a[nx:nx + ny], a[nx + ny:].reshape(ny, nx))
+    return images
+
+
+def psf_fit_task(task):
+    # runs a single chain for one filter at one resolution level, returning the filter and
+    # level indices with the result. x0 of None starts the chain from random_psf_x0, or an EM
+    # fit for init='em', otherwise it is the warm start for the chain. with a checkpoint, a
+    # (filename, key) pair, finished chains are loaded rather than rerun, and unfinished chains
+    # continue from their last saved state
+    j, k, i, engine, init, N, x0, niters, bounds, g, s, t, f_stop, checkpoint = task
+    x, y, z = psf_fit_images[(j, k)]
+    if checkpoint is not None:
+        checkpoint = PsfChainCheckpoint(checkpoint[0], checkpoint[1], f_stop)
+        if checkpoint.done:
+            return j, k, checkpoint.result()
+    if engine == 'em':
+        p = em_psf_x0(x, y, z, N, g, bounds, p0=x0)
+        res = OptimizeResult(x=p, fun=psf_fit_min(p, x, y, z)[0], nfev=1, nit=1)
+        if checkpoint is None:
+            return j, k, res
+        checkpoint.nfev += res.nfev
+        return j, k, checkpoint.finish(res)
+    if x0 is None and init == 'em':
+        x0 = em_psf_x0(x, y, z, N, g, bounds)
+    # we must constrain sum_k c_k = cut_flux, to ensure flux preservation in convolution
+    min_kwarg = {'method': 'SLSQP', 'args': (x, y, z), 'jac': True, 'bounds': bounds,
+                 'constraints': {'type': 'eq', 'fun': eq_con, 'jac': eq_con_jac, 'args': [g]}}
+    fitting_wrapper = psf_lsq_fitting_wrapper if engine == 'lsq' else psf_fitting_wrapper
+    res = fitting_wrapper((i, (x, y, z, 0, 0, N, min_kwarg, niters, x0, s, t, f_stop,
+                               checkpoint)))
+    return j, k, res
+
+
+def psf_mog_fitting(psf_names, oversamp, psf_comp_filename, N_comp, max_pix_offsets, cuts,
+                    engine='basinhopping', init='random', coarse_factors=(), incremental=False,
+                    refit_rtol=0.05, checkpoint_dir=None, seed_filename=None):
+    # engine is either 'basinhopping', SLSQP minimisation of the sum of squares within
+    # scipy.optimize.basinhopping, 'lsq', trust-region least-squares minimisation of the
+    # residuals in a similar basin-hopping loop, which needs far fewer iterations, or 'em', a
+    # standalone expectation-maximisation fit to the image. init sets the starting point of each
+    # basinhopping or lsq chain, either 'random' or 'em', an EM fit to the image, with a good
+    # start allowing for an order of magnitude fewer chains and iterations. coarse_factors, e.g.
+    # (4, 2), runs the global search on block-averaged downsamples of the cut-out first, each
+    # finer level -- ending on the native grid -- warm-started from the previous level's best fit.
+    # incremental seeds each filter from the existing fits in psf_comp_filename, see
+    # load_psf_comp_seeds -- or from those in seed_filename if given -- with fewer iterations;
+    # chains seeded from the filter's own fit stop early only once they improve on that fit's
+    # objective on the current cut-out by refit_rtol -- the seed itself is already within any
+    # looser stop, which would end every chain at its first step -- and otherwise search for
+    # their full, reduced, number of iterations. the fit is headless, writing only the
+    # components and the _fit.npz record; see psf_mog_diagnostics for plots. with checkpoint_dir
+    # set, each chain's progress is saved there, and a rerun with the same inputs after the job
+    # is killed skips the finished chains and continues the unfinished ones
     # assuming each gaussian component has mux, muy, sigx, sigy, rho, c, and that we fit for
     # N_comp Gaussians in the central region, and fit each diffration spike separately
     psf_comp = np.empty((len(psf_names), N_comp + 1, 6), float)
+    filters = [os.path.splitext(os.path.basename(q))[0] for q in psf_names]
+    if incremental:
+        seeds = load_psf_comp_seeds(psf_comp_filename if seed_filename is None else seed_filename,
+                                    filters)
+    else:
+        seeds = [None] * len(filters)
+    fit_fun, fit_nfev, fit_time = np.empty(len(filters)), np.zeros(len(filters), int), \
+        np.empty(len(filters))
+    cut_fluxes = np.empty(len(filters))
+    factors = list(coarse_factors) + [1]
+    cutouts, fit_images, fit_bounds, fit_x0, fit_f_stop = [], {}, [], [], []
 
     for j in range(0, len(psf_names)):
         print(j)
-        cut = cuts[j]
-        f = pyfits.open(psf_names[j])
-        # #### WFC3 ####
-        # as WFC3-2016-12 suggests that fortran reads these files (x, y, N) we most likely read
-        # them as (N, y, x) with the transposition from f- to c-order, thus the psf is (y, x) shape
-        # psf_image = f[0].data[4, :, :]
-        # #### WFIRST ####
-        psf_image = f[0].data
-        x, y = np.arange(0, psf_image.shape[1])/oversamp, np.arange(0, psf_image.shape[0])/oversamp
-        x_cent, y_cent = (x[-1]+x[0])/2, (y[-1]+y[0])/2
-        over_index_middle = 1 / 2
-        cut_int = ((x.reshape(1, -1) % 1.0 == over_index_middle) &
-                   (y.reshape(-1, 1) % 1.0 == over_index_middle))
-        total_flux = np.sum(psf_image[cut_int])
-        x -= x_cent
-        y -= y_cent
-        x_cent, y_cent = 0, 0
-
-        ax = plt.subplot(gs[0, j])
-        norm = simple_norm(psf_image, 'log', percent=100)
-        # with the psf being (y, x) we do not need to transpose it to correct for pcolormesh being
-        # flipped, but our x and y need additional tweaking, as these are pixel centers, but
-        # pcolormesh wants pixel edges. we thus subtract half a pixel off each value and add a
-        # final value to the end
-        dx, dy = np.mean(np.diff(x)), np.mean(np.diff(y))
-        x_pc, y_pc = np.append(x - dx/2, x[-1] + dx/2), np.append(y - dy/2, y[-1] + dy/2)
-        img = ax.pcolormesh(x_pc, y_pc, psf_image, cmap='viridis', norm=norm, edgecolors='face',
-                            shading='flat')
-        cb = plt.colorbar(img, ax=ax, use_gridspec=True)
-        cb.set_label('PSF Response')
-        ax.set_xlabel('x / pixel')
-        ax.set_ylabel('y / pixel')
-
-        x_w = np.where((x >= -1 * max_pix_offsets[j]) & (x <= max_pix_offsets[j]))[0]
-        y_w = np.where((y >= -1 * max_pix_offsets[j]) & (y <= max_pix_offsets[j]))[0]
-        y_w0, y_w1, x_w0, x_w1 = np.amin(y_w), np.amax(y_w), np.amin(x_w), np.amax(x_w)
-        psf_image_c = np.copy(psf_image[y_w0:y_w1+1, x_w0:x_w1+1])
-        psf_image_c[psf_image_c < cut] = 0
-        x_c, y_c = x[x_w0:x_w1+1], y[y_w0:y_w1+1]
-        cut_int = ((x_c.reshape(1, -1) % 1.0 == over_index_middle) &
-                   (y_c.reshape(-1, 1) % 1.0 == over_index_middle))
-        cut_flux = np.sum(psf_image_c[cut_int])
-        ax.set_title(r'Cut flux is {:.3f}\% of total flux'.format(cut_flux/total_flux*100))
-        ax.axvline(x_c[0], c='k', ls='-')
-        ax.axvline(x_c[-1], c='k', ls='-')
-        ax.axhline(y_c[0], c='k', ls='-')
-        ax.axhline(y_c[-1], c='k', ls='-')
-
-        temp = 0.01
-
-        start = timeit.default_timer()
-        N_pools = 10
-        N_overloop = 2
+        cutouts.append(psf_cutout(psf_names[j], oversamp, max_pix_offsets[j], cuts[j]))
+        _, _, _, x_c, y_c, psf_image_c, _, cut_flux, _ = cutouts[j]
+
+        for k, factor in enumerate(factors):
+            fit_images[(j, k)] = block_mean_psf(x_c, y_c, psf_image_c, factor)
+        bounds = [(x_c[0], x_c[-1]), (y_c[0], y_c[-1]), (1e-1, 3), (1e-1, 3), (-0.9, 0.9),
+                  (None, None)]*N_comp
+        seed, f_stop = None, None
+        if seeds[j] is not None:
+            seed = clip_to_bounds(resize_psf_x0(seeds[j][0], N_comp, cut_flux), bounds)
+            if seeds[j][1]:
+                f_stop = (1 - refit_rtol) * psf_fit_min(seed, x_c, y_c, psf_image_c)[0]
+        fit_bounds.append(bounds)
+        fit_x0.append(seed)
+        fit_f_stop.append(f_stop)
+
+    temp = 0.01
+
+    start = timeit.default_timer()
+    # every (filter, chain) task is run by one pool, shared across all filters, so that no
+    # worker waits on the slowest chain of a filter before the next filter starts
+    N_pools = 10
+    N_chains = 20
+    if engine == 'lsq':
+        niters = 20
+    else:
         niters = 350
-        pool = multiprocessing.Pool(N_pools)
-        counter = np.arange(0, N_pools*N_overloop)
-        xy_step = max_pix_offsets[j]/3
-        x0 = None
-        method = 'SLSQP'  # 'L-BFGS-B'
-        # we must constrain sum_k c_k = cut_flux, to ensure flux preservation in convolution
-        min_kwarg = {'method': method, 'args': (x_c, y_c, psf_image_c),
-                     'jac': True, 'bounds': [(x_c[0], x_c[-1]), (y_c[0], y_c[-1]),
-                                             (1e-1, 3), (1e-1, 3), (-0.9, 0.9),
-                                             (None, None)]*N_comp,
-                     'constraints': {'type': 'eq', 'fun': eq_con, 'jac': eq_con_jac,
-                                     'args': [cut_flux]}}
-        iter_rep = itertools.repeat([x_c, y_c, psf_image_c, x_cent, y_cent, N_comp, min_kwarg,
-                                     niters, x0, xy_step, temp])
-        iter_group = zip(counter, iter_rep)
-        res = None
-        min_val = None
-        for stuff in pool.imap_unordered(psf_fitting_wrapper, iter_group, chunksize=N_overloop):
-            if min_val is None or stuff.fun < min_val:
-                res = stuff
-                min_val = stuff.fun
+    if init == 'em':
+        N_chains, niters = 2, max(1, niters // 10)
+
+    # the cut-outs at each resolution level are placed in shared memory, read by the workers,
+    # rather than pickled into every task
+    layout, size = {}, 0
+    for key, (x_f, y_f, psf_image_f) in fit_images.items():
+        layout[key] = (size, len(x_f), len(y_f))
+        size += len(x_f) + len(y_f) + psf_image_f.size
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1) * 8)
+    checkpoints = []
+    if checkpoint_dir is not None and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    pool = None
+    try:
+        for key, (x_f, y_f, psf_image_f) in shared_psf_images(shm.buf, layout).items():
+            x_f[:], y_f[:], psf_image_f[:] = fit_images[key]
+
+        def level_tasks(j, k, warm_x0):
+            # finer levels, and refits, polish an existing fit, so need only a short search
+            niters_ = niters if warm_x0 is None else max(1, niters // 10)
+            # EM from a warm start is deterministic, so needs only the one chain
+            n = 1 if warm_x0 is not None and engine == 'em' else N_chains
+            # the stored objective is only comparable on the native grid
+            f_stop_ = fit_f_stop[j] if factors[k] == 1 else None
+            tasks = [[j, k, i, engine, init, N_comp, warm_x0, niters_, fit_bounds[j],
+                      cutouts[j][7], max_pix_offsets[j]/3, temp, f_stop_, None]
+                     for i in range(0, n)]
+            if checkpoint_dir is not None:
+                # checkpoints are only valid for chains run on the same inputs
+                key = hashlib.sha1(repr(tasks[0][3:6] + tasks[0][7:13]).encode())
+                for q in list(fit_images[(j, k)]) + ([] if warm_x0 is None else [warm_x0]):
+                    key.update(np.ascontiguousarray(q, dtype=float).tobytes())
+                for task in tasks:
+                    task[13] = ('{}/{}_{}_{}.npz'.format(checkpoint_dir, filters[j], k, task[2]),
+                                key.hexdigest())
+                    checkpoints.append(task[13][0])
+            return tasks
+
+        results = queue.Queue()
+        pool = multiprocessing.Pool(N_pools, initializer=psf_fit_pool_init,
+                                    initargs=(shm.name, layout))
+        best, n_left = {}, {}
+
+        def submit(j, k, warm_x0):
+            tasks = level_tasks(j, k, warm_x0)
+            n_left[(j, k)] = len(tasks)
+            for task in tasks:
+                pool.apply_async(psf_fit_task, (task,), callback=results.put,
+                                 error_callback=results.put)
+
+        for j in range(0, len(psf_names)):
+            submit(j, 0, fit_x0[j])
+        n_running = len(psf_names)
+        res = [None] * len(psf_names)
+        while n_running > 0:
+            stuff = results.get()
+            if isinstance(stuff, BaseException):
+                raise stuff
+            j, k, stuff = stuff
+            fit_nfev[j] += stuff.nfev
+            if (j, k) not in best or stuff.fun < best[(j, k)].fun:
+                best[(j, k)] = stuff
+            n_left[(j, k)] -= 1
+            if n_left[(j, k)] > 0:
+                continue
+            # total objective evaluations across all chains, to compare the cost of the engines
+            print(filters[j], engine, factors[k], fit_nfev[j], best[(j, k)].fun)
+            if k + 1 < len(factors):
+                submit(j, k + 1, best[(j, k)].x)
+            else:
+                res[j] = best[(j, k)]
+                fit_time[j] = timeit.default_timer()-start
+                n_running -= 1
         pool.close()
-        p = res.x
+        pool.join()
+    finally:
+        # if a chain raised, the other workers are still running, and attached to the shared
+        # memory, so must be stopped before it is released
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shm.close()
+        shm.unlink()
+
+    for j in range(0, len(psf_names)):
+        p = res[j].x
+        fit_fun[j], cut_fluxes[j] = res[j].fun, cutouts[j][7]
 
         # if we want the integral -- or sum -- over pixels r < 20 to be 1 - cut_flux then we need
         # to figure out what the sigma for that must be. the easiest way to try this is to just
@@ -447,91 +1254,365 @@ def psf_mog_fitting(psf_names, oversamp, psf_comp_filename, N_comp, type_, max_p
         p = np.append(p, new_g)
 
         psf_comp[j, :, :] = p.reshape(N_comp + 1, 6)
+        print(fit_time[j])
 
-        print(timeit.default_timer()-start)
-        print(psf_fit_min(p, x, y, psf_image)[0])
-        psf_fit = psf_fit_fun(p, x, y)
-        ax = plt.subplot(gs[1, j])
-        norm = simple_norm(psf_fit, 'log', percent=100)
-        img = ax.pcolormesh(x_pc, y_pc, psf_fit, cmap='viridis', norm=norm, edgecolors='face', shading='flat')
-        cb = plt.colorbar(img, ax=ax, use_gridspec=True)
-        cb.set_label('PSF Response')
-        ax.set_xlabel('x / pixel')
-        ax.set_ylabel('y / pixel')
-        ax.set_title('Model PSF sum: {:.5f}'.format(np.sum(psf_fit_fun(p, x_int, y_int))))
-        ax.axvline(x_c[0], c='k', ls='-')
-        ax.axvline(x_c[-1], c='k', ls='-')
-        ax.axhline(y_c[0], c='k', ls='-')
-        ax.axhline(y_c[-1], c='k', ls='-')
-
-        ax = plt.subplot(gs[2, j])
-        ratio = np.zeros_like(psf_fit)
-        ratio[psf_image != 0] = (psf_fit[psf_image != 0] - psf_image[psf_image != 0]) / \
-            psf_image[psf_image != 0]
-        ratio_ma = np.ma.array(ratio, mask=(psf_image == 0) & (psf_image > 1e-3))
-        norm = simple_norm(ratio[(ratio != 0) & (psf_image > 1e-3)], 'linear', percent=100)
-        cmap = plt.get_cmap('viridis')
-        cmap.set_bad('w', 0)
-        img = ax.pcolormesh(x_pc, y_pc, ratio_ma, cmap=cmap, norm=norm, edgecolors='face', shading='flat')
-        cb = plt.colorbar(img, ax=ax, use_gridspec=True)
-        cb.set_label('Relative Difference')
-        ax.set_xlabel('x / pixel')
-        ax.set_ylabel('y / pixel')
-        ax.axvline(x_c[0], c='k', ls='-')
-        ax.axvline(x_c[-1], c='k', ls='-')
-        ax.axhline(y_c[0], c='k', ls='-')
-        ax.axhline(y_c[-1], c='k', ls='-')
-
-        ax = plt.subplot(gs[3, j])
-        ratio = (psf_fit - psf_image)
-        ratio_ma = np.ma.array(ratio, mask=(psf_image == 0) & (psf_image > 1e-3))
-        norm = simple_norm(ratio[(ratio != 0) & (psf_image > 1e-3)], 'linear', percent=100)
-        cmap = plt.get_cmap('viridis')
-        cmap.set_bad('w', 0)
-        img = ax.pcolormesh(x_pc, y_pc, ratio_ma, cmap=cmap, norm=norm, edgecolors='face', shading='flat')
-        cb = plt.colorbar(img, ax=ax, use_gridspec=True)
-        cb.set_label('Absolute Difference')
-        ax.set_xlabel('x / pixel')
-        ax.set_ylabel('y / pixel')
-        ax.axvline(x_c[0], c='k', ls='-')
-        ax.axvline(x_c[-1], c='k', ls='-')
-        ax.axhline(y_c[0], c='k', ls='-')
-        ax.axhline(y_c[-1], c='k', ls='-')
-
-        ax = plt.subplot(gs[4, j])
-        psf_x = np.copy(psf_image[y_w0:y_w1+1, x_w0:x_w1+1])
-        dx, dy = np.mean(np.diff(x_c)), np.mean(np.diff(y_c))
-        x_pc_c, y_pc_c = np.append(x_c - dx/2, x_c[-1] + dx/2), np.append(y_c - dy/2, y_c[-1] + dy/2)
-        norm = simple_norm(np.log10(psf_x), 'linear', percent=100)
-        img = ax.pcolormesh(x_pc_c, y_pc_c, np.log10(psf_x), cmap='viridis', norm=norm, edgecolors='face',
-                            shading='flat')
-        cut_flux = np.sum(psf_x[cut_int])
-        ax.set_title(r'Cut flux is {:.3f}\% of total flux'.format(cut_flux/total_flux*100))
-        cb = plt.colorbar(img, ax=ax, use_gridspec=True)
-        cb.set_label('log$_{10}$(PSF Response)')
-        ax.set_xlabel('x / pixel')
-        ax.set_ylabel('y / pixel')
-
-        ax = plt.subplot(gs[5, j])
-        norm = simple_norm(psf_image_c, 'log', percent=100)
-        img = ax.pcolormesh(x_pc_c, y_pc_c, psf_image_c, cmap='viridis', norm=norm, edgecolors='face',
-                            shading='flat')
-        cb = plt.colorbar(img, ax=ax, use_gridspec=True)
-        cb.set_label('PSF Response')
-        ax.set_xlabel('x / pixel')
-        ax.set_ylabel('y / pixel')
+    np.save(psf_comp_filename, psf_comp)
+    # record which filter each set of components is for, and how the fits went
+    np.savez(psf_comp_fit_filename(psf_comp_filename), filters=np.array(filters), fun=fit_fun,
+             nfev=fit_nfev, time=fit_time, cut_flux=cut_fluxes, N_comp=N_comp)
+    # with the fits saved, the chains' checkpoints are no longer needed
+    for checkpoint in checkpoints:
+        if os.path.isfile(checkpoint):
+            os.remove(checkpoint)
+
+
+def plot_psf_mog_fit(iterable):
+    # diagnostic figure of the MoG fit to a single filter's PSF, saved to its own file; returns
+    # the sum of squared residuals of the model over the full oversampled PSF
+    filter_, psf_name, oversamp, p, max_pix_offset, cut, type_ = iterable
+    (x, y, psf_image, x_c, y_c, psf_image_c, total_flux, cut_flux,
+     (y_w0, y_w1, x_w0, x_w1)) = psf_cutout(psf_name, oversamp, max_pix_offset, cut)
+    over_index_middle = 1 / 2
+    cut_int = ((x_c.reshape(1, -1) % 1.0 == over_index_middle) &
+               (y_c.reshape(-1, 1) % 1.0 == over_index_middle))
+    x_int, y_int = np.arange(-20, 20.1, 1), np.arange(-20, 20.1, 1)
+    j = 0
+    gs = gridcreate(filter_, 6, 1, 0.8, 5)
+
+    ax = plt.subplot(gs[0, j])
+    norm = simple_norm(psf_image, 'log', percent=100)
+    # with the psf being (y, x) we do not need to transpose it to correct for pcolormesh being
+    # flipped, but our x and y need additional tweaking, as these are pixel centers, but
+    # pcolormesh wants pixel edges. we thus subtract half a pixel off each value and add a
+    # final value to the end
+    dx, dy = np.mean(np.diff(x)), np.mean(np.diff(y))
+    x_pc, y_pc = np.append(x - dx/2, x[-1] + dx/2), np.append(y - dy/2, y[-1] + dy/2)
+    img = ax.pcolormesh(x_pc, y_pc, psf_image, cmap='viridis', norm=norm, edgecolors='face',
+                        shading='flat')
+    cb = plt.colorbar(img, ax=ax, use_gridspec=True)
+    cb.set_label('PSF Response')
+    ax.set_xlabel('x / pixel')
+    ax.set_ylabel('y / pixel')
+    ax.set_title(r'Cut flux is {:.3f}\% of total flux'.format(cut_flux/total_flux*100))
+    ax.axvline(x_c[0], c='k', ls='-')
+    ax.axvline(x_c[-1], c='k', ls='-')
+    ax.axhline(y_c[0], c='k', ls='-')
+    ax.axhline(y_c[-1], c='k', ls='-')
+
+    psf_fit = psf_fit_fun(p, x, y)
+    ax = plt.subplot(gs[1, j])
+    norm = simple_norm(psf_fit, 'log', percent=100)
+    img = ax.pcolormesh(x_pc, y_pc, psf_fit, cmap='viridis', norm=norm, edgecolors='face', shading='flat')
+    cb = plt.colorbar(img, ax=ax, use_gridspec=True)
+    cb.set_label('PSF Response')
+    ax.set_xlabel('x / pixel')
+    ax.set_ylabel('y / pixel')
+    ax.set_title('Model PSF sum: {:.5f}'.format(np.sum(psf_fit_fun(p, x_int, y_int))))
+    ax.axvline(x_c[0], c='k', ls='-')
+    ax.axvline(x_c[-1], c='k', ls='-')
+    ax.axhline(y_c[0], c='k', ls='-')
+    ax.axhline(y_c[-1], c='k', ls='-')
+
+    ax = plt.subplot(gs[2, j])
+    ratio = np.zeros_like(psf_fit)
+    ratio[psf_image != 0] = (psf_fit[psf_image != 0] - psf_image[psf_image != 0]) / \
+        psf_image[psf_image != 0]
+    ratio_ma = np.ma.array(ratio, mask=(psf_image == 0) & (psf_image > 1e-3))
+    norm = simple_norm(ratio[(ratio != 0) & (psf_image > 1e-3)], 'linear', percent=100)
+    cmap = plt.get_cmap('viridis')
+    cmap.set_bad('w', 0)
+    img = ax.pcolormesh(x_pc, y_pc, ratio_ma, cmap=cmap, norm=norm, edgecolors='face', shading='flat')
+    cb = plt.colorbar(img, ax=ax, use_gridspec=True)
+    cb.set_label('Relative Difference')
+    ax.set_xlabel('x / pixel')
+    ax.set_ylabel('y / pixel')
+    ax.axvline(x_c[0], c='k', ls='-')
+    ax.axvline(x_c[-1], c='k', ls='-')
+    ax.axhline(y_c[0], c='k', ls='-')
+    ax.axhline(y_c[-1], c='k', ls='-')
+
+    ax = plt.subplot(gs[3, j])
+    ratio = (psf_fit - psf_image)
+    ratio_ma = np.ma.array(ratio, mask=(psf_image == 0) & (psf_image > 1e-3))
+    norm = simple_norm(ratio[(ratio != 0) & (psf_image > 1e-3)], 'linear', percent=100)
+    cmap = plt.get_cmap('viridis')
+    cmap.set_bad('w', 0)
+    img = ax.pcolormesh(x_pc, y_pc, ratio_ma, cmap=cmap, norm=norm, edgecolors='face', shading='flat')
+    cb = plt.colorbar(img, ax=ax, use_gridspec=True)
+    cb.set_label('Absolute Difference')
+    ax.set_xlabel('x / pixel')
+    ax.set_ylabel('y / pixel')
+    ax.axvline(x_c[0], c='k', ls='-')
+    ax.axvline(x_c[-1], c='k', ls='-')
+    ax.axhline(y_c[0], c='k', ls='-')
+    ax.axhline(y_c[-1], c='k', ls='-')
+
+    ax = plt.subplot(gs[4, j])
+    psf_x = np.copy(psf_image[y_w0:y_w1+1, x_w0:x_w1+1])
+    dx, dy = np.mean(np.diff(x_c)), np.mean(np.diff(y_c))
+    x_pc_c, y_pc_c = np.append(x_c - dx/2, x_c[-1] + dx/2), np.append(y_c - dy/2, y_c[-1] + dy/2)
+    norm = simple_norm(np.log10(psf_x), 'linear', percent=100)
+    img = ax.pcolormesh(x_pc_c, y_pc_c, np.log10(psf_x), cmap='viridis', norm=norm, edgecolors='face',
+                        shading='flat')
+    cut_flux = np.sum(psf_x[cut_int])
+    ax.set_title(r'Cut flux is {:.3f}\% of total flux'.format(cut_flux/total_flux*100))
+    cb = plt.colorbar(img, ax=ax, use_gridspec=True)
+    cb.set_label('log$_{10}$(PSF Response)')
+    ax.set_xlabel('x / pixel')
+    ax.set_ylabel('y / pixel')
+
+    ax = plt.subplot(gs[5, j])
+    norm = simple_norm(psf_image_c, 'log', percent=100)
+    img = ax.pcolormesh(x_pc_c, y_pc_c, psf_image_c, cmap='viridis', norm=norm, edgecolors='face',
+                        shading='flat')
+    cb = plt.colorbar(img, ax=ax, use_gridspec=True)
+    cb.set_label('PSF Response')
+    ax.set_xlabel('x / pixel')
+    ax.set_ylabel('y / pixel')
 
     plt.tight_layout()
-    plt.savefig('psf_fit/test_psf_mog_{}.pdf'.format(type_))
-
-    np.save(psf_comp_filename, psf_comp)
+    plt.savefig('psf_fit/test_psf_mog_{}_{}.pdf'.format(type_, filter_))
+    plt.close(filter_)
+
+    return psf_fit_min(p, x, y, psf_image)[0]
+
+
+def psf_mog_diagnostics(psf_names, oversamp, psf_comp_filename, type_, max_pix_offsets, cuts):
+    # plots the saved MoG fits against their PSFs, one figure per filter made in parallel
+    psf_comp = np.load(psf_comp_filename)
+    filters = [os.path.splitext(os.path.basename(q))[0] for q in psf_names]
+    iter_group = [(filters[j], psf_names[j], oversamp, psf_comp[j].reshape(-1), max_pix_offsets[j],
+                   cuts[j], type_) for j in range(0, len(psf_names))]
+    pool = multiprocessing.Pool(min(len(psf_names), 10))
+    for filter_, fun in zip(filters, pool.map(plot_psf_mog_fit, iter_group)):
+        print(filter_, fun)
+    pool.close()
+    pool.join()
+
+
+def make_field_psf_grid(grid_root, filters, detectors, positions, oversamp, N_comp,
+                        max_pix_offsets, cuts, seed_filename='../PSFs/wfirst_psf_comp.npy',
+                        **fit_kwargs):
+    # fits MoG PSF components at every detector position (x, y), for x and y each in positions,
+    # of every detector, in every filter, saving the field-dependent components as a single
+    # (filter, detector, x, y, component, 6) cube in {grid_root}.npz, see field_psf_comp. the
+    # webbpsf PSFs come from the cache, with the ePSFs written under {grid_root}_epsf, and all
+    # nodes are fit together by psf_mog_fitting, seeded from the components of the same filter
+    # in seed_filename -- or each node's own fit if the grid was fit before -- with fit_kwargs
+    # passed on. max_pix_offsets and cuts are given per filter
+    psf_specs = [(filter_, detector, (x, y)) for filter_ in filters for detector in detectors
+                 for x in positions for y in positions]
+    psf_filenames = cached_psf_filenames(psf_specs, oversamp)
+    epsf_dir = '{}_epsf'.format(grid_root)
+    if not os.path.exists(epsf_dir):
+        os.makedirs(epsf_dir)
+    psf_names = []
+    for (filter_, detector, (x, y)), psf_filename in zip(psf_specs, psf_filenames):
+        # the ePSFs are cheap to remake from the cached PSFs, so are always rewritten; each PSF
+        # is only open while its ePSF is made, as there can be many hundreds of nodes
+        psf_names.append('{}/{}_{}_{}_{}.fits'.format(epsf_dir, filter_, detector, x, y))
+        with pyfits.open(psf_filename) as psf:
+            create_effective_psf(psf, oversamp).writeto(psf_names[-1], overwrite=True)
+    n_node = len(detectors) * len(positions)**2
+    node_offsets = [max_pix_offsets[i] for i in range(0, len(filters)) for _ in range(0, n_node)]
+    node_cuts = [cuts[i] for i in range(0, len(filters)) for _ in range(0, n_node)]
+
+    nodes_filename = '{}_nodes.npy'.format(grid_root)
+    if os.path.isfile(nodes_filename):
+        seed_filename = nodes_filename
+    psf_mog_fitting(psf_names, oversamp, nodes_filename, N_comp, node_offsets, node_cuts,
+                    incremental=True, seed_filename=seed_filename, **fit_kwargs)
+    psf_comp = np.load(nodes_filename).reshape(len(filters), len(detectors), len(positions),
+                                               len(positions), N_comp + 1, 6)
+    np.savez('{}.npz'.format(grid_root), psf_comp=psf_comp, filters=np.array(filters),
+             detectors=np.array(detectors), positions=np.array(positions))
+
+
+field_psf_grids = {}
+
+
+def match_psf_comp(psf_c, psf_c_ref):
+    # reorders the fitted components of psf_c -- all but the final, fixed-shape, wide one -- into
+    # correspondence with those of psf_c_ref, by the assignment minimising the summed squared
+    # differences of their parameters
+    cost = np.sum((psf_c[:-1, None, :] - psf_c_ref[None, :-1, :])**2, axis=-1)
+    rows, cols = linear_sum_assignment(cost)
+    order = np.empty(len(rows), int)
+    order[cols] = rows
+    return np.concatenate([psf_c[:-1][order], psf_c[-1:]])
+
+
+def load_field_psf_grid(grid_filename):
+    # field PSF grids are small, so are read in full once and kept for every later call. each
+    # node is fit independently, so its components are put into correspondence with those of an
+    # already matched neighbour on the same detector -- the node below it, or for the first row
+    # the node to its left -- for field_psf_comp to interpolate between
+    if grid_filename not in field_psf_grids:
+        with np.load(grid_filename) as f:
+            psf_grid = dict((key, f[key]) for key in f.files)
+        psf_comp = psf_grid['psf_comp']
+        for i in range(0, psf_comp.shape[0]):
+            for d in range(0, psf_comp.shape[1]):
+                for k_x in range(0, psf_comp.shape[2]):
+                    for k_y in range(0, psf_comp.shape[3]):
+                        if k_y > 0:
+                            psf_comp[i, d, k_x, k_y] = match_psf_comp(
+                                psf_comp[i, d, k_x, k_y], psf_comp[i, d, k_x, k_y - 1])
+                        elif k_x > 0:
+                            psf_comp[i, d, k_x, k_y] = match_psf_comp(
+                                psf_comp[i, d, k_x, k_y], psf_comp[i, d, k_x - 1, k_y])
+        field_psf_grids[grid_filename] = psf_grid
+    return field_psf_grids[grid_filename]
+
+
+def field_psf_comp(psf_grid, filter_, detector, detector_position):
+    # PSF components for any position on a detector, from the grid of load_field_psf_grid, as a
+    # bilinear interpolation of the parameters of the corresponding components of the fits at the
+    # surrounding grid positions; positions outside the grid take the nearest edge. the weights
+    # are interpolated linearly too, so the total flux is that of the bilinear interpolation of
+    # the PSFs, and the fits are returned exactly at the grid positions. returns an (N + 1, 6)
+    # array, as at each grid position, which can be used as psf_c by mog_add_psf and mog_galaxy
+    i = list(psf_grid['filters']).index(filter_)
+    d = list(psf_grid['detectors']).index(detector)
+    positions = psf_grid['positions']
+    weights = []
+    for q in detector_position:
+        if len(positions) == 1:
+            weights.append([(0, 1)])
+            continue
+        q = np.clip(q, positions[0], positions[-1])
+        k = min(np.searchsorted(positions, q, side='right') - 1, len(positions) - 2)
+        f = (q - positions[k]) / (positions[k+1] - positions[k])
+        weights.append([(k, 1 - f), (k + 1, f)])
+    psf_c = 0
+    for k_x, w_x in weights[0]:
+        for k_y, w_y in weights[1]:
+            psf_c = psf_c + w_x * w_y * psf_grid['psf_comp'][i, d, k_x, k_y]
+    return psf_c
+
+
+def merge_psf_comp(psf_c_1, psf_c_2):
+    # moment-matched merge of two (mux, muy, sx, sy, rho, c) components of the same sign: the
+    # single gaussian with the same flux, mean and covariance as their sum
+    (mu_1, mu_2), (V_1, V_2), (c_1, c_2) = psf_comp_to_mog(np.array([psf_c_1, psf_c_2]))
+    c = c_1 + c_2
+    mu = (c_1 * mu_1 + c_2 * mu_2) / c
+    d_1, d_2 = mu_1 - mu, mu_2 - mu
+    V = (c_1 * (V_1 + np.outer(d_1, d_1)) + c_2 * (V_2 + np.outer(d_2, d_2))) / c
+    sx, sy = np.sqrt(V[0, 0]), np.sqrt(V[1, 1])
+    return np.array([mu[0], mu[1], sx, sy, V[0, 1] / (sx * sy), c])
+
+
+def refit_psf_comp_weights(basis, target, g):
+    # least-squares weights of the unit-flux component images basis, (K, pixel), to the target
+    # image, subject to sum_k c_k = g, from the linear (KKT) system of the equality constrained
+    # problem -- as with the fit itself, weights are unbounded
+    K = len(basis)
+    A = np.zeros((K + 1, K + 1), float)
+    A[:K, :K] = np.matmul(basis, basis.T)
+    A[:K, K] = A[K, :K] = 1
+    b = np.append(np.matmul(basis, target), g)
+    return np.linalg.lstsq(A, b, rcond=None)[0][:K]
+
+
+def reduce_psf_comp(psf_c, n_comps, half_width=20, n_sub=4):
+    # greedy model-order reduction of the (N + 1, 6) components of a single filter, the wide
+    # component last: each step tries dropping every core component and merging every pair of
+    # same-signed ones, refits the weights of what remains, keeping the total core flux, and
+    # keeps whichever candidate best reproduces the full mixture over |x|, |y| <= half_width
+    # pixels, sampled n_sub times per pixel. the wide component is always kept unchanged.
+    # returns, for each number of core components in n_comps, the (n + 1, 6) mixture and its
+    # maximum residual relative to the peak and aperture flux error relative to the flux of the
+    # full mixture over the same region
+    x = np.arange(-half_width * n_sub, half_width * n_sub + 1) / n_sub
+    psf_image = psf_fit_fun(psf_c.reshape(-1), x, x).reshape(-1)
+    target = psf_image - psf_fit_fun(psf_c[-1], x, x).reshape(-1)
+    g = np.sum(psf_c[:-1, 5])
+
+    def unit_image(psf_c_):
+        return psf_fit_fun(np.append(psf_c_[:5], 1), x, x).reshape(-1)
+
+    core = np.copy(psf_c[:-1])
+    basis = np.array([unit_image(q) for q in core])
+    reduced = {}
+    while True:
+        n = len(core)
+        if n in n_comps:
+            res = np.matmul(core[:, 5], basis) - target
+            reduced[n] = (np.append(core, psf_c[[-1]], axis=0),
+                          np.amax(np.abs(res)) / np.amax(psf_image),
+                          np.abs(np.sum(res)) / np.sum(psf_image))
+        if n <= min(n_comps):
+            break
+        candidates = [(np.delete(core, k, axis=0), np.delete(basis, k, axis=0))
+                      for k in range(0, n)]
+        for k in range(0, n):
+            for l in range(k + 1, n):
+                if core[k, 5] * core[l, 5] <= 0:
+                    continue
+                merged = merge_psf_comp(core[k], core[l])
+                keep = np.delete(np.arange(0, n), [k, l])
+                candidates.append((np.append(core[keep], [merged], axis=0),
+                                   np.append(basis[keep], [unit_image(merged)], axis=0)))
+        best_cost = np.inf
+        for core_, basis_ in candidates:
+            c = refit_psf_comp_weights(basis_, target, g)
+            cost = np.sum((np.matmul(c, basis_) - target)**2)
+            if cost < best_cost:
+                best_cost, best = cost, (core_, basis_, c)
+        core, basis, c = best
+        core[:, 5] = c
+    return reduced
+
+
+def psf_comp_tier_filename(psf_comp_filename, n_comp):
+    return '{}_n{}.npy'.format(os.path.splitext(psf_comp_filename)[0], n_comp)
+
+
+def psf_comp_tiers_filename(psf_comp_filename):
+    return '{}_tiers.npz'.format(os.path.splitext(psf_comp_filename)[0])
+
+
+def compress_psf_comp(psf_comp_filename, n_comps=(4, 6, 8, 10, 12, 16)):
+    # writes the reduced mixtures of every filter in psf_comp_filename as precision tiers, one
+    # (filter, n + 1, 6) file per number of core components n, see psf_comp_tier_filename, each
+    # usable anywhere the full components are; their accuracies are recorded in
+    # {psf_comp_filename}_tiers.npz for select_psf_comp_tier
+    psf_comp = np.load(psf_comp_filename)
+    n_comps = sorted(n for n in n_comps if n < psf_comp.shape[1] - 1)
+    res_err = np.empty((len(n_comps), len(psf_comp)), float)
+    flux_err = np.empty((len(n_comps), len(psf_comp)), float)
+    psf_comp_tiers = [np.empty((len(psf_comp), n + 1, 6), float) for n in n_comps]
+    for j in range(0, len(psf_comp)):
+        reduced = reduce_psf_comp(psf_comp[j], n_comps)
+        for i, n in enumerate(n_comps):
+            psf_comp_tiers[i][j], res_err[i, j], flux_err[i, j] = reduced[n]
+    for i, n in enumerate(n_comps):
+        np.save(psf_comp_tier_filename(psf_comp_filename, n), psf_comp_tiers[i])
+    np.savez(psf_comp_tiers_filename(psf_comp_filename), n_comp=np.array(n_comps),
+             res_err=res_err, flux_err=flux_err)
+
+
+def select_psf_comp_tier(psf_comp_filename, rtol, ftol):
+    # the file of the fewest-component tier from compress_psf_comp whose maximum residual and
+    # aperture flux error, relative to the full mixture, are within rtol and ftol in every filter;
+    # the full components if no tier is, or if the tiers are older than the components
+    tiers_filename = psf_comp_tiers_filename(psf_comp_filename)
+    if not os.path.isfile(tiers_filename) or \
+            os.path.getmtime(tiers_filename) < os.path.getmtime(psf_comp_filename):
+        return psf_comp_filename
+    with np.load(tiers_filename) as f:
+        n_comp, res_err, flux_err = f['n_comp'], f['res_err'], f['flux_err']
+    for i in np.argsort(n_comp):
+        if np.all(res_err[i] <= rtol) and np.all(flux_err[i] <= ftol):
+            return psf_comp_tier_filename(psf_comp_filename, n_comp[i])
+    return psf_comp_filename
 
 
 if __name__ == '__main__':
     filters = ['r062', 'z087', 'y106', 'w149', 'j129', 'h158', 'f184']
     if sys.argv[1] == 'make':
         # psfs is a list of HDULists
-        psfs = []
         reduced_psfs = []
         oversamp = 4
 
@@ -539,9 +1620,9 @@ if __name__ == '__main__':
         # detector-binned data -- i.e., the created ePSF but sampled at pixel centers, which is thus
         # propagated into reduced_psf with [1] unchaged but [0] now the ePSF (the detector-pixel
         # sampled fraction at oversampling levels of pixel positions).
-        for filter_ in filters:
-            psf = create_psf_image(filter_, oversamp)
-            psfs.append(psf)
+        psfs = cached_psf_images([(filter_, 'SCA09', (2048, 2048)) for filter_ in filters],
+                                 oversamp)
+        for filter_, psf in zip(filters, psfs):
             reduced_psf = create_effective_psf(psf, oversamp)
             rp_hdulist = pyfits.HDUList([a for a in reduced_psf])
             rp_hdulist.writeto('../PSFs/{}.fits'.format(filter_), overwrite=True)
@@ -582,10 +1663,39 @@ if __name__ == '__main__':
             ax.set_ylabel('y / pixel')
         plt.tight_layout()
         plt.savefig('{}/wfirst_psfs.pdf'.format('psf_fit'))
-    elif sys.argv[1] == 'fit':
+    elif sys.argv[1] == 'compress':
+        psf_comp_filename = '../PSFs/wfirst_psf_comp.npy'
+        compress_psf_comp(psf_comp_filename)
+        with np.load(psf_comp_tiers_filename(psf_comp_filename)) as f:
+            for n, res_err, flux_err in zip(f['n_comp'], f['res_err'], f['flux_err']):
+                print(n, np.amax(res_err), np.amax(flux_err))
+    elif sys.argv[1] == 'grid':
+        # field-dependent fits across the focal plane, at the corners, edge centers and center of
+        # every SCA, for the filters with cut-outs set below
+        grid_filters = ['z087', 'y106', 'w149', 'j129', 'h158', 'f184']
+        detectors = ['SCA{:02d}'.format(q) for q in range(1, 19)]
+        max_pix_offsets, cuts = [9, 9, 9, 10, 11, 11], [0.0009, 0.0009, 0.0009, 0.0008, 0.0008, 0.0007]
+        make_field_psf_grid('../PSFs/wfirst_field_psf', grid_filters, detectors, [4, 2048, 4092], 4,
+                            20, max_pix_offsets, cuts, checkpoint_dir='psf_fit/checkpoints')
+    elif sys.argv[1] == 'fit' or sys.argv[1] == 'refit' or sys.argv[1] == 'plot':
+        # refit seeds each filter from the existing components, rather than a global search;
+        # plot makes the diagnostic figures of the saved fits, kept separate from the headless fit
         psf_comp_filename = '../PSFs/wfirst_psf_comp.npy'
         psf_names = ['../PSFs/{}.fits'.format(q) for q in filters]
-        oversampling, N_comp, max_pix_offsets, cuts = 4, 20, [9, 9, 9, 10, 11, 11], [0.0009, 0.0009, 0.0009, 0.0008, 0.0008, 0.0007]
-
-        psf_mog_fitting(psf_names, oversampling, psf_comp_filename, N_comp,
-                        'wfirst', max_pix_offsets, cuts)
+        # one cut-out size and cut per filter, r062 taking those of z087
+        oversampling, N_comp = 4, 20
+        max_pix_offsets = [9, 9, 9, 9, 10, 11, 11]
+        cuts = [0.0009, 0.0009, 0.0009, 0.0009, 0.0008, 0.0008, 0.0007]
+
+        if sys.argv[1] == 'plot':
+            psf_mog_diagnostics(psf_names, oversampling, psf_comp_filename, 'wfirst',
+                                max_pix_offsets, cuts)
+        else:
+            engine = sys.argv[2] if len(sys.argv) > 2 else 'basinhopping'
+            init = sys.argv[3] if len(sys.argv) > 3 else 'random'
+            # e.g. 4,2 for a coarse-to-fine fit through 4x and 2x downsampled cut-outs
+            coarse_factors = [int(q) for q in sys.argv[4].split(',')] if len(sys.argv) > 4 else []
+            psf_mog_fitting(psf_names, oversampling, psf_comp_filename, N_comp, max_pix_offsets,
+                            cuts, engine=engine, init=init, coarse_factors=coarse_factors,
+                            incremental=sys.argv[1] == 'refit',
+                            checkpoint_dir='psf_fit/checkpoints')
@@ -63,58 +63,43 @@ def make_fluxes(filters, times, filt_zp, t0, exptime, psf_r, dark, readnoise):
     # time, band (name, see registered bandpasses), flux, fluxerr [both just derived from an
     # image somehow], zp, zpsys [zeropoint and name of system]
 
-    time_array = []
-    band_array = []
-    flux_array = []
-    fluxerr_array = []
-    zp_array = []
-    zpsys_array = []
-
-    true_flux = []
-    for k in range(0, ntimes):
+    # one bandpass magnitude evaluation per filter over all epochs, giving (time, filter) arrays
+    time = np.asarray(times, dtype=float) + t0
+    zp = np.asarray(filt_zp, dtype=float)[:nfilts]
+    m_ia = np.empty((ntimes, nfilts), float)
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='divide by zero encountered in log10')
+        warnings.filterwarnings('ignore', message='invalid value encountered in log10')
         for j in range(0, nfilts):
-            if filters[j] == 'F184':
-                bkg = np.random.uniform(1, 3)
-            else:
-                bkg = np.random.uniform(0.3, 0.7)
-            time = times[k] + t0
-
-            # get the apparent magnitude of the supernova at a given time; first get the
-            # appropriate filter for the observation
-            bandpass = sncosmo.get_bandpass(filters[j])
             # time should be in days
-            with warnings.catch_warnings():
-                warnings.filterwarnings('ignore', message='divide by zero encountered in log10')
-                warnings.filterwarnings('ignore', message='invalid value encountered in log10')
-                m_ia = sn_model.bandmag(bandpass, magsys='ab', time=time)
-                if np.isnan(m_ia):
-                    m_ia = -2.5 * np.log10(0.01) + filt_zp[j]
-
-            t_f = 10**(-1/2.5 * (m_ia - filt_zp[j]))
-
-            # noise floor of, say, 0.5% photometry in quadrature with shot noise and background
-            # counts in e/s/pixel, assuming a WFIRST aperture size of psf_r pix, or ~pi r^2 pixels,
-            # remembering to correct for the fact that uncertainties in fluxes are really done in
-            # photon counts, so multiply then divide by exptime
-            npix = np.pi * psf_r**2
-            _f = t_f * exptime
-            _d = dark * npix * exptime
-            _b = bkg * npix * exptime
-            _r = npix * readnoise**2
-            flux_err = np.sqrt(_f + (0.005 * _f)**2 + _b + _d + _r) / exptime
-            flux = np.random.normal(loc=t_f, scale=flux_err)
-            time_array.append(time)
-            band_array.append(filters[j])
-            flux_array.append(flux)
-            fluxerr_array.append(flux_err)
-            zp_array.append(filt_zp[j])  # filter-specific zeropoint
-            zpsys_array.append('ab')
-
-            true_flux.append(t_f)
-
-    lc_data = [np.array(time_array), np.array(band_array), np.array(flux_array),
-               np.array(fluxerr_array), np.array(zp_array), np.array(zpsys_array)]
-    true_flux = np.array(true_flux)
+            m_ia[:, j] = sn_model.bandmag(sncosmo.get_bandpass(filters[j]), magsys='ab', time=time)
+    m_ia = np.where(np.isnan(m_ia), -2.5 * np.log10(0.01) + zp, m_ia)
+
+    t_f = 10**(-1/2.5 * (m_ia - zp))
+
+    # background counts in e/s/pixel, drawn for every observation at once; as before, only a
+    # filter named exactly F184 takes the higher background
+    high_bkg = np.array([filter_ == 'F184' for filter_ in filters])
+    bkg = np.random.uniform(np.where(high_bkg, 1, 0.3), np.where(high_bkg, 3, 0.7),
+                            size=(ntimes, nfilts))
+
+    # noise floor of, say, 0.5% photometry in quadrature with shot noise and background
+    # counts in e/s/pixel, assuming a WFIRST aperture size of psf_r pix, or ~pi r^2 pixels,
+    # remembering to correct for the fact that uncertainties in fluxes are really done in
+    # photon counts, so multiply then divide by exptime
+    npix = np.pi * psf_r**2
+    _f = t_f * exptime
+    _d = dark * npix * exptime
+    _b = bkg * npix * exptime
+    _r = npix * readnoise**2
+    flux_err = np.sqrt(_f + (0.005 * _f)**2 + _b + _d + _r) / exptime
+    flux = np.random.normal(loc=t_f, scale=flux_err)
+
+    # observations are ordered by time, and by filter within each time, with filter-specific
+    # zeropoints
+    lc_data = [np.repeat(time, nfilts), np.tile(np.asarray(filters), ntimes), flux.reshape(-1),
+               flux_err.reshape(-1), np.tile(zp, ntimes), np.full(ntimes * nfilts, 'ab')]
+    true_flux = t_f.reshape(-1)
 
     param_names = ['z', 't0', 'amplitude']
     sn_params = np.array([sn_model[q] for q in param_names])
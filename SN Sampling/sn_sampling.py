@@ -1,14 +1,17 @@
 import os
+import copy
 import matplotlib.gridspec as gridspec
 import numpy as np
 import matplotlib.pyplot as plt
 
 from scipy.special import gammaincinv
 from astropy.table import Table
+from astropy.cosmology import WMAP9
 import sncosmo
 from scipy.ndimage import shift
 import glob
 import timeit
+import hashlib
 
 try:
     dummy = profile
@@ -23,7 +26,6 @@ import psf_mog_fitting as pmf
 import emcee
 from multiprocessing import Pool
 
-import warnings
 os.environ["OMP_NUM_THREADS"] = "1"
 
 # things to add to detector to create accurate noise model:
@@ -112,27 +114,37 @@ def add_poisson(image):
     return np.random.poisson(lam=image).astype(float)
 
 
+# every template model built so far, each only loaded once per process: get_sn_model hands out
+# copies, sharing nothing mutable with the prototype. sn_peak_amplitudes holds the amplitude
+# giving each template its peak absolute magnitude, keyed by (sn_type, absmag, band, magsys)
+sn_model_prototypes = {}
+sn_peak_amplitudes = {}
+
+
 def get_sn_model(sn_type, setflag, t0=0.0, z=0.0):
     # salt2 for Ia, random other timeseriessource subclasses for non-Ias
     # draw salt2 x1 and c from salt2_parameters (gaussian, x1: x0=0.4, sigma=0.9, c: x0=-0.04,
     # sigma = 0.1); Hounsell 2017 gives SALT2 models over a wider wavelength range
 
-    if sn_type == 'Ia':  # -20-+50
-        sn_model = sncosmo.Model('hsiao')
-    elif sn_type == 'Iat':  # 0-93
-        sn_model = sncosmo.Model('nugent-sn91t')
-    elif sn_type == 'Iabg':  # 0-113
-        sn_model = sncosmo.Model('nugent-sn91bg')
-    elif sn_type == 'Ib':  # -44.16-+168.48
-        sn_model = sncosmo.Model('snana-2007y')
-    elif sn_type == 'Ic':  # -42.48-+167.4
-        sn_model = sncosmo.Model('snana-2004fe')
-    elif sn_type == 'IIP' or sn_type == 'II':  # -28.8-+79.4
-        sn_model = sncosmo.Model('snana-2007kw')
-    elif sn_type == 'IIL':  # 0-411; really about 150 before polynomial fit increases flux again
-        sn_model = sncosmo.Model('nugent-sn2l')
-    elif sn_type == 'IIn':  # 0-227, but really to about 150
-        sn_model = sncosmo.Model('nugent-sn2n')  # 'snana-2006ix')
+    if sn_type not in sn_model_prototypes:
+        if sn_type == 'Ia':  # -20-+50
+            sn_model = sncosmo.Model('hsiao')
+        elif sn_type == 'Iat':  # 0-93
+            sn_model = sncosmo.Model('nugent-sn91t')
+        elif sn_type == 'Iabg':  # 0-113
+            sn_model = sncosmo.Model('nugent-sn91bg')
+        elif sn_type == 'Ib':  # -44.16-+168.48
+            sn_model = sncosmo.Model('snana-2007y')
+        elif sn_type == 'Ic':  # -42.48-+167.4
+            sn_model = sncosmo.Model('snana-2004fe')
+        elif sn_type == 'IIP' or sn_type == 'II':  # -28.8-+79.4
+            sn_model = sncosmo.Model('snana-2007kw')
+        elif sn_type == 'IIL':  # 0-411; really about 150 before polynomial fit increases flux again
+            sn_model = sncosmo.Model('nugent-sn2l')
+        elif sn_type == 'IIn':  # 0-227, but really to about 150
+            sn_model = sncosmo.Model('nugent-sn2n')  # 'snana-2006ix')
+        sn_model_prototypes[sn_type] = sn_model
+    sn_model = copy.copy(sn_model_prototypes[sn_type])
     if setflag:
         sn_model.set(t0=t0, z=z)
     # TODO: add galaxy dust via smcosmo.F99Dust([r_v])
@@ -140,11 +152,179 @@ def get_sn_model(sn_type, setflag, t0=0.0, z=0.0):
     return sn_model
 
 
-def make_images(filters, pixel_scale, sn_type, times, exptime, filt_zp, psf_comp_filename,
-                dark_current, readnoise, t0, lambda_eff):
-    nfilts = len(filters)
-    ntimes = len(times)
-
+def sn_peak_amplitude(sn_type, absmag=-19.0, band='f125w', magsys='ab'):
+    # amplitude of the sn_type template at peak absolute magnitude absmag in band, i.e. at zero
+    # distance modulus; as it depends on neither z nor t0 it is found, by set_source_peakabsmag at
+    # z=1, once per template and cached
+    key = (sn_type, absmag, band, magsys)
+    if key not in sn_peak_amplitudes:
+        sn_model = get_sn_model(sn_type, 1, t0=0, z=1)
+        sn_model.set_source_peakabsmag(absmag, band, magsys)
+        sn_peak_amplitudes[key] = sn_model['amplitude'] * 10**(0.4 * WMAP9.distmod(1).value)
+    return sn_peak_amplitudes[key]
+
+
+def set_sn_peakabsmag(sn_model, sn_type, absmag=-19.0, band='f125w', magsys='ab'):
+    # as sn_model.set_source_peakabsmag, with the WMAP9 distance modulus at the model's redshift,
+    # but from the cached peak amplitude of its template
+    z = sn_model['z']
+    if z <= 0:
+        raise ValueError('absolute magnitude undefined when z<=0.')
+    sn_model.set(amplitude=sn_peak_amplitude(sn_type, absmag, band, magsys) *
+                 10**(-0.4 * WMAP9.distmod(z).value))
+
+
+# redshifts and observer-frame phases, in days relative to t0, of the tabulated template
+# bandfluxes, and where the tables are saved
+bandflux_grid_z = np.arange(0, 3.0 + 1e-10, 0.01)
+bandflux_grid_phase = np.arange(-120, 250 + 1e-10, 1.0)
+bandflux_grid_dir = 'bandflux_grids'
+# tables already loaded by this process, keyed by (type, filter), and the redshift limits of
+# fit_lc, keyed by (type, filter, zero point, largest z, z step, minimum counts)
+bandflux_grids = {}
+fit_lc_z_limits = {}
+
+
+def bandpass_hash(filter_):
+    bandpass = sncosmo.get_bandpass(filter_)
+    return hashlib.sha1(np.concatenate([bandpass.wave, bandpass.trans]).tobytes()).hexdigest()[:16]
+
+
+def make_bandflux_grid(sn_model, filter_, zs, phases):
+    # zero point 0 AB bandflux of the model, at unit amplitude and t0 = 0, at each redshift and
+    # observer-frame phase; NaN at redshifts where the filter does not overlap the model
+    sn_model.set(t0=0, amplitude=1)
+    flux = np.full((len(zs), len(phases)), np.nan)
+    for i, z in enumerate(zs):
+        sn_model.set(z=z)
+        if sn_model.bandoverlap(filter_):
+            flux[i] = sn_model.bandflux(filter_, phases, zp=0, zpsys='ab')
+    return flux
+
+
+def load_bandflux_grid(sn_type, filter_):
+    # bandflux table of the template of sn_type in a filter, see make_bandflux_grid, made once and
+    # saved in bandflux_grid_dir; it is remade if the template, the filter throughput or the grid
+    # has changed. with each table is kept the rest-frame phase range of the template, which
+    # grid_bandflux only interpolates within, and stored its interpolation error: the largest
+    # difference between grid_bandflux and sncosmo at the centres of the grid cells, relative to
+    # the peak bandflux in the table
+    key = (sn_type, filter_)
+    if key not in bandflux_grids:
+        sn_model = get_sn_model(sn_type, 0)
+        source = sn_model.source
+        grid_filename = '{}/{}_{}.npz'.format(bandflux_grid_dir, source.name, filter_)
+        version = '{} {} {} {}'.format(source.version, sncosmo.__version__, bandpass_hash(filter_),
+                                       hashlib.sha1(np.concatenate([bandflux_grid_z,
+                                                    bandflux_grid_phase]).tobytes()).hexdigest())
+        grid = None
+        if os.path.isfile(grid_filename):
+            with np.load(grid_filename) as f:
+                grid = dict((q, f[q]) for q in f.files)
+            if str(grid['version']) != version:
+                grid = None
+        if grid is None:
+            grid = {'z': bandflux_grid_z, 'phase': bandflux_grid_phase, 'version': version,
+                    'flux': make_bandflux_grid(sn_model, filter_, bandflux_grid_z,
+                                               bandflux_grid_phase),
+                    'min_phase': source.minphase(), 'max_phase': source.maxphase()}
+            z_mid = bandflux_grid_z[:-1] + np.diff(bandflux_grid_z) / 2
+            phase_mid = bandflux_grid_phase[:-1] + np.diff(bandflux_grid_phase) / 2
+            flux_mid = make_bandflux_grid(sn_model, filter_, z_mid, phase_mid)
+            diff = grid_bandflux(grid, z_mid.reshape(-1, 1), phase_mid.reshape(1, -1)) - flux_mid
+            grid['err'] = np.nanmax(np.abs(diff)) / np.nanmax(np.abs(grid['flux']))
+            print('{} {} bandflux grid, interpolation error {:.1e} of peak'.format(
+                source.name, filter_, grid['err']))
+            if not os.path.exists(bandflux_grid_dir):
+                os.makedirs(bandflux_grid_dir, exist_ok=True)
+            # several processes may be making the table at once, so write to a unique file and
+            # then atomically move it into place
+            temp_filename = '{}.{}.npz'.format(os.path.splitext(grid_filename)[0], os.getpid())
+            np.savez(temp_filename, **grid)
+            os.replace(temp_filename, grid_filename)
+        # tables saved before the phase range was kept take it from the template, which the
+        # version already ties them to
+        grid['min_phase'], grid['max_phase'] = source.minphase(), source.maxphase()
+        bandflux_grids[key] = grid
+    return bandflux_grids[key]
+
+
+def grid_bandflux(grid, z, phase):
+    # interpolation of a bandflux table from load_bandflux_grid at redshifts z and observer-frame
+    # phases, which broadcast together: linear in redshift, and cubic (Catmull-Rom) in phase, as
+    # sncosmo splines the templates in phase. NaN outside the table, where the filter does not
+    # overlap the model at either neighbouring redshift, or where any of the nodes used is outside
+    # the template's phase range, min_phase to max_phase in the rest frame, as sncosmo's flux
+    # is not smooth at its ends, which no interpolation follows; model_bandflux falls back to
+    # sncosmo there. within the range the error is of the order of the table's err
+    zs, phases, flux = grid['z'], grid['phase'], grid['flux']
+    t_z = (np.asarray(z, dtype=float) - zs[0]) / (zs[1] - zs[0])
+    t_p = (np.asarray(phase, dtype=float) - phases[0]) / (phases[1] - phases[0])
+    i = np.clip(np.floor(t_z).astype(int), 0, len(zs) - 2)
+    j = np.clip(np.floor(t_p).astype(int), 1, len(phases) - 3)
+    w_z, w_p = t_z - i, t_p - j
+    w_ps = [(-w_p**3 + 2 * w_p**2 - w_p) / 2, (3 * w_p**3 - 5 * w_p**2 + 2) / 2,
+            (-3 * w_p**3 + 4 * w_p**2 + w_p) / 2, (w_p**3 - w_p**2) / 2]
+    f = 0
+    for i_, w_z_ in [(i, 1 - w_z), (i + 1, w_z)]:
+        for k in range(0, 4):
+            # a node with no weight does not contribute, even where it has no overlap
+            w = w_z_ * w_ps[k]
+            f = f + np.where(w == 0, 0, w * flux[i_, j + k - 1])
+    outside = (t_z < 0) | (t_z > len(zs) - 1) | (t_p < 0) | (t_p > len(phases) - 1)
+    for i_ in [i, i + 1]:
+        outside = outside | (phases[j - 1] / (1 + zs[i_]) < grid['min_phase']) | \
+            (phases[j + 2] / (1 + zs[i_]) > grid['max_phase'])
+    return np.where(outside, np.nan, f)
+
+
+def model_bandflux(sn_model, sn_type, filters, time, zp):
+    # (time, filter) count rates, in the AB system with zero points zp, of sn_model -- a model of
+    # sn_type -- at observer-frame times, interpolated from the bandflux tables where they cover
+    # the model's redshift and the phases, and from sncosmo otherwise
+    t_f = np.empty((len(time), len(filters)), float)
+    for j in range(0, len(filters)):
+        grid = load_bandflux_grid(sn_type, filters[j])
+        t_f[:, j] = sn_model['amplitude'] * 10**(0.4 * zp[j]) * \
+            grid_bandflux(grid, sn_model['z'], time - sn_model['t0'])
+        q = np.isnan(t_f[:, j])
+        if np.any(q):
+            t_f[q, j] = sn_model.bandflux(filters[j], time[q], zp=zp[j], zpsys='ab')
+    return t_f
+
+
+def get_fit_lc_z_limits(sn_type, filter_, zp, largest_z, dz, min_counts):
+    # the redshift limits fit_lc places on the template of sn_type, at unit amplitude and t0 = 0,
+    # from one filter with zero point zp, found once per process: the largest z, up to largest_z,
+    # before the filter drops out of overlap with the model; the (first, last) of the redshifts,
+    # in steps of dz, up to there; and the (lowest, highest) of those at which the peak-phase
+    # count rate is above min_counts -- the full range if never. as they are only found once,
+    # these come from sncosmo as fit_lc always found them, rather than the bandflux tables,
+    # whose interpolation could move a limit by a step where the count rate is at min_counts
+    key = (sn_type, filter_, zp, largest_z, dz, min_counts)
+    if key not in fit_lc_z_limits:
+        # the overlap is stepped through exactly as z is accumulated in steps of dz, as where the
+        # steps pass largest_z sets the final limit
+        sn_model = get_sn_model(sn_type, 0)
+        z = 0
+        while sn_model.bandoverlap(filter_, z=z):
+            z += dz
+            if z > largest_z:
+                break  # otherwise this will just keep going forever for very red filters
+        z_upper_band = min(largest_z, z - dz)
+        z_array = np.arange(0, z_upper_band+1e-10, dz)
+        countrate = np.empty_like(z_array)
+        for q, z_init in enumerate(z_array):
+            sn_model.set(z=z_init)
+            countrate[q] = sn_model.bandflux(filter_, time=0, zp=zp, zpsys='ab')
+        q = np.where(countrate > min_counts)[0]
+        z_range = (z_array[0], z_array[-1])
+        z_count = (z_array[q[0]], z_array[q[-1]]) if len(q) > 0 else z_range
+        fit_lc_z_limits[key] = z_upper_band, z_range, z_count
+    return fit_lc_z_limits[key]
+
+
+def draw_host_params():
     # assuming surface brightnesses vary between roughly mu_e = 18-23 mag/arcsec^2 (mcgaugh
     # 1995, driver 2005, shen 2003 -- assume shen 2003 gives gaussian with mu=20.94, sigma=0.74)
 
@@ -167,11 +347,6 @@ def make_images(filters, pixel_scale, sn_type, times, exptime, filt_zp, psf_comp
     x_ = gammaincinv(2*n_type, y_frac)
     # however, x = bn * (R/Re)**(1/n), so we have to solve for R now, approximating bn; in arcsec
     offset_r = (x_ / (2*n_type - 1/3))**n_type * half_l_r
-    # redshift randomly drawn between two values uniformly
-    z_low, z_high = 0.2, 1.0
-    z = np.random.uniform(z_low, z_high)
-
-    psf_comp = np.load(psf_comp_filename)
 
     # 0.75 mag is really 2.5 * log10(2), for double flux, given area is half-light radius
     mag = mu_0 - 2.5 * np.log10(np.pi * half_l_r**2 * e_disk) - 2.5 * np.log10(2)
@@ -184,6 +359,41 @@ def make_images(filters, pixel_scale, sn_type, times, exptime, filt_zp, psf_comp
     Rg = np.array([[-a * np.sin(t), b * np.cos(t)], [a * np.cos(t), b * np.sin(t)]])
     Vgm_unit = np.matmul(Rg, np.transpose(Rg))
 
+    return mu_0, n_type, e_disk, pa_disk, half_l_r, offset_r, Vgm_unit, mag
+
+
+def make_images(filters, pixel_scale, sn_type, times, exptime, filt_zp, psf_comp_filename,
+                dark_current, readnoise, t0, lambda_eff, host_library=None):
+    nfilts = len(filters)
+    ntimes = len(times)
+
+    if host_library is None:
+        mu_0, n_type, e_disk, pa_disk, half_l_r, offset_r, Vgm_unit, mag = draw_host_params()
+    else:
+        # draw a pre-rendered host from the library, rather than creating a new one
+        library_hosts, library_stamps = load_host_library(host_library)
+        h = np.random.choice(len(library_hosts['mu_0']))
+        mu_0, n_type, e_disk, pa_disk, half_l_r, offset_r, Vgm_unit, mag = \
+            [library_hosts[q][h] for q in ['mu_0', 'n_type', 'e_disk', 'pa_disk', 'half_l_r',
+                                           'offset_r', 'Vgm_unit', 'mag']]
+        if not host_library_matches(library_hosts, filters, pixel_scale, filt_zp,
+                                    psf_comp_filename):
+            raise ValueError('Host library {} was not created for filters {} with zeropoints '
+                             '{}, pixel scale {} and PSF components {}.'.format(
+                                 host_library, filters, filt_zp, pixel_scale, psf_comp_filename))
+        library_filt_inds = np.array([np.where(library_hosts['filters'] == filter_)[0][0]
+                                      for filter_ in filters])
+
+    # redshift randomly drawn between two values uniformly
+    z_low, z_high = 0.2, 1.0
+    z = np.random.uniform(z_low, z_high)
+
+    psf_comp = np.load(psf_comp_filename)
+    # unit-flux PSF stamps on a sub-pixel grid, to inject the supernova by table lookup
+    psf_table = pmf.load_psf_stamp_table(psf_comp_filename)
+    # fraction of the PSF flux in a box aperture, as a function of sub-pixel source position
+    apcorr_table = pmf.load_aperture_correction_table(psf_comp_filename)
+
     endflag = 0
     while endflag == 0:
         # random offsets for star should be in arcseconds
@@ -209,7 +419,7 @@ def make_images(filters, pixel_scale, sn_type, times, exptime, filt_zp, psf_comp
     # pretending that F125W on WFC3/IR is 2MASS J, we set the absolute magnitude of a
     # type Ia supernova to J = -19.0 (meikle 2000). Phillips (1993) also says that ~M_I = -19 --
     # currently just setting absolute magnitudes to -19, but could change if needed
-    sn_model.set_source_peakabsmag(-19.0, 'f125w', 'ab')
+    set_sn_peakabsmag(sn_model, sn_type, -19.0, 'f125w', 'ab')
 
     images_with_sn = []
     images_without_sn = []
@@ -241,15 +451,27 @@ def make_images(filters, pixel_scale, sn_type, times, exptime, filt_zp, psf_comp
     gal_params = [mu_0, n_type, e_disk, pa_disk, half_l_r, offset_r, Vgm_unit, mag]
     # TODO: check if simple half-pixel dither is right and update if not
     second_gal_offets = np.empty((nfilts, 2), float)
+    # the noiseless host galaxy only depends on the filter and its dither offset, neither of
+    # which change between epochs, so we render it once for each (filter, offset) and then just
+    # add the supernova to a copy of it for each observation
+    host_images = {}
     for j in range(0, nfilts):
-        # define a random pixel offset ra/dec
-        offset_ra, offset_dec = np.random.uniform(0.01, 0.99), np.random.uniform(0.01, 0.99)
-        sign = -1 if np.random.uniform(0, 1) < 0.5 else 1
-        # non-reference image should be offset by half a pixel, wrapped around [0, 1]
-        second_gal_offets[j, 0] = (offset_ra + sign * 0.5 + 1) % 1
-        second_gal_offets[j, 1] = (offset_dec + sign * 0.5 + 1) % 1
-        image = pmf.mog_galaxy(pixel_scale, filt_zp[j], psf_comp[j], gal_params +
-                               [offset_ra, offset_dec])
+        if host_library is None:
+            # define a random pixel offset ra/dec
+            offset_ra, offset_dec = np.random.uniform(0.01, 0.99), np.random.uniform(0.01, 0.99)
+            sign = -1 if np.random.uniform(0, 1) < 0.5 else 1
+            # non-reference image should be offset by half a pixel, wrapped around [0, 1]
+            second_gal_offets[j, 0] = (offset_ra + sign * 0.5 + 1) % 1
+            second_gal_offets[j, 1] = (offset_dec + sign * 0.5 + 1) % 1
+            image = pmf.mog_galaxy(pixel_scale, filt_zp[j], psf_comp[j], gal_params +
+                                   [offset_ra, offset_dec])
+        else:
+            # library hosts come with their reference and dithered offsets already drawn
+            offset_ra, offset_dec = library_hosts['offsets'][h, library_filt_inds[j], 0]
+            second_gal_offets[j, :] = library_hosts['offsets'][h, library_filt_inds[j], 1]
+            image = get_library_host(library_hosts, library_stamps, h, filters[j], 0)
+            host_images[(j, *second_gal_offets[j, :])] = \
+                get_library_host(library_hosts, library_stamps, h, filters[j], 1)
         q = np.where(image < 0)
         image[q] = 1e-8
         image = add_background(image, zod_count[j])
@@ -285,10 +507,14 @@ def make_images(filters, pixel_scale, sn_type, times, exptime, filt_zp, psf_comp
 
             # if cosmicrays are needed then figure out what stips does for that...
             offset_ra, offset_dec = second_gal_offets[j, :]
-            image = pmf.mog_galaxy(pixel_scale, filt_zp[j], psf_comp[j],
-                                   gal_params + [offset_ra, offset_dec])
-            image = pmf.mog_add_psf(image, [rand_ra / pixel_scale, rand_dec / pixel_scale, m_ia],
-                                    filt_zp[j], psf_comp[j])
+            host_key = (j, offset_ra, offset_dec)
+            if host_key not in host_images:
+                host_images[host_key] = pmf.mog_galaxy(pixel_scale, filt_zp[j], psf_comp[j],
+                                                       gal_params + [offset_ra, offset_dec])
+            # the PSF is added to the image in place, so we must not pass the cached host directly
+            image = np.copy(host_images[host_key])
+            image = pmf.add_psf_from_table(image, [rand_ra / pixel_scale, rand_dec / pixel_scale,
+                                                   m_ia], filt_zp[j], psf_table[j])
             q = np.where(image < 0)
             image[q] = 1e-8
             image = add_background(image, zod_count[j])
@@ -309,12 +535,10 @@ def make_images(filters, pixel_scale, sn_type, times, exptime, filt_zp, psf_comp
             yind = np.floor(rand_dec / pixel_scale + y_cent).astype(int)
 
             N = 5
-            delta = np.arange(-N, N+1e-10, 1)
-            p = psf_comp[j].reshape(-1)
             # rand_* is (fractional) pixel offset from centre, so we just modulo 1 to get single
             # pixel fraction
             dx, dy = (rand_ra/pixel_scale) % 1, (rand_dec/pixel_scale) % 1
-            psf_box_sum = np.sum(pmf.psf_fit_fun(p, delta+dx, delta+dy))
+            psf_box_sum = pmf.aperture_correction(apcorr_table[j], N, dx, dy)
             # current naive sum the entire (box) 'aperture' flux of the Sn, correcting for
             # exposure time in both counts and uncertainty; also have to correct for the lost flux
             # outside of the box
@@ -343,6 +567,104 @@ def make_images(filters, pixel_scale, sn_type, times, exptime, filt_zp, psf_comp
     return images_with_sn, images_without_sn, diff_images, lc_data, sn_params, true_flux
 
 
+def make_host_library(library_root, n_hosts, filters, pixel_scale, filt_zp, psf_comp_filename):
+    # pre-render n_hosts noiseless host galaxies, each drawn from the same distributions as in
+    # make_images, at both their reference and dithered offsets in every filter. the stamps are
+    # stored per filter in a single flat array, {library_root}_{filter}.npy, which is memory
+    # mapped on loading, and the host parameters in {library_root}_hosts.npz
+    psf_comp = np.load(psf_comp_filename)
+    hosts = [draw_host_params() for _ in range(0, n_hosts)]
+    # offsets are [host, filter, reference/dithered image, ra/dec]
+    offsets = np.empty((n_hosts, len(filters), 2, 2), float)
+    for i in range(0, n_hosts):
+        for j in range(0, len(filters)):
+            offset_ra, offset_dec = np.random.uniform(0.01, 0.99), np.random.uniform(0.01, 0.99)
+            sign = -1 if np.random.uniform(0, 1) < 0.5 else 1
+            offsets[i, j, 0, :] = offset_ra, offset_dec
+            offsets[i, j, 1, 0] = (offset_ra + sign * 0.5 + 1) % 1
+            offsets[i, j, 1, 1] = (offset_dec + sign * 0.5 + 1) % 1
+    # stamp sizes only depend on offset_r, so are the same in every filter; each host takes up
+    # two consecutive stamps in the flat array
+    shapes = np.array([pmf.galaxy_image_shape(host[5], pixel_scale) for host in hosts])
+    sizes = 2 * np.prod(shapes, axis=1)
+    starts = np.cumsum(sizes) - sizes
+    for j in range(0, len(filters)):
+        stamps = np.lib.format.open_memmap('{}_{}.npy'.format(library_root, filters[j]),
+                                           mode='w+', dtype=float, shape=(int(np.sum(sizes)),))
+        for i in range(0, n_hosts):
+            for d in range(0, 2):
+                image = pmf.mog_galaxy(pixel_scale, filt_zp[j], psf_comp[j],
+                                       list(hosts[i]) + list(offsets[i, j, d]))
+                start = starts[i] + d * image.size
+                stamps[start:start + image.size] = image.ravel()
+        stamps.flush()
+        del stamps
+
+    np.savez('{}_hosts.npz'.format(library_root), filters=np.array(filters),
+             filt_zp=np.array(filt_zp), pixel_scale=pixel_scale,
+             psf_comp_filename=psf_comp_filename, psf_comp_hash=psf_comp_hash(psf_comp_filename),
+             mu_0=np.array([host[0] for host in hosts]),
+             n_type=np.array([host[1] for host in hosts]),
+             e_disk=np.array([host[2] for host in hosts]),
+             pa_disk=np.array([host[3] for host in hosts]),
+             half_l_r=np.array([host[4] for host in hosts]),
+             offset_r=np.array([host[5] for host in hosts]),
+             Vgm_unit=np.array([host[6] for host in hosts]),
+             mag=np.array([host[7] for host in hosts]),
+             offsets=offsets, shapes=shapes, starts=starts)
+
+
+# hashes of PSF component files already read by this process, keyed by (filename, mtime), as
+# for the PSF component tables, so that a file is only re-read once it has been rewritten
+psf_comp_hashes = {}
+
+
+def psf_comp_hash(psf_comp_filename):
+    key = (psf_comp_filename, os.path.getmtime(psf_comp_filename))
+    if key not in psf_comp_hashes:
+        psf_comp_hashes[key] = hashlib.sha1(np.load(psf_comp_filename).tobytes()).hexdigest()[:16]
+    return psf_comp_hashes[key]
+
+
+def host_library_matches(library_hosts, filters, pixel_scale, filt_zp, psf_comp_filename):
+    # whether a library's stamps were rendered for all of the filters, with the same zero points,
+    # pixel scale and PSF -- both the component file and, as it may have been refit or
+    # recompressed since, its contents
+    if 'psf_comp_hash' not in library_hosts or \
+            str(library_hosts['psf_comp_filename']) != psf_comp_filename or \
+            str(library_hosts['psf_comp_hash']) != psf_comp_hash(psf_comp_filename) or \
+            not np.isclose(library_hosts['pixel_scale'], pixel_scale):
+        return False
+    for filter_, zp in zip(filters, filt_zp):
+        q = np.where(library_hosts['filters'] == filter_)[0]
+        if len(q) == 0 or not np.isclose(library_hosts['filt_zp'][q[0]], zp):
+            return False
+    return True
+
+
+# host libraries already opened by this process, keyed by library_root, to avoid re-reading the
+# parameters and re-mapping the stamp files on every make_images call
+host_libraries = {}
+
+
+def load_host_library(library_root):
+    if library_root not in host_libraries:
+        with np.load('{}_hosts.npz'.format(library_root)) as f:
+            library_hosts = {q: f[q] for q in f.files}
+        library_stamps = {filter_: np.load('{}_{}.npy'.format(library_root, filter_),
+                                           mmap_mode='r')
+                          for filter_ in library_hosts['filters']}
+        host_libraries[library_root] = (library_hosts, library_stamps)
+    return host_libraries[library_root]
+
+
+def get_library_host(library_hosts, library_stamps, i, filter_, d):
+    # returns a (writeable) copy of the reference (d=0) or dithered (d=1) stamp of host i
+    shape = library_hosts['shapes'][i]
+    start = library_hosts['starts'][i] + d * np.prod(shape)
+    return np.array(library_stamps[filter_][start:start + np.prod(shape)]).reshape(shape)
+
+
 def make_fluxes(filters, sn_type, times, filt_zp, t0, exptime, psf_r, dark, readnoise):
     nfilts = len(filters)
     ntimes = len(times)
@@ -355,64 +677,43 @@ def make_fluxes(filters, sn_type, times, filt_zp, t0, exptime, psf_r, dark, read
     # pretending that F125W on WFC3/IR is 2MASS J, we set the absolute magnitude of a
     # type Ia supernova to J = -19.0 (meikle 2000). Phillips (1993) also says that ~M_I = -19 --
     # currently just setting absolute magnitudes to -19, but could change if needed
-    sn_model.set_source_peakabsmag(-19.0, 'f125w', 'ab')
+    set_sn_peakabsmag(sn_model, sn_type, -19.0, 'f125w', 'ab')
 
     # things that are needed to create the astropy.table.Table for use in fit_lc:
     # time, band (name, see registered bandpasses), flux, fluxerr [both just derived from an
     # image somehow], zp, zpsys [zeropoint and name of system]
 
-    time_array = []
-    band_array = []
-    flux_array = []
-    fluxerr_array = []
-    zp_array = []
-    zpsys_array = []
-
-    true_flux = []
-    for k in range(0, ntimes):
-        for j in range(0, nfilts):
-            if filters[j] == 'F184':
-                bkg = np.random.uniform(1, 3)
-            else:
-                bkg = np.random.uniform(0.3, 0.7)
-            time = times[k] + t0
-
-            # get the apparent magnitude of the supernova at a given time; first get the
-            # appropriate filter for the observation
-            bandpass = sncosmo.get_bandpass(filters[j])
-            # time should be in days
-            with warnings.catch_warnings():
-                warnings.filterwarnings('ignore', message='divide by zero encountered in log10')
-                warnings.filterwarnings('ignore', message='invalid value encountered in log10')
-                m_ia = sn_model.bandmag(bandpass, magsys='ab', time=time)
-                if np.isnan(m_ia):
-                    m_ia = -2.5 * np.log10(0.01) + filt_zp[j]
-
-            t_f = 10**(-1/2.5 * (m_ia - filt_zp[j]))
-
-            # noise floor of, say, 0.5% photometry in quadrature with shot noise and background
-            # counts in e/s/pixel, assuming a WFIRST aperture size of psf_r pix, or ~pi r^2 pixels,
-            # remembering to correct for the fact that uncertainties in fluxes are really done in
-            # photon counts, so multiply then divide by exptime
-            npix = np.pi * psf_r**2
-            _f = t_f * exptime
-            _d = dark * npix * exptime
-            _b = bkg * npix * exptime
-            _r = npix * readnoise**2
-            flux_err = np.sqrt(_f + (0.005 * _f)**2 + _b + _d + _r) / exptime
-            flux = np.random.normal(loc=t_f, scale=flux_err)
-            time_array.append(time)
-            band_array.append(filters[j])
-            flux_array.append(flux)
-            fluxerr_array.append(flux_err)
-            zp_array.append(filt_zp[j])  # filter-specific zeropoint
-            zpsys_array.append('ab')
-
-            true_flux.append(t_f)
-
-    lc_data = [np.array(time_array), np.array(band_array), np.array(flux_array),
-               np.array(fluxerr_array), np.array(zp_array), np.array(zpsys_array)]
-    true_flux = np.array(true_flux)
+    # count rates from the template bandflux tables over all epochs, giving (time, filter)
+    # arrays; time should be in days. negative fluxes have no magnitude, and are set to 0.01
+    # counts/s
+    time = np.asarray(times, dtype=float) + t0
+    zp = np.asarray(filt_zp, dtype=float)[:nfilts]
+    t_f = model_bandflux(sn_model, sn_type, filters, time, zp)
+    t_f[t_f < 0] = 0.01
+
+    # background counts in e/s/pixel, drawn for every observation at once; as before, only a
+    # filter named exactly F184 takes the higher background
+    high_bkg = np.array([filter_ == 'F184' for filter_ in filters])
+    bkg = np.random.uniform(np.where(high_bkg, 1, 0.3), np.where(high_bkg, 3, 0.7),
+                            size=(ntimes, nfilts))
+
+    # noise floor of, say, 0.5% photometry in quadrature with shot noise and background
+    # counts in e/s/pixel, assuming a WFIRST aperture size of psf_r pix, or ~pi r^2 pixels,
+    # remembering to correct for the fact that uncertainties in fluxes are really done in
+    # photon counts, so multiply then divide by exptime
+    npix = np.pi * psf_r**2
+    _f = t_f * exptime
+    _d = dark * npix * exptime
+    _b = bkg * npix * exptime
+    _r = npix * readnoise**2
+    flux_err = np.sqrt(_f + (0.005 * _f)**2 + _b + _d + _r) / exptime
+    flux = np.random.normal(loc=t_f, scale=flux_err)
+
+    # observations are ordered by time, and by filter within each time, with filter-specific
+    # zeropoints
+    lc_data = [np.repeat(time, nfilts), np.tile(np.asarray(filters), ntimes), flux.reshape(-1),
+               flux_err.reshape(-1), np.tile(zp, ntimes), np.full(ntimes * nfilts, 'ab')]
+    true_flux = t_f.reshape(-1)
 
     param_names = ['z', 't0', 'amplitude']
     sn_params = np.array([sn_model[q] for q in param_names])
@@ -420,6 +721,72 @@ def make_fluxes(filters, sn_type, times, filt_zp, t0, exptime, psf_r, dark, read
     return lc_data, sn_params, true_flux
 
 
+def make_population_fluxes(filters, sn_types, zs, t0s, times, filt_zp, exptime, psf_r, dark,
+                           readnoise):
+    # simulates the light curves of N supernovae in one call, as make_fluxes, of types sn_types at
+    # redshifts zs and times t0s, each (N,), observed in every filter at times relative to t0,
+    # either a shared (n_epoch,) cadence or one (N, n_epoch) per supernova. only one model is made
+    # per type, normalised to its cached peak absolute magnitude: as set_sn_peakabsmag, the
+    # amplitude of each supernova is then that scaled by its distance modulus. the observations
+    # of all supernovae of a type in a filter are interpolated from its bandflux table at once,
+    # with only those off the table from sncosmo, one supernova at a time. returns the light
+    # curves as flat columns -- sn (the index of the supernova), time, band, flux, fluxerr, zp,
+    # zpsys -- ordered by supernova, then time, then filter, the (N, 3) z, t0, amplitude of each
+    # supernova and the true fluxes
+    nfilts = len(filters)
+    sn_types, zs, t0s = np.asarray(sn_types), np.asarray(zs, dtype=float), \
+        np.asarray(t0s, dtype=float)
+    if np.any(zs <= 0):
+        raise ValueError('absolute magnitude undefined when z<=0.')
+    n_sn = len(zs)
+    times = np.broadcast_to(np.asarray(times, dtype=float), (n_sn, np.shape(times)[-1]))
+    ntimes = times.shape[1]
+    zp = np.asarray(filt_zp, dtype=float)[:nfilts]
+    # every observation of a supernova, time-major as make_fluxes
+    obs_bands = np.tile(np.asarray(filters), ntimes)
+    obs_zp = np.tile(zp, ntimes)
+
+    t_f = np.empty((n_sn, ntimes, nfilts), float)
+    amplitudes = np.empty(n_sn, float)
+    distance_scale = 10**(-0.4 * WMAP9.distmod(zs).value)
+    for sn_type in np.unique(sn_types):
+        q = np.where(sn_types == sn_type)[0]
+        # amplitude at a peak absolute magnitude J = -19.0 (see make_fluxes), before distance
+        amplitudes[q] = sn_peak_amplitude(sn_type, -19.0, 'f125w', 'ab') * distance_scale[q]
+        sn_model = get_sn_model(sn_type, 0)
+        for j in range(0, nfilts):
+            t_f[q, :, j] = amplitudes[q].reshape(-1, 1) * 10**(0.4 * zp[j]) * grid_bandflux(
+                load_bandflux_grid(sn_type, filters[j]), zs[q].reshape(-1, 1), times[q])
+            for i in q[np.any(np.isnan(t_f[q, :, j]), axis=1)]:
+                n = np.isnan(t_f[i, :, j])
+                sn_model.set(z=zs[i], t0=t0s[i], amplitude=amplitudes[i])
+                t_f[i, n, j] = sn_model.bandflux(filters[j], times[i, n] + t0s[i], zp=zp[j],
+                                                 zpsys='ab')
+    sn_params = np.stack([zs, t0s, amplitudes], axis=1)
+    t_f = t_f.reshape(n_sn, ntimes * nfilts)
+    # as make_fluxes, observations with no defined magnitude are given 0.01 counts/s
+    t_f[t_f < 0] = 0.01
+
+    high_bkg = np.array([filter_ == 'F184' for filter_ in obs_bands])
+    bkg = np.random.uniform(np.where(high_bkg, 1, 0.3), np.where(high_bkg, 3, 0.7),
+                            size=t_f.shape)
+    npix = np.pi * psf_r**2
+    _f = t_f * exptime
+    _d = dark * npix * exptime
+    _b = bkg * npix * exptime
+    _r = npix * readnoise**2
+    flux_err = np.sqrt(_f + (0.005 * _f)**2 + _b + _d + _r) / exptime
+    flux = np.random.normal(loc=t_f, scale=flux_err)
+
+    n_obs = ntimes * nfilts
+    obs_times = np.repeat(times + t0s.reshape(-1, 1), nfilts, axis=1)
+    lc_data = [np.repeat(np.arange(0, n_sn), n_obs), obs_times.reshape(-1),
+               np.tile(obs_bands, n_sn), flux.reshape(-1), flux_err.reshape(-1),
+               np.tile(obs_zp, n_sn), np.full(n_sn * n_obs, 'ab')]
+
+    return lc_data, sn_params, t_f.reshape(-1)
+
+
 @profile
 def fit_lc(lc_data, sn_types, directory, filters, figtext, ncol, minsnr, sn_priors,
            filt_zp, make_fit_figs, multi_z_fit, type_ind, sn_params):
@@ -435,41 +802,23 @@ def fit_lc(lc_data, sn_types, directory, filters, figtext, ncol, minsnr, sn_prio
         sn_model = get_sn_model(sn_type, 0)
 
         # place upper limits on the redshift probeable, by finding the z at which each filter drops
-        # out of being in overlap with the model
-        z_upper_band = np.empty(len(filters), float)
-        for p in range(0, len(filters)):
-            z = 0
-            while sn_model.bandoverlap(filters[p], z=z):
-                z += dz
-                if z > largest_z:
-                    break  # otherwise this will just keep going forever for very red filters
-            z_upper_band[p] = min(largest_z, z - dz)
-        z_upper_count = np.empty(len(filters), float)
-        z_lower_count = np.empty(len(filters), float)
+        # out of being in overlap with the model.
         # the lower limits on z -- for this model -- are, assuming a minsnr detection in that
         # filter, a model flux in the given system of, say, 0.0001 counts/s; a very low goal, but
         # one that avoids bluer SNe being selected when they would drop out of the detection. Also
         # avoids models from failing to calculate an amplitude... Similarly, we can calculate the
         # maximum redshift for a blue filter to have a "detection". If there is no detection in
         # this filter, we set the redshift range to its maximum to remove the filter from
-        # consideration.
+        # consideration. all but the detection depend only on the template, filter and zero
+        # point, so are looked up from get_fit_lc_z_limits
+        z_upper_band = np.empty(len(filters), float)
+        z_upper_count = np.empty(len(filters), float)
+        z_lower_count = np.empty(len(filters), float)
         for p in range(0, len(filters)):
-            z_array = np.arange(0, z_upper_band[p]+1e-10, dz)
+            z_upper_band[p], z_range, z_count = get_fit_lc_z_limits(
+                sn_type, filters[p], filt_zp[p], largest_z, dz, min_counts)
             snr_filt = lc_data['flux'].data[p] / lc_data['fluxerr'].data[p]
-            if snr_filt < minsnr:
-                z_upper_count[p] = z_array[-1]
-                z_lower_count[p] = z_array[0]
-                continue
-            countrate = np.empty_like(z_array)
-            for q, z_init in enumerate(z_array):
-                sn_model.set(z=z_init)
-                countrate[q] = sn_model.bandflux(filters[p], time=0, zp=filt_zp[p], zpsys='ab')
-            if len(np.where(countrate > min_counts)[0]) > 0:
-                z_upper_count[p] = z_array[np.where(countrate > min_counts)[0][-1]]
-                z_lower_count[p] = z_array[np.where(countrate > min_counts)[0][0]]
-            else:
-                z_upper_count[p] = z_array[-1]
-                z_lower_count[p] = z_array[0]
+            z_lower_count[p], z_upper_count[p] = z_range if snr_filt < minsnr else z_count
         # set the bounds on z to be at most the smallest of those available by the given filters in
         # the set being fit here
         z_min = np.amax(z_lower_count)
@@ -568,7 +917,7 @@ def run_filt_cadence_combo(p, directory, sn_types, filters, pixel_scale, filt_zp
                            psf_comp_filename, dark_current, readnoise, t0, lambda_eff,
                            make_sky_figs, make_fit_figs, make_flux_figs, image_flag, multi_z_fit,
                            psf_r, draw_sn_types, max_interval, min_offset,
-                           max_offset):
+                           max_offset, host_library):
     logexptime, t_interval, _n_obs = p
     n_obs = int(np.rint(_n_obs))
     exptime = 10**logexptime
@@ -596,7 +945,8 @@ def run_filt_cadence_combo(p, directory, sn_types, filters, pixel_scale, filt_zp
     if image_flag:
         images_with_sn, images_without_sn, diff_images, lc_data, sn_params, true_flux = \
             make_images(filters, pixel_scale, sn_types[type_ind], times, exptime, filt_zp,
-                        psf_comp_filename, dark_current, readnoise, t0, lambda_eff)
+                        psf_comp_filename, dark_current, readnoise, t0, lambda_eff,
+                        host_library=host_library)
     else:
         lc_data, sn_params, true_flux = make_fluxes(filters, sn_types[type_ind], times,
                                                     filt_zp, t0, exptime, psf_r, dark_current,
@@ -667,7 +1017,9 @@ if __name__ == '__main__':
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    psf_comp_filename = '../PSFs/wfirst_psf_comp.npy'
+    # renders with the fewest-component PSF mixture from psf_mog_fitting.compress_psf_comp within
+    # these residual and flux tolerances, or the full fit if there is none
+    psf_comp_filename = pmf.select_psf_comp_tier('../PSFs/wfirst_psf_comp.npy', 1e-3, 1e-3)
 
     filters_master = np.array(['z087', 'y106', 'w149', 'j129', 'h158', 'f184'])  # 'r062'
     colours_master = np.array(['k', 'r', 'b', 'g', 'c', 'm', 'orange'])
@@ -718,6 +1070,18 @@ if __name__ == '__main__':
     make_sky_figs, make_flux_figs, image_flag = False, False, False
     make_fit_figs, multi_z_fit = False, False
 
+    # in image mode hosts can be drawn from a pre-rendered library instead of being created for
+    # each lnprob call; set to None to always render new hosts
+    host_library, n_library_hosts = None, 3000
+    # the library is rebuilt if it is missing or was rendered with different filters or PSF
+    if image_flag and host_library is not None and (not os.path.isfile(
+            '{}_hosts.npz'.format(host_library)) or not host_library_matches(
+            load_host_library(host_library)[0], filters_master, pixel_scale, filt_zp_master,
+            psf_comp_filename)):
+        host_libraries.pop(host_library, None)
+        make_host_library(host_library, n_library_hosts, filters_master, pixel_scale,
+                          filt_zp_master, psf_comp_filename)
+
     sub_inds_combos = [[0], [1], [2], [3], [4], [5],
                        [0, 1], [0, 2], [0, 3], [0, 4], [0, 5],
                        [1, 2], [1, 3], [1, 4], [1, 5],
@@ -737,7 +1101,7 @@ if __name__ == '__main__':
             args = (directory, sn_types, filters, pixel_scale, filt_zp, psf_comp_filename,
                     dark_current, readnoise, t0, lambda_eff, make_sky_figs, make_fit_figs,
                     make_flux_figs, image_flag, multi_z_fit, psf_r, draw_sn_types,
-                    max_interval, min_offset, max_offset)
+                    max_interval, min_offset, max_offset, host_library)
 
             subname = ''
             for f in filters:
@@ -104,13 +104,20 @@ def faintest_sn(sn_types, filters, filt_minmags, exptime, filt_zp, snr_det, psf_
     for sn_type in sn_types:
         sn_model = sn.get_sn_model(sn_type, 1)
         for filt, filt_minmag in zip(filters, filt_minmags):
-            z = 0
-            sn_model.set(z=z)
-            while (sn_model.bandoverlap(filt) and sn_model.bandmag(filt, 'ab',
-                   sn_model.source.peakphase(filt)) < filt_minmag):
-                sn_model.set(z=z)
-                z += 0.01
-            if sn_model.bandoverlap(filt):
+            # step up in redshift, through the template's bandflux table, until the peak falls
+            # below the detection limit or the filter drops out of overlap with the model
+            grid = sn.load_bandflux_grid(sn_type, filt)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mags = -2.5 * np.log10(sn_model['amplitude'] * sn.grid_bandflux(
+                    grid, grid['z'], sn_model.source.peakphase(filt)))
+            overlap = ~np.isnan(grid['flux'][:, 0])
+            detected = overlap & (mags < filt_minmag)
+            if np.all(detected):
+                print(sn_type, filt, 'z>{:.2f}'.format(grid['z'][-1]), 'beyond table')
+                continue
+            k = np.argmin(detected)
+            z = 0 if k == 0 else grid['z'][k] + 0.01
+            if overlap[k]:
                 print(sn_type, filt, 'z={:.2f}'.format(z), 'mag loss')
             else:
                 print(sn_type, filt, 'z={:.2f}'.format(z), 'wavelength loss')
@@ -0,0 +1,528 @@
+import numpy as np
+import os
+import pytest
+import astropy.io.fits as pyfits
+from multiprocessing import shared_memory
+
+import psf_mog_fitting as pmf
+
+# (N, 6) mux, muy, sx, sy, rho, c components: one narrower than a pixel, one correlated and
+# one wide enough to run off the stamp
+psf_c = np.array([[0.1, -0.2, 0.3, 0.25, 0.0, 0.5],
+                  [-0.3, 0.4, 1.5, 0.8, 0.6, 0.3],
+                  [0.0, 0.0, 6.0, 5.0, -0.2, 0.2]])
+
+
+@pytest.mark.parametrize('n_sigma', [1, 3, 5])
+@pytest.mark.parametrize('offset', [(0, 0), (0.45, 0.45), (7.3, -4.6)])
+def test_mog_render_truncated_dropped_flux(n_sigma, offset):
+    # the truncated render is mog_render's inside each component's box, and plus the flux it
+    # reports as dropped recovers the flux of the components
+    x, y = np.arange(0, 25, dtype=float), np.arange(0, 27, dtype=float)
+    mks, Vks, pks = pmf.psf_comp_to_mog(psf_c)
+    mus = mks + np.array([12 + offset[0], 13 + offset[1]])
+    image = pmf.mog_render(x, y, mus, Vks, pks)
+    image_trunc, dropped_flux = pmf.mog_render_truncated(x, y, mus, Vks, pks, n_sigma)
+    assert np.all(image_trunc <= image * (1 + 1e-12))
+    assert np.isclose(np.sum(image_trunc) + dropped_flux, np.sum(pks), rtol=1e-12, atol=0)
+    # boxes covering the whole image drop nothing from it
+    image_trunc, _ = pmf.mog_render_truncated(x, y, mus, Vks, pks, 100)
+    assert np.allclose(image_trunc, image, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('n_sigma', [1, 3, 5])
+def test_mog_render_truncated_resolved(n_sigma):
+    # for components wider than a pixel and well inside the image, the dropped flux is the flux
+    # mog_render puts outside the boxes -- up to the sampling error of the narrowest, ~1e-9 --
+    # with the boxes spread over several size groups
+    x, y = np.arange(0, 101, dtype=float), np.arange(0, 99, dtype=float)
+    mus = np.array([[50.2, 49.1], [30.7, 60.3], [55.0, 45.5], [48.0, 51.0]])
+    psf_c_ = np.array([[0, 0, 1.0, 1.2, 0.3, 0.4], [0, 0, 2.5, 1.5, -0.5, 0.1],
+                       [0, 0, 4.0, 6.0, 0.1, 0.3], [0, 0, 8.0, 7.0, 0.0, 0.2]])
+    _, Vks, pks = pmf.psf_comp_to_mog(psf_c_)
+    image = pmf.mog_render(x, y, mus, Vks, pks)
+    image_trunc, dropped_flux = pmf.mog_render_truncated(x, y, mus, Vks, pks, n_sigma)
+    assert np.isclose(np.sum(image) - np.sum(image_trunc), dropped_flux, rtol=0, atol=1e-8)
+
+
+@pytest.mark.parametrize('n_sigma', [1, 3, 5])
+def test_mog_galaxy_truncated_dropped_flux(n_sigma):
+    # as above, through mog_galaxy's half-light radius scaling and mog_add_psf, in counts/s
+    pixel_scale, filt_zp, mag = 0.11, 26.41, 22.0
+    flux = 10**(-1/2.5 * (mag - filt_zp)) * np.sum(psf_c[:, 5])
+    gal_params = [20.9, 1, 0.7, 0.3, 0.4, 1.2, np.array([[1.3, 0.2], [0.2, 0.6]]), mag, 0.3,
+                  -0.2]
+    image_trunc, dropped_flux = pmf.mog_galaxy(pixel_scale, filt_zp, psf_c, gal_params,
+                                               n_sigma=n_sigma)
+    assert np.isclose(np.sum(image_trunc) + dropped_flux, flux, rtol=1e-12, atol=0)
+
+    image_trunc, dropped_flux = pmf.mog_add_psf(np.zeros((25, 25), float), [0.45, -0.3, mag],
+                                                filt_zp, psf_c, n_sigma=n_sigma)
+    assert np.isclose(np.sum(image_trunc) + dropped_flux, flux, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('offset', [(0, 0), (2.25, -3.5), (-4.875, 0.125)])
+def test_add_psf_from_table_on_grid(tmp_path, offset):
+    # at the table's sub-pixel offsets the stamps are mog_add_psf's image within the stamp, and
+    # nothing is added outside it
+    n_sub, half_width, filt_zp, mag = 8, 12, 26.41, 22.0
+    psf_comp_filename = str(tmp_path / 'psf_comp.npy')
+    np.save(psf_comp_filename, np.array([psf_c, psf_c[::-1]]))
+    psf_table = pmf.load_psf_stamp_table(psf_comp_filename, n_sub=n_sub, half_width=half_width)
+    assert np.all(psf_table == pmf.make_psf_stamp_table(np.array([psf_c, psf_c[::-1]]), n_sub,
+                                                        half_width))
+    image = pmf.mog_add_psf(np.zeros((41, 41), float), [offset[0], offset[1], mag], filt_zp,
+                            psf_c)
+    image_table = pmf.add_psf_from_table(np.zeros((41, 41), float), [offset[0], offset[1], mag],
+                                         filt_zp, psf_table[0])
+    x_ind, y_ind = int(np.floor(20 + offset[0])), int(np.floor(20 + offset[1]))
+    stamp = np.zeros((41, 41), bool)
+    stamp[x_ind - half_width:x_ind + half_width + 1, y_ind - half_width:y_ind + half_width + 1] = 1
+    assert np.allclose(image_table[stamp], image[stamp], rtol=0, atol=1e-12 * np.amax(image))
+    assert np.all(image_table[~stamp] == 0)
+
+
+def test_add_psf_from_table_off_grid():
+    # between the sub-pixel offsets the stamps are bilinearly interpolated, with an error which
+    # falls as 1/n_sub**2 for a PSF resolved by the pixels
+    filt_zp, psf_params = 26.41, [1.3, -0.71, 22.0]
+    image = pmf.mog_add_psf(np.zeros((41, 41), float), psf_params, filt_zp, psf_c[1:])
+    errs = []
+    for n_sub in [8, 16]:
+        psf_table = pmf.make_psf_stamp_table(np.array([psf_c[1:]]), n_sub, 20)
+        image_table = pmf.add_psf_from_table(np.zeros((41, 41), float), psf_params, filt_zp,
+                                             psf_table[0])
+        errs.append(np.amax(np.abs(image_table - image)) / np.amax(image))
+    assert errs[0] < 1e-2 and errs[1] < errs[0] / 3
+
+
+def test_aperture_correction_table(tmp_path):
+    # the fraction of the PSF in each box is the direct sum of psf_fit_fun over its pixels, and
+    # aperture_correction interpolates between the sub-pixel offsets
+    n_sub, max_half_width = 4, 6
+    psf_comp_filename = str(tmp_path / 'psf_comp.npy')
+    np.save(psf_comp_filename, np.array([psf_c, psf_c[::-1]]))
+    apcorr_table = pmf.load_aperture_correction_table(psf_comp_filename, n_sub=n_sub,
+                                                      max_half_width=max_half_width)
+    for k, psf_c_ in enumerate([psf_c, psf_c[::-1]]):
+        for N in [0, 1, 3, 6]:
+            d = np.arange(-N, N + 1)
+            for i in range(0, n_sub + 1):
+                for j in range(0, n_sub + 1):
+                    box = pmf.psf_fit_fun(psf_c_.reshape(-1), d + i / n_sub, d + j / n_sub)
+                    assert np.isclose(apcorr_table[k, N, i, j], np.sum(box), rtol=1e-12, atol=0)
+                    assert pmf.aperture_correction(apcorr_table[k], N, i / n_sub, j / n_sub) == \
+                        pytest.approx(apcorr_table[k, N, i, j], rel=1e-12)
+    corners = apcorr_table[0, 3, 1:3, 2:4]
+    apcorr = pmf.aperture_correction(apcorr_table[0], 3, 1.5 / n_sub, 2.5 / n_sub)
+    assert np.isclose(apcorr, np.mean(corners), rtol=1e-12, atol=0)
+
+
+def numerical_gradient(fun, p, h=1e-6):
+    # central finite differences of the scalar fun at p
+    grad = np.empty(len(p), float)
+    for i in range(0, len(p)):
+        dp = np.zeros(len(p), float)
+        dp[i] = h
+        grad[i] = (fun(p + dp) - fun(p - dp)) / (2 * h)
+    return grad
+
+
+@pytest.mark.parametrize('p', [psf_c.reshape(-1), [0.3, -0.1, 0.9, 1.4, -0.7, 0.6,
+                                                   -0.2, 0.3, 0.5, 0.4, 0.4, 0.3]])
+def test_psf_fit_min_gradient(p):
+    # the analytic gradient of the objective against finite differences, on an image the
+    # parameters do not fit, so that every gradient term is exercised
+    x, y = np.arange(-6, 6.01, 0.25), np.arange(-5, 5.01, 0.25)
+    z = pmf.psf_fit_fun([0.1, 0.1, 1.1, 0.9, 0.2, 1], x, y)
+    p = np.array(p, dtype=float)
+    _, jac = pmf.psf_fit_min(p, x, y, z)
+    jac_num = numerical_gradient(lambda q: pmf.psf_fit_min(q, x, y, z)[0], p)
+    assert np.allclose(jac, jac_num, rtol=1e-5, atol=1e-8)
+
+
+# a two-component PSF image, sampled finely enough and far enough out for either fitter to
+# recover it, the bounds psf_mog_fitting sets on the components, and a start near the truth
+p_fit = np.array([[0.1, -0.2, 0.7, 0.6, 0.2, 0.6], [-0.3, 0.4, 1.6, 1.2, -0.3, 0.35]])
+x_fit, y_fit = np.arange(-9, 9.01, 0.25), np.arange(-8.5, 8.51, 0.25)
+z_fit = pmf.psf_fit_fun(p_fit.reshape(-1), x_fit, y_fit)
+g_fit = np.sum(p_fit[:, 5])
+bounds_fit = [(x_fit[0], x_fit[-1]), (y_fit[0], y_fit[-1]), (1e-1, 3), (1e-1, 3), (-0.9, 0.9),
+              (None, None)] * 2
+x0_fit = (p_fit + np.array([0.2, -0.1, 0.1, -0.1, 0.1, 0.05])).reshape(-1)
+
+
+def fit_task(engine, niters=3, x0=x0_fit, bounds=bounds_fit, checkpoint=None):
+    # a single chain of psf_fit_task on the image above, as psf_mog_fitting submits it
+    return [0, 0, 0, engine, 'random', 2, x0, niters, bounds, g_fit, 0.5, 0.01, None, checkpoint]
+
+
+def sorted_comp(p):
+    # components in order of decreasing weight, as p_fit
+    p = np.asarray(p).reshape(-1, 6)
+    return p[np.argsort(-p[:, 5])]
+
+
+def test_psf_residuals_jacobian():
+    # the residual jacobian, through the reparameterised last weight, against finite differences
+    resids = pmf.PsfResiduals(x_fit, y_fit, z_fit, g_fit)
+    q, h = x0_fit[:-1], 1e-6
+    assert np.isclose(np.sum(resids.full_params(q)[5::6]), g_fit, rtol=1e-12, atol=0)
+    jac_num = np.empty((z_fit.size, len(q)), float)
+    for i in range(0, len(q)):
+        dq = np.zeros(len(q), float)
+        dq[i] = h
+        jac_num[:, i] = (resids.residuals(q + dq) - resids.residuals(q - dq)) / (2 * h)
+    assert np.allclose(resids.jacobian(q), jac_num, rtol=0, atol=1e-6 * np.amax(np.abs(jac_num)))
+
+
+def test_psf_lsq_fit(monkeypatch):
+    # the least-squares engine recovers the components, keeping their total flux exactly, with
+    # its objective that of psf_fit_min, comparable with basinhopping's
+    monkeypatch.setattr(pmf, 'psf_fit_images', {(0, 0): (x_fit, y_fit, z_fit)}, raising=False)
+    _, _, res = pmf.psf_fit_task(fit_task('lsq'))
+    assert np.allclose(sorted_comp(res.x), p_fit, rtol=0, atol=1e-8)
+    assert np.isclose(np.sum(res.x[5::6]), g_fit, rtol=1e-12, atol=0)
+    assert np.isclose(res.fun, pmf.psf_fit_min(res.x, x_fit, y_fit, z_fit)[0], rtol=1e-6,
+                      atol=1e-20)
+    assert res.nit == 3 and res.nfev > 0
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_psf_em_fit(seed):
+    # EM from its own random start recovers the components, to within the sampling of the image,
+    # with the weights summing to the given flux; warm-started from them it stays there
+    np.random.seed(seed)
+    p, n_iter = pmf.psf_em_fit(x_fit, y_fit, z_fit, 2, g_fit)
+    assert np.allclose(sorted_comp(p), p_fit, rtol=0, atol=1e-3)
+    assert np.isclose(np.sum(p[5::6]), g_fit, rtol=1e-12, atol=0)
+    p, n_iter_warm = pmf.psf_em_fit(x_fit, y_fit, z_fit, 2, g_fit, p0=p_fit.reshape(-1))
+    assert np.allclose(p, p_fit.reshape(-1), rtol=0, atol=1e-5)
+    assert n_iter_warm < n_iter
+
+
+def test_psf_fit_task_em(monkeypatch):
+    # the EM engine returns a single-step result within the fit's bounds, here holding the wider
+    # component's x sigma below its true value, with psf_fit_min's objective
+    monkeypatch.setattr(pmf, 'psf_fit_images', {(0, 0): (x_fit, y_fit, z_fit)}, raising=False)
+    bounds = [b if i % 6 != 2 else (1e-1, 1.5) for i, b in enumerate(bounds_fit)]
+    _, _, res = pmf.psf_fit_task(fit_task('em', bounds=bounds))
+    assert np.all(res.x == pmf.clip_to_bounds(res.x, bounds))
+    assert sorted_comp(res.x)[1, 2] == 1.5
+    assert res.fun == pmf.psf_fit_min(res.x, x_fit, y_fit, z_fit)[0]
+    assert res.nfev == 1 and res.nit == 1
+
+
+@pytest.mark.parametrize('factor', [2, 3, 4])
+def test_block_mean_psf_coarse_to_fine(monkeypatch, factor):
+    # block means conserve the flux of the image, sum z dx dy, on a grid factor times coarser;
+    # the fit to the downsample is close to the components, and warm-starts a fit on the
+    # native grid recovering them, as psf_mog_fitting runs its levels
+    x, y, z = pmf.block_mean_psf(x_fit, y_fit, z_fit, factor)
+    assert len(x) == len(x_fit) // factor and len(y) == len(y_fit) // factor
+    assert np.allclose(np.diff(x), factor * 0.25, rtol=1e-12, atol=0)
+    assert np.allclose(np.diff(y), factor * 0.25, rtol=1e-12, atol=0)
+    assert np.isclose(np.sum(z) * (factor * 0.25)**2, np.sum(z_fit) * 0.25**2, rtol=1e-8, atol=0)
+    monkeypatch.setattr(pmf, 'psf_fit_images', {(0, 0): (x, y, z), (0, 1): (x_fit, y_fit, z_fit)},
+                        raising=False)
+    _, _, res = pmf.psf_fit_task(fit_task('lsq'))
+    assert np.allclose(sorted_comp(res.x), p_fit, rtol=0, atol=0.1)
+    task = fit_task('lsq', niters=1, x0=res.x)
+    task[1] = 1
+    _, _, res = pmf.psf_fit_task(task)
+    assert np.allclose(sorted_comp(res.x), p_fit, rtol=0, atol=1e-6)
+
+
+def test_psf_fit_pool_shared_images(monkeypatch):
+    # cut-outs written into shared memory by the layout of psf_mog_fitting are read back
+    # unchanged by an attached worker, whose tasks then fit them as if they were passed directly
+    fit_images = {(0, 0): pmf.block_mean_psf(x_fit, y_fit, z_fit, 2),
+                  (0, 1): (x_fit, y_fit, z_fit), (1, 0): (x_fit[:5], y_fit[:3], z_fit[:3, :5])}
+    layout, size = {}, 0
+    for key, (x, y, z) in fit_images.items():
+        layout[key] = (size, len(x), len(y))
+        size += len(x) + len(y) + z.size
+    shm = shared_memory.SharedMemory(create=True, size=size * 8)
+    monkeypatch.setattr(pmf, 'psf_fit_shm', None, raising=False)
+    monkeypatch.setattr(pmf, 'psf_fit_images', None, raising=False)
+    try:
+        for key, (x, y, z) in pmf.shared_psf_images(shm.buf, layout).items():
+            x[:], y[:], z[:] = fit_images[key]
+        del x, y, z
+        pmf.psf_fit_pool_init(shm.name, layout)
+        for key, images in fit_images.items():
+            for a, b in zip(pmf.psf_fit_images[key], images):
+                assert np.all(a == b)
+        task = fit_task('lsq', niters=1, x0=p_fit.reshape(-1))
+        task[1] = 1
+        _, _, res = pmf.psf_fit_task(task)
+        assert np.allclose(res.x, p_fit.reshape(-1), rtol=0, atol=1e-8)
+    finally:
+        # the views into the block must be released before it can be closed
+        pmf.psf_fit_images = None
+        if pmf.psf_fit_shm is not None:
+            pmf.psf_fit_shm.close()
+        shm.close()
+        shm.unlink()
+
+
+def test_legacy_psf_comp_filters():
+    # the committed components were written before the _fit.npz record, so are read in the
+    # hard-coded legacy filter order, which must have one entry per set of components
+    psf_comp_filename = os.path.join(os.path.dirname(__file__), '../PSFs/wfirst_psf_comp.npy')
+    if not os.path.isfile(psf_comp_filename):
+        pytest.skip('no committed PSF components')
+    assert not os.path.isfile(pmf.psf_comp_fit_filename(psf_comp_filename))
+    assert len(np.load(psf_comp_filename)) == len(pmf.legacy_psf_comp_filters)
+    assert len(set(pmf.legacy_psf_comp_filters)) == len(pmf.legacy_psf_comp_filters)
+
+
+def test_load_psf_comp_seeds(tmp_path):
+    # distinct components per filter, the wide component last
+    psf_comp = np.array([np.append(psf_c + 0.01 * i, [[0, 0, 6.6, 6.6, 0, 0.1]], axis=0)
+                         for i in range(0, len(pmf.legacy_psf_comp_filters))])
+    psf_comp_filename = str(tmp_path / 'psf_comp.npy')
+    filters = ['y106', 'z087_SCA01_4_4', 'r062']
+    assert pmf.load_psf_comp_seeds(psf_comp_filename, filters) == [None] * 3
+
+    # without a _fit.npz record the sets are in the legacy order
+    np.save(psf_comp_filename, psf_comp)
+    seeds = pmf.load_psf_comp_seeds(psf_comp_filename, filters)
+    legacy = pmf.legacy_psf_comp_filters
+    assert seeds[0][1] and np.all(seeds[0][0] == psf_comp[legacy.index('y106'), :-1].reshape(-1))
+    # grid nodes take their filter's fit, but not as their own
+    assert not seeds[1][1]
+    assert np.all(seeds[1][0] == psf_comp[legacy.index('z087'), :-1].reshape(-1))
+    # other filters take the nearest in wavelength, positions and widths scaled by wavelength
+    p = np.copy(psf_comp[legacy.index('z087'), :-1])
+    p[:, :4] *= 0.62 / 0.87
+    assert not seeds[2][1] and np.allclose(seeds[2][0], p.reshape(-1), rtol=1e-12, atol=0)
+
+    # with a record, its filter order is used instead
+    stored = legacy[::-1]
+    np.savez(pmf.psf_comp_fit_filename(psf_comp_filename), filters=np.array(stored))
+    seeds = pmf.load_psf_comp_seeds(psf_comp_filename, filters)
+    assert seeds[0][1] and np.all(seeds[0][0] == psf_comp[stored.index('y106'), :-1].reshape(-1))
+
+
+@pytest.mark.parametrize('N', [1, 3, 5])
+def test_resize_psf_x0(N):
+    p = pmf.resize_psf_x0(psf_c.reshape(-1), N, 2.0).reshape(-1, 6)
+    assert p.shape == (N, 6)
+    assert np.isclose(np.sum(p[:, 5]), 2.0, rtol=1e-12, atol=0)
+    if N <= len(psf_c):
+        # the highest-weight components are kept, with their shapes unchanged
+        keep = psf_c[np.argsort(-psf_c[:, 5])][:N]
+        assert np.all(p[:, :5] == keep[:, :5])
+    else:
+        # splitting a component in two along x keeps the mean position of the weights
+        p0 = pmf.resize_psf_x0(psf_c.reshape(-1), len(psf_c), 2.0).reshape(-1, 6)
+        assert np.allclose(np.sum(p[:, 5:] * p[:, :2], axis=0),
+                           np.sum(p0[:, 5:] * p0[:, :2], axis=0), rtol=1e-12, atol=1e-12)
+
+
+class ChainKilled(Exception):
+    pass
+
+
+@pytest.mark.parametrize('engine', ['basinhopping', 'lsq'])
+def test_psf_chain_checkpoint_resume(tmp_path, monkeypatch, engine):
+    # a chain killed part way through continues from its checkpoint for the iterations it had
+    # left, keeping the evaluations of both runs, and once finished is loaded rather than rerun.
+    # checkpoints saved under another key are ignored. the image has a third component, which
+    # the two fitted cannot follow, so the chain's best objective is well away from zero
+    z = z_fit + pmf.psf_fit_fun([2.0, 1.0, 0.5, 3.0, 0.0, 0.1], x_fit, y_fit)
+    monkeypatch.setattr(pmf, 'psf_fit_images', {(0, 0): (x_fit, y_fit, z)}, raising=False)
+    checkpoint = (str(tmp_path / 'chain.npz'), 'key')
+    call = pmf.PsfChainCheckpoint.__call__
+
+    def killed_call(self, x, f, accept):
+        stop = call(self, x, f, accept)
+        if self.nit == 2:
+            raise ChainKilled
+        return stop
+
+    monkeypatch.setattr(pmf.PsfChainCheckpoint, '__call__', killed_call)
+    with pytest.raises(ChainKilled):
+        pmf.psf_fit_task(fit_task(engine, niters=5, checkpoint=checkpoint))
+    saved = pmf.PsfChainCheckpoint(*checkpoint)
+    assert saved.nit == 2 and saved.nfev > 0 and not saved.done
+    assert np.isclose(saved.f_best, pmf.psf_fit_min(saved.x_best, x_fit, y_fit, z)[0],
+                      rtol=1e-9, atol=0)
+    assert pmf.PsfChainCheckpoint(checkpoint[0], 'other key').x_best is None
+
+    monkeypatch.setattr(pmf.PsfChainCheckpoint, '__call__', call)
+    _, _, res = pmf.psf_fit_task(fit_task(engine, niters=5, checkpoint=checkpoint))
+    assert res.nit == 5 and res.nfev > saved.nfev and res.fun <= saved.f_best
+    assert pmf.PsfChainCheckpoint(*checkpoint).done
+    _, _, res_done = pmf.psf_fit_task(fit_task(engine, niters=5, checkpoint=checkpoint))
+    assert np.all(res_done.x == res.x) and res_done.fun == res.fun
+    assert res_done.nfev == res.nfev and res_done.nit == res.nit
+
+
+# six core components, of both signs and some near-duplicates, and the fit's wide component
+psf_c_full = np.array([[0.05, -0.1, 0.4, 0.35, 0.1, 0.35], [0.1, 0.0, 0.45, 0.4, 0.0, 0.2],
+                       [-0.2, 0.3, 1.2, 0.9, 0.3, 0.15], [0.3, -0.2, 1.4, 1.0, -0.2, 0.1],
+                       [0.0, 0.0, 3.0, 2.5, 0.0, 0.08], [0.0, 0.1, 2.0, 2.2, 0.1, -0.02],
+                       [0.0, 0.0, 12.0, 12.0, 0.0, 0.1]])
+
+
+def field_node_comp(k_x, k_y):
+    # components of a node varying smoothly over the detector, the wide component unchanged
+    psf_c_ = np.concatenate([psf_c_full[:4], psf_c_full[-1:]])
+    psf_c_[:-1, :2] += [0.02 * k_x, -0.03 * k_y]
+    psf_c_[:-1, 2:4] *= 1 + 0.04 * k_x + 0.02 * k_y
+    psf_c_[:-1, 5] *= 1 - 0.01 * k_x * k_y
+    return psf_c_
+
+
+def test_field_psf_comp(tmp_path, monkeypatch):
+    # each node is fit independently, so is stored with its components in any order; loaded,
+    # they correspond to those of the first node, and field_psf_comp returns the nodes at their
+    # positions, interpolates bilinearly between them, and takes the nearest edge outside them
+    monkeypatch.setattr(pmf, 'field_psf_grids', {})
+    positions = np.array([4, 1024, 2044])
+    rng = np.random.RandomState(3)
+    orders = np.array([[[rng.permutation(4) for _ in range(0, 3)] for _ in range(0, 3)]
+                       for _ in range(0, 2)])
+    psf_comp = np.empty((1, 2, 3, 3, 5, 6), float)
+    for d in range(0, 2):
+        for k_x in range(0, 3):
+            for k_y in range(0, 3):
+                psf_c_ = field_node_comp(k_x, k_y)
+                psf_comp[0, d, k_x, k_y] = np.concatenate([psf_c_[:-1][orders[d, k_x, k_y]],
+                                                           psf_c_[-1:]])
+    grid_filename = str(tmp_path / 'field_grid.npz')
+    np.savez(grid_filename, psf_comp=psf_comp, filters=np.array(['z087']),
+             detectors=np.array(['SCA01', 'SCA02']), positions=positions)
+    psf_grid = pmf.load_field_psf_grid(grid_filename)
+    assert pmf.load_field_psf_grid(grid_filename) is psf_grid
+    for d in range(0, 2):
+        def node(k_x, k_y):
+            psf_c_ = field_node_comp(k_x, k_y)
+            return np.concatenate([psf_c_[:-1][orders[d, 0, 0]], psf_c_[-1:]])
+
+        for k_x in range(0, 3):
+            for k_y in range(0, 3):
+                assert np.all(psf_grid['psf_comp'][0, d, k_x, k_y] == node(k_x, k_y))
+                psf_c_ = pmf.field_psf_comp(psf_grid, 'z087', ['SCA01', 'SCA02'][d],
+                                            (positions[k_x], positions[k_y]))
+                assert np.allclose(psf_c_, node(k_x, k_y), rtol=1e-12, atol=0)
+        psf_c_ = pmf.field_psf_comp(psf_grid, 'z087', ['SCA01', 'SCA02'][d], (1534, 514))
+        assert np.allclose(psf_c_, (node(1, 0) + node(2, 0) + node(1, 1) + node(2, 1)) / 4,
+                           rtol=1e-12, atol=0)
+        psf_c_ = pmf.field_psf_comp(psf_grid, 'z087', ['SCA01', 'SCA02'][d], (-50, 4000))
+        assert np.allclose(psf_c_, node(0, 2), rtol=1e-12, atol=0)
+
+
+def test_reduce_psf_comp():
+    # every reduced mixture keeps the total core flux and the wide component, with the errors it
+    # reports those of its image against the full mixture's, the residual not growing with n
+    half_width, n_sub = 20, 4
+    reduced = pmf.reduce_psf_comp(psf_c_full, (2, 3, 4), half_width=half_width, n_sub=n_sub)
+    assert sorted(reduced) == [2, 3, 4]
+    x = np.arange(-half_width * n_sub, half_width * n_sub + 1) / n_sub
+    psf_image = pmf.psf_fit_fun(psf_c_full.reshape(-1), x, x)
+    res_errs = []
+    for n in [2, 3, 4]:
+        psf_c_, res_err, flux_err = reduced[n]
+        assert psf_c_.shape == (n + 1, 6)
+        assert np.isclose(np.sum(psf_c_[:-1, 5]), np.sum(psf_c_full[:-1, 5]), rtol=1e-12, atol=0)
+        assert np.all(psf_c_[-1] == psf_c_full[-1])
+        res = pmf.psf_fit_fun(psf_c_.reshape(-1), x, x) - psf_image
+        assert np.isclose(res_err, np.amax(np.abs(res)) / np.amax(psf_image), rtol=1e-9, atol=0)
+        assert np.isclose(flux_err, np.abs(np.sum(res)) / np.sum(psf_image), rtol=0, atol=1e-12)
+        assert flux_err < 1e-9
+        res_errs.append(res_err)
+    assert res_errs[0] >= res_errs[1] >= res_errs[2]
+
+
+def test_compress_psf_comp(tmp_path):
+    # the tiers written keep each filter's flux, only tiers with fewer components than the fit
+    # are made, and select_psf_comp_tier picks the smallest within tolerance, unless the
+    # components are newer than the tiers
+    psf_comp_filename = str(tmp_path / 'psf_comp.npy')
+    psf_comp = np.array([psf_c_full, psf_c_full[[1, 0, 3, 2, 5, 4, 6]] * [1, 1, 1.2, 1, 1, 1]])
+    np.save(psf_comp_filename, psf_comp)
+    pmf.compress_psf_comp(psf_comp_filename, n_comps=(2, 4, 8))
+    assert not os.path.isfile(pmf.psf_comp_tier_filename(psf_comp_filename, 8))
+    with np.load(pmf.psf_comp_tiers_filename(psf_comp_filename)) as f:
+        assert np.all(f['n_comp'] == [2, 4])
+        # the four component tier is within 1% of the peak in both filters, the two not
+        assert np.all(f['res_err'][1] < 0.01) and np.all(f['res_err'][0] > 0.01)
+        flux_err = np.amin(np.amax(f['flux_err'], axis=1))
+    for n in [2, 4]:
+        psf_comp_tier = np.load(pmf.psf_comp_tier_filename(psf_comp_filename, n))
+        assert psf_comp_tier.shape == (2, n + 1, 6)
+        assert np.allclose(np.sum(psf_comp_tier[:, :, 5], axis=1),
+                           np.sum(psf_comp[:, :, 5], axis=1), rtol=1e-12, atol=0)
+
+    assert pmf.select_psf_comp_tier(psf_comp_filename, 1, 1) == \
+        pmf.psf_comp_tier_filename(psf_comp_filename, 2)
+    assert pmf.select_psf_comp_tier(psf_comp_filename, 0.01, 1) == \
+        pmf.psf_comp_tier_filename(psf_comp_filename, 4)
+    assert pmf.select_psf_comp_tier(psf_comp_filename, 0, 1) == psf_comp_filename
+    assert pmf.select_psf_comp_tier(psf_comp_filename, 1, flux_err / 2) == psf_comp_filename
+    mtime = os.path.getmtime(pmf.psf_comp_tiers_filename(psf_comp_filename)) + 10
+    os.utime(psf_comp_filename, (mtime, mtime))
+    assert pmf.select_psf_comp_tier(psf_comp_filename, 1, 1) == psf_comp_filename
+
+
+# a PSF of two core gaussians and a faint, elongated, spike, which the MoG fit leaves to the
+# residual table, with the fit's wide component last
+psf_cores = np.array([[0.0, 0.0, 0.6, 0.5, 0.1, 0.6], [0.1, -0.1, 1.5, 1.7, -0.2, 0.25]])
+psf_spike = np.array([[0.0, 0.0, 4.0, 0.4, 0.0, 0.05]])
+psf_wide = np.array([[0.0, 0.0, 6.6, 6.6, 0.0, 0.1]])
+
+
+def write_epsf(filename, psf_c_, oversamp=4, n=181):
+    # oversampled (y, x) ePSF image of the components, centred on the middle sample
+    x = (np.arange(0, n) - (n - 1) / 2) / oversamp
+    pyfits.PrimaryHDU(pmf.psf_fit_fun(psf_c_.reshape(-1), x, x)).writeto(filename)
+
+
+def make_residual_table(tmp_path, threshold=1e-6):
+    psf_comp_filename, psf_name = str(tmp_path / 'psf_comp.npy'), str(tmp_path / 'epsf.fits')
+    np.save(psf_comp_filename, np.array([np.concatenate([psf_cores, psf_wide])]))
+    if not os.path.isfile(psf_name):
+        write_epsf(psf_name, np.concatenate([psf_cores, psf_spike]))
+    return pmf.load_psf_residual_table(psf_comp_filename, [psf_name], 4, threshold=threshold)
+
+
+@pytest.mark.parametrize('offset', [(0, 0), (0.25, -0.5), (-0.3, 0.45)])
+def test_add_psf_residual(tmp_path, offset):
+    # the cores plus the residual table reproduce the ePSF of a point source, on the oversampled
+    # grid to within the residuals zeroed by the threshold, and otherwise to within the bilinear
+    # interpolation of the spike between grid points
+    psf_residual = make_residual_table(tmp_path)[0]
+    filt_zp, psf_params = 26.41, [offset[0], offset[1], 22.0]
+    image = pmf.mog_add_psf(np.zeros((31, 29), float), psf_params, filt_zp,
+                            np.concatenate([psf_cores, psf_spike]))
+    image_res = pmf.mog_add_psf(np.zeros((31, 29), float), psf_params, filt_zp, psf_cores)
+    image_res = pmf.add_psf_residual(image_res, psf_params, filt_zp, psf_residual, 4)
+    on_grid = np.all(np.array(offset) * 4 % 1 == 0)
+    assert np.allclose(image_res, image, rtol=0, atol=(3e-6 if on_grid else 1e-2) *
+                       np.amax(image))
+
+
+def test_add_galaxy_psf_residual(tmp_path):
+    # as above, for a galaxy convolved with the PSF
+    psf_residual = make_residual_table(tmp_path)[0]
+    pixel_scale, filt_zp = 0.11, 26.41
+    gal_params = [20.9, 1, 0.7, 0.3, 0.4, 1.2, np.array([[1.3, 0.2], [0.2, 0.6]]), 22.0, 0.3,
+                  -0.2]
+    image = pmf.mog_galaxy(pixel_scale, filt_zp, np.concatenate([psf_cores, psf_spike]),
+                           gal_params)
+    image_res = pmf.mog_galaxy(pixel_scale, filt_zp, psf_cores, gal_params)
+    image_res = pmf.add_galaxy_psf_residual(image_res, pixel_scale, filt_zp, gal_params,
+                                            psf_residual, 4)
+    assert np.allclose(image_res, image, rtol=0, atol=1e-3 * np.amax(image))
+
+
+def test_load_psf_residual_table_key(tmp_path):
+    # tables made with another threshold, or from other ePSFs, are not reused
+    psf_residual = np.array(make_residual_table(tmp_path))
+    assert np.any(np.array(make_residual_table(tmp_path, threshold=1e-2)) != psf_residual)
+    psf_comp_filename, psf_name = str(tmp_path / 'psf_comp.npy'), str(tmp_path / 'epsf_2.fits')
+    write_epsf(psf_name, psf_cores)
+    assert np.all(pmf.load_psf_residual_table(psf_comp_filename, [psf_name], 4) == 0)
@@ -0,0 +1,236 @@
+import numpy as np
+import os
+import pytest
+import sncosmo
+
+import sn_sampling as sns
+import sn_sampling_extras as snse
+
+filters = np.array(['z087', 'y106', 'w149', 'j129', 'h158', 'f184'])
+filt_zp = np.array([26.39, 26.41, 27.50, 26.35, 26.41, 25.96])
+sn_types = ['Ia', 'Iat', 'Iabg', 'Ib', 'Ic', 'IIP', 'IIL', 'IIn']
+# as fit_lc
+largest_z, dz, min_counts = 1.7, 0.01, 0.0001
+
+
+@pytest.fixture(scope='module')
+def registered_filters():
+    # the WFI throughputs, read relative to the working directory as register_filters does
+    filter_files = ['../../webbpsf-data/WFI/filters/{}_throughput.fits'.format(filter_.upper())
+                    for filter_ in filters]
+    if not all(os.path.exists(filter_file) for filter_file in filter_files):
+        pytest.skip('webbpsf-data WFI filter throughputs not found')
+    snse.register_filters(filters)
+    return filters
+
+
+def baseline_z_upper_band(sn_model, filter_):
+    # fit_lc's original search, stepping z up until the filter no longer overlaps the model
+    z = 0
+    while sn_model.bandoverlap(filter_, z=z):
+        z += dz
+        if z > largest_z:
+            break
+    return min(largest_z, z - dz)
+
+
+@pytest.mark.parametrize('sn_type', sn_types)
+def test_fit_lc_z_upper_band(sn_type, registered_filters):
+    sn_model = sns.get_sn_model(sn_type, 0)
+    for filter_, zp in zip(filters, filt_zp):
+        z_upper_band, _, _ = sns.get_fit_lc_z_limits(sn_type, filter_, zp, largest_z, dz,
+                                                     min_counts)
+        assert z_upper_band == baseline_z_upper_band(sn_model, filter_)
+
+
+def baseline_z_limits(sn_model, filter_, zp, min_counts_, detected):
+    # fit_lc's original per-call (lower, upper) redshift bounds from a single filter, with and
+    # without a minsnr detection in it
+    z_array = np.arange(0, baseline_z_upper_band(sn_model, filter_)+1e-10, dz)
+    if not detected:
+        return z_array[0], z_array[-1]
+    countrate = np.empty_like(z_array)
+    for q, z_init in enumerate(z_array):
+        sn_model.set(z=z_init)
+        countrate[q] = sn_model.bandflux(filter_, time=0, zp=zp, zpsys='ab')
+    q = np.where(countrate > min_counts_)[0]
+    return (z_array[q[0]], z_array[q[-1]]) if len(q) > 0 else (z_array[0], z_array[-1])
+
+
+@pytest.mark.parametrize('sn_type', sn_types)
+def test_fit_lc_z_limits(sn_type, registered_filters):
+    # fit_lc's threshold, and one cutting into the template's range of count rates, exactly at
+    # its count rate at one of the redshift steps
+    sn_model = sns.get_sn_model(sn_type, 0)
+    for filter_, zp in zip(filters, filt_zp):
+        sn_model.set(z=0.5)
+        step_counts = sn_model.bandflux(filter_, time=0, zp=zp, zpsys='ab')
+        for min_counts_ in [min_counts, step_counts]:
+            _, z_range, z_count = sns.get_fit_lc_z_limits(sn_type, filter_, zp, largest_z, dz,
+                                                          min_counts_)
+            assert z_range == baseline_z_limits(sn_model, filter_, zp, min_counts_, False)
+            assert z_count == baseline_z_limits(sn_model, filter_, zp, min_counts_, True)
+
+
+# exposure time, aperture radius, dark current and read noise, as the main script
+exptime, psf_r, dark, readnoise = 1000, 3, 0.015, 20
+# epochs relative to t0, running off both ends of the bandflux tables to use sncosmo there
+times = np.array([-130, -20, -3.5, 0, 12.25, 40, 95, 260])
+
+
+@pytest.mark.parametrize('sn_type', ['Ia', 'IIP'])
+def test_make_fluxes(sn_type, registered_filters):
+    # the fluxes of every epoch and filter at once against sncosmo's bandflux of the same model,
+    # to within the interpolation error of the bandflux tables, ordered by time and then by
+    # filter, with uncertainties between those of the lowest and highest backgrounds drawn
+    t0 = 2.7
+    np.random.seed(5)
+    lc_data, sn_params, true_flux = sns.make_fluxes(filters, sn_type, times, filt_zp, t0,
+                                                    exptime, psf_r, dark, readnoise)
+    sn_model = sns.get_sn_model(sn_type, 1, t0=sn_params[1], z=sn_params[0])
+    sn_model.set(amplitude=sn_params[2])
+    true_flux = true_flux.reshape(len(times), len(filters))
+    for j, (filter_, zp) in enumerate(zip(filters, filt_zp)):
+        t_f = sn_model.bandflux(filter_, times + t0, zp=zp, zpsys='ab')
+        t_f[t_f < 0] = 0.01
+        grid = sns.load_bandflux_grid(sn_type, filter_)
+        peak = sn_params[2] * 10**(0.4 * zp) * np.nanmax(np.abs(grid['flux']))
+        assert np.allclose(true_flux[:, j], t_f, rtol=0, atol=2 * grid['err'] * peak)
+
+    assert np.all(lc_data[0] == np.repeat(times + t0, len(filters)))
+    assert np.all(lc_data[1] == np.tile(filters, len(times)))
+    assert np.all(lc_data[4] == np.tile(filt_zp, len(times))) and np.all(lc_data[5] == 'ab')
+    npix = np.pi * psf_r**2
+    f, d, r = true_flux.reshape(-1) * exptime, dark * npix * exptime, npix * readnoise**2
+    err_low, err_high = [np.sqrt(f + (0.005 * f)**2 + bkg * npix * exptime + d + r) / exptime
+                         for bkg in [0.3, 0.7]]
+    assert np.all((lc_data[3] >= err_low) & (lc_data[3] <= err_high))
+
+
+@pytest.mark.parametrize('sn_type', ['Ia', 'Ib', 'IIP'])
+def test_make_population_fluxes_single(sn_type, registered_filters):
+    # a population of one supernova is make_fluxes, given the same random draws
+    t0 = 2.7
+    np.random.seed(17)
+    lc_data, sn_params, true_flux = sns.make_fluxes(filters, sn_type, times, filt_zp, t0,
+                                                    exptime, psf_r, dark, readnoise)
+    np.random.seed(17)
+    z = np.random.uniform(0.2, 1.5)
+    lc_data_p, sn_params_p, true_flux_p = sns.make_population_fluxes(
+        filters, [sn_type], [z], [t0], times, filt_zp, exptime, psf_r, dark, readnoise)
+    assert np.all(lc_data_p[0] == 0)
+    assert np.allclose(sn_params_p[0], sn_params, rtol=1e-12, atol=0)
+    assert np.allclose(true_flux_p, true_flux, rtol=1e-12, atol=0)
+    for q, q_p in zip(lc_data, lc_data_p[1:]):
+        if q.dtype.kind == 'f':
+            assert np.allclose(q_p, q, rtol=1e-12, atol=0)
+        else:
+            assert np.all(q_p == q)
+
+
+def test_make_population_fluxes(registered_filters):
+    # a mixed population, each with its own cadence, against the true fluxes of make_fluxes'
+    # model of each supernova
+    sn_types_ = np.array(['Ia', 'IIP', 'Ia', 'IIn', 'Ib'])
+    zs, t0s = np.array([0.3, 1.1, 0.85, 0.2, 1.45]), np.array([0, 5.5, -3, 10, 1])
+    times_ = times + np.arange(0, len(zs)).reshape(-1, 1) * 1.5
+    lc_data, sn_params, true_flux = sns.make_population_fluxes(
+        filters, sn_types_, zs, t0s, times_, filt_zp, exptime, psf_r, dark, readnoise)
+    n_obs = len(times) * len(filters)
+    true_flux = true_flux.reshape(len(zs), n_obs)
+    for i in range(0, len(zs)):
+        sn_model = sns.get_sn_model(sn_types_[i], 1, t0=t0s[i], z=zs[i])
+        sns.set_sn_peakabsmag(sn_model, sn_types_[i], -19.0, 'f125w', 'ab')
+        t_f = sns.model_bandflux(sn_model, sn_types_[i], filters, times_[i] + t0s[i], filt_zp)
+        t_f[t_f < 0] = 0.01
+        assert np.allclose(true_flux[i], t_f.reshape(-1), rtol=1e-12, atol=0)
+        assert np.allclose(sn_params[i], [sn_model[q] for q in ['z', 't0', 'amplitude']],
+                           rtol=1e-12, atol=0)
+        q = slice(i * n_obs, (i + 1) * n_obs)
+        assert np.all(lc_data[0][q] == i)
+        assert np.allclose(lc_data[1][q], np.repeat(times_[i] + t0s[i], len(filters)),
+                           rtol=1e-12, atol=0)
+        assert np.all(lc_data[2][q] == np.tile(filters, len(times)))
+
+    with pytest.raises(ValueError):
+        sns.make_population_fluxes(filters, sn_types_, np.append(zs[:-1], 0), t0s, times_,
+                                   filt_zp, exptime, psf_r, dark, readnoise)
+
+
+def test_host_library_matches(tmp_path):
+    # a host library is only used with the PSF components it was rendered with: not with another
+    # file, nor with its own file once that has been rewritten with other components
+    psf_c = np.array([[0, 0, 0.8, 0.7, 0.1, 0.9], [0, 0, 6.6, 6.6, 0, 0.1]])
+    psf_comp_filename, other_filename = str(tmp_path / 'psf_comp.npy'), \
+        str(tmp_path / 'psf_comp_2.npy')
+    np.save(psf_comp_filename, np.array([psf_c] * len(filters)))
+    np.save(other_filename, np.array([psf_c * 1.01] * len(filters)))
+    library_root = str(tmp_path / 'hosts')
+    np.random.seed(3)
+    sns.make_host_library(library_root, 2, filters, 0.11, filt_zp, psf_comp_filename)
+    with np.load('{}_hosts.npz'.format(library_root)) as f:
+        library_hosts = {q: f[q] for q in f.files}
+    assert sns.host_library_matches(library_hosts, filters, 0.11, filt_zp, psf_comp_filename)
+    assert not sns.host_library_matches(library_hosts, filters, 0.11, filt_zp, other_filename)
+    assert not sns.host_library_matches(library_hosts, filters, 0.12, filt_zp, psf_comp_filename)
+    np.save(psf_comp_filename, np.array([psf_c * 1.01] * len(filters)))
+    # the hash is kept per modification time, so make sure that it moves on
+    mtime = os.path.getmtime(psf_comp_filename) + 10
+    os.utime(psf_comp_filename, (mtime, mtime))
+    assert not sns.host_library_matches(library_hosts, filters, 0.11, filt_zp, psf_comp_filename)
+
+
+def test_grid_bandflux_synthetic(monkeypatch):
+    # interpolated bandfluxes of a synthetic template, with a secondary maximum and colour
+    # evolution, against sncosmo over the table's full phase range -- past both ends of the
+    # template, where model_bandflux must fall back to sncosmo -- relative to the peak bandflux
+    phase = np.arange(-15, 60.01, 1)
+    wave = np.arange(3000, 20001, 50)
+    p, w = phase.reshape(-1, 1), wave.reshape(1, -1)
+    flux = 1e-9 * (np.exp(-0.5 * (p / 8)**2) + 0.3 * np.exp(-0.5 * ((p - 28) / 6)**2)) * \
+        np.exp(-0.5 * ((w - 7000 - 60 * p) / 3000)**2)
+    source = sncosmo.TimeSeriesSource(phase, wave, flux, name='synthetic')
+    band = sncosmo.Bandpass(np.arange(9000, 12001, 100), np.ones(31), name='synthetic_band')
+    sncosmo.register(band, force=True)
+    sn_model = sncosmo.Model(source)
+    zs, phases = np.arange(0.4, 0.6 + 1e-10, 0.01), sns.bandflux_grid_phase
+    grid = {'z': zs, 'phase': phases, 'flux': sns.make_bandflux_grid(sn_model, band, zs, phases),
+            'min_phase': source.minphase(), 'max_phase': source.maxphase()}
+    monkeypatch.setitem(sns.bandflux_grids, ('synthetic', 'synthetic_band'), grid)
+
+    # the error is bounded by the table's own mid-cell error, as load_bandflux_grid records it
+    z_mid, phase_mid = zs[:-1] + np.diff(zs) / 2, phases[:-1] + np.diff(phases) / 2
+    diff = sns.grid_bandflux(grid, z_mid.reshape(-1, 1), phase_mid.reshape(1, -1)) - \
+        sns.make_bandflux_grid(sn_model, band, z_mid, phase_mid)
+    peak = np.nanmax(grid['flux'])
+    err = np.nanmax(np.abs(diff)) / peak
+    assert err < 1e-4
+
+    time = np.arange(-40, 120, 0.37)
+    for z in [0.4, 0.433, 0.5, 0.587]:
+        sn_model.set(z=z, t0=1.3, amplitude=1)
+        t_f = sns.model_bandflux(sn_model, 'synthetic', ['synthetic_band'], time, [0])[:, 0]
+        assert np.all(np.isfinite(t_f))
+        assert np.allclose(t_f, sn_model.bandflux(band, time, zp=0, zpsys='ab'), rtol=0,
+                           atol=2 * err * peak)
+    # the table only interpolates where its whole cubic stencil lies within the template
+    inside = ~np.isnan(sns.grid_bandflux(grid, 0.5, time - 1.3))
+    rest = (time - 1.3) / 1.5
+    assert np.all(~inside | ((rest > source.minphase()) & (rest < source.maxphase())))
+    assert np.any(inside) and np.any(~inside)
+
+
+@pytest.mark.parametrize('sn_type', ['Ia', 'IIP'])
+def test_get_sn_model_copies(sn_type):
+    # every model is a copy of the cached prototype, so setting the parameters of one changes
+    # neither the prototype nor any other model, and a new model starts from the defaults
+    sn_model = sns.get_sn_model(sn_type, 1, t0=5.0, z=0.5)
+    default = sns.get_sn_model(sn_type, 0).parameters
+    other = sns.get_sn_model(sn_type, 1, t0=-3.0, z=1.2)
+    other.set(amplitude=3 * other['amplitude'])
+    assert sn_model['z'] == 0.5 and sn_model['t0'] == 5.0
+    assert sn_model['amplitude'] == default[sn_model.param_names.index('amplitude')]
+    assert other.source is not sn_model.source
+    assert other.source is not sns.sn_model_prototypes[sn_type].source
+    assert np.all(sns.sn_model_prototypes[sn_type].parameters == default)
+    assert np.all(sns.get_sn_model(sn_type, 0).parameters == default)